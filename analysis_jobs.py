@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+"""
+分析ジョブのキュー（プロセス内で共有するワーカープール）
+
+60-90秒かかる分析をStreamlitのスクリプトスレッドで実行すると、その間セッションが固まり、
+ブラウザを再読み込みすると実行中の分析が失われる。分析はジョブとしてワーカープールに登録し、
+画面はジョブIDで状態・進捗・途中経過を取得する（別の画面に移動しても、戻ってきて結果を受け取れる）。
+同時に実行するジョブ数はワーカー数で制限し、超えた分は待機する。
+
+同じ key（正規化したリクエスト）のジョブが実行中・待機中であれば、新しく実行せずにそのジョブに
+相乗りする（single-flight）。相乗りしたユーザーも同じジョブIDで途中経過と結果を受け取るため、
+会議の後などに同じ分析が何人から実行されてもAPIの呼び出しは1回で済む。
+
+    queue = AnalysisJobQueue(max_workers=4)
+    job_id = queue.submit("admin", "競合 vs 自社", lambda job: run(job), key=request_key)
+    job = queue.get(job_id)   # job.state / job.phase / job.progress / job.result
+"""
+
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_ERROR = "error"
+JOB_CANCELLED = "cancelled"
+
+FINISHED_STATES = (JOB_DONE, JOB_ERROR, JOB_CANCELLED)
+
+
+class JobCancelledError(Exception):
+    """ジョブが中止された"""
+
+
+class AnalysisJob:
+    """
+    1件の分析ジョブ
+
+    ワーカースレッドが set_progress() / note() / append_text() で更新し、
+    画面側は同じオブジェクトを読む（値の差し替えのみなので読み取りにロックは不要）。
+    """
+
+    def __init__(self, owner, label, context=None, key=None):
+        self.id = uuid.uuid4().hex[:12]
+        self.owner = owner            # ジョブを登録したユーザー
+        self.owners = {owner}         # 結果を受け取れるユーザー（相乗りしたユーザーを含む）
+        self.key = key
+        self.attached = 0             # 相乗りした回数
+        self.label = label
+        self.context = context or {}  # 結果の表示に使う付随情報（タイトル名等）
+        self.state = JOB_QUEUED
+        self.phase = "実行待ち"
+        self.progress = None          # 0.0-1.0（不明ならNone）
+        self.notes = []               # [(レベル "info" / "warning" / "success", メッセージ), ...]
+        self.chunks = []              # ストリーミング応答の受信済み断片
+        self.first_chunk_at = None    # 最初の断片を受信した時刻（最初のトークンまでの時間の計測用）
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.cancel_event = threading.Event()
+        self._future = None
+
+    @property
+    def finished(self):
+        return self.state in FINISHED_STATES
+
+    @property
+    def elapsed(self):
+        """開始からの経過秒数（未開始なら0）"""
+        if self.started_at is None:
+            return 0.0
+        return (self.finished_at or time.time()) - self.started_at
+
+    def set_progress(self, phase, progress=None):
+        self.phase = phase
+        self.progress = progress
+
+    def note(self, message, level="info"):
+        self.notes.append((level, message))
+
+    def append_text(self, chunk):
+        if self.first_chunk_at is None:
+            self.first_chunk_at = time.time()
+        self.chunks.append(chunk)
+
+    def check_cancelled(self):
+        """中止が要求されていれば JobCancelledError（ワーカーは処理の区切りで呼ぶ）"""
+        if self.cancel_event.is_set():
+            raise JobCancelledError("分析を中止しました")
+
+
+class AnalysisJobQueue:
+    """
+    分析ジョブのワーカープール（プロセス内で共有）
+
+    完了したジョブは結果を受け取れるよう finished_ttl 秒・最大 max_finished 件まで保持する。
+    """
+
+    def __init__(self, max_workers=4, max_finished=200, finished_ttl=6 * 3600):
+        self.max_workers = max_workers
+        self.max_finished = max_finished
+        self.finished_ttl = finished_ttl
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="analysis-job")
+        self._lock = threading.Lock()
+        self._jobs = {}
+        self._inflight = {}       # key -> 実行中・待機中のジョブ
+        self._attached_total = 0
+
+    # ---------- 登録 ----------
+
+    def submit(self, owner, label, fn, context=None, key=None):
+        """
+        ジョブを登録（実行の完了は待たない）
+
+        Args:
+            owner: ジョブを登録したユーザー名（結果を受け取れるのは本人と相乗りしたユーザーのみ）
+            label: 一覧に表示する説明
+            fn: fn(job) を実行して戻り値を job.result にする関数
+            context: job.context に保存する付随情報
+            key: 正規化したリクエスト。同じ key のジョブが完了前（中止要求済みを除く）なら
+                 fn は実行せず、そのジョブに owner を追加して同じIDを返す
+
+        Returns:
+            ジョブID
+        """
+        with self._lock:
+            running = self._inflight.get(key) if key is not None else None
+            if running is not None and not running.finished and not running.cancel_event.is_set():
+                running.owners.add(owner)
+                running.attached += 1
+                self._attached_total += 1
+                return running.id
+            self._prune()
+            job = AnalysisJob(owner, label, context, key)
+            self._jobs[job.id] = job
+            if key is not None:
+                self._inflight[key] = job
+        job._future = self._executor.submit(self._run, job, fn)
+        return job.id
+
+    def _run(self, job, fn):
+        if job.cancel_event.is_set():
+            self._finish(job, JOB_CANCELLED, error="実行前に中止しました")
+            return
+        job.state = JOB_RUNNING
+        job.started_at = time.time()
+        job.set_progress("実行中")
+        try:
+            job.result = fn(job)
+        except JobCancelledError as e:
+            self._finish(job, JOB_CANCELLED, error=str(e))
+        except Exception as e:
+            self._finish(job, JOB_ERROR, error=str(e))
+        else:
+            self._finish(job, JOB_DONE)
+
+    def _finish(self, job, state, error=None):
+        with self._lock:
+            if job.key is not None and self._inflight.get(job.key) is job:
+                del self._inflight[job.key]
+        job.error = error
+        job.finished_at = time.time()
+        job.set_progress({JOB_DONE: "完了", JOB_ERROR: "エラー", JOB_CANCELLED: "中止"}[state], 1.0)
+        job.state = state
+
+    # ---------- 参照・操作 ----------
+
+    def get(self, job_id):
+        """ジョブ（存在しない・保持期限切れならNone）"""
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def jobs_for(self, owner):
+        """ユーザーのジョブ（相乗りしたジョブを含む、新しい順）"""
+        with self._lock:
+            jobs = [job for job in self._jobs.values() if owner in job.owners]
+        return sorted(jobs, key=lambda job: -job.created_at)
+
+    def cancel(self, job_id):
+        """
+        ジョブの中止を要求
+
+        待機中のジョブは実行しない。実行中のジョブは処理の区切り（ストリーミングの断片・
+        要約のチャンク等）で中止する（応答を待っている1回のAPI呼び出しは完了まで待つ）。
+        """
+        job = self.get(job_id)
+        if job is None or job.finished:
+            return False
+        job.cancel_event.set()
+        if job._future is not None and job._future.cancel():
+            self._finish(job, JOB_CANCELLED, error="実行前に中止しました")
+        return True
+
+    def detach(self, job_id, owner):
+        """
+        相乗りしている他のユーザーがいれば、owner だけをジョブから外す（ジョブは続行）
+
+        Returns:
+            外した場合True（owner が最後の1人なら何もせずFalse、呼び出し側で cancel する）
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job.finished or owner not in job.owners or len(job.owners) == 1:
+                return False
+            job.owners.discard(owner)
+            return True
+
+    def stats(self):
+        """
+        {"queued": 待機中, "running": 実行中, "finished": 保持中の完了ジョブ, "workers": ワーカー数,
+         "attached": このプロセスで相乗りした（APIを呼ばずに済んだ）回数}
+        """
+        with self._lock:
+            states = [job.state for job in self._jobs.values()]
+            attached = self._attached_total
+        return {
+            "queued": states.count(JOB_QUEUED),
+            "running": states.count(JOB_RUNNING),
+            "finished": sum(state in FINISHED_STATES for state in states),
+            "workers": self.max_workers,
+            "attached": attached,
+        }
+
+    def _prune(self):
+        """保持期限切れ・上限超過の完了ジョブを削除（ロック内で呼ぶ）"""
+        now = time.time()
+        finished = sorted(
+            (job for job in self._jobs.values() if job.finished),
+            key=lambda job: job.finished_at
+        )
+        excess = len(finished) - self.max_finished
+        for i, job in enumerate(finished):
+            if i < excess or now - job.finished_at > self.finished_ttl:
+                del self._jobs[job.id]
@@ -0,0 +1,597 @@
+# -*- coding: utf-8 -*-
+"""
+競合分析プロンプトの組み立て（Prompt Caching対応）
+
+プロンプトは「静的プレフィックス」と「動的サフィックス」に分けて構築する。
+静的プレフィックス（システムプロンプト・市場データ・出力形式テンプレート）は
+リクエストごとに1バイトも変わらないため、Claudeでは cache_control を付けて
+キャッシュし、OpenAIでは先頭一致の自動キャッシュに乗せる。
+競合タイトル名などリクエストごとの値はすべて末尾の動的サフィックスに置く。
+"""
+
+# 静的プレフィックスの内容を変更したら必ず上げる（結果キャッシュのキーにも使用）
+PROMPT_TEMPLATE_VERSION = "2.7.1"
+
+# 組み込み市場データ
+MARKET_DATA = """
+【2024年度 国内ゲーム市場データ】
+■ 総市場規模
+- モバイルゲーム: 約1.3兆円
+- 家庭用ゲーム: 約0.4兆円
+- PCゲーム: 約0.2兆円
+
+■ ジャンル別シェア（モバイル）
+- RPG: 28%
+- パズル: 15%
+- アクション: 12%
+- カードゲーム: 10%
+- その他: 35%
+
+■ 主要タイトル推定年間売上（2024年）
+1. モンスターストライク: 約500億円
+2. パズル&ドラゴンズ: 約300億円
+3. Fate/Grand Order: 約400億円
+4. プロジェクトセカイ: 約250億円
+5. ウマ娘 プリティーダービー: 約600億円
+
+■ プラットフォーム比率
+- iOS: 55%
+- Android: 45%
+
+■ ユーザー獲得単価（CPI）
+- RPG: 800-1,500円
+- パズル: 300-600円
+- アクション: 500-1,000円
+"""
+
+# Provider・モード別のモデルとtemperature
+CLAUDE_PROVIDER = "Claude (Anthropic)"
+OPENAI_PROVIDER = "OpenAI (GPT)"
+MODEL_SETTINGS = {
+    (CLAUDE_PROVIDER, False): ("claude-sonnet-4-20250514", 0.7),
+    (CLAUDE_PROVIDER, True): ("claude-opus-4-20250514", 0.1),
+    (OPENAI_PROVIDER, False): ("gpt-4o", 0.7),
+}
+
+# 補助的な呼び出し（資料の要約・スコアの取得）に使う安価なモデル
+LIGHT_MODELS = {
+    CLAUDE_PROVIDER: "claude-3-5-haiku-20241022",
+    OPENAI_PROVIDER: "gpt-4o-mini",
+}
+
+
+def select_model(provider: str, use_opus: bool = False) -> tuple:
+    """
+    使用するモデルとtemperatureを選択
+
+    Returns:
+        (モデル名, temperature)
+    """
+    if provider != CLAUDE_PROVIDER:
+        use_opus = False
+    return MODEL_SETTINGS[(provider, use_opus)]
+
+
+# 共通システムプロンプト
+BASE_SYSTEM_PROMPT = "あなたはゲーム業界の競合分析専門家です。"
+
+# Opus 4用システムプロンプト（表形式の徹底）
+OPUS_SYSTEM_PROMPT = """あなたはゲーム業界の競合分析専門家です。
+
+【絶対に守るべきルール】
+1. すべての情報は必ずMarkdown表形式で出力すること
+2. 表の形式: | 項目 | 値1 | 値2 | のように必ず縦棒(|)で区切ること
+3. 箇条書き（-や•）は絶対に使用禁止
+4. テキストのみの羅列は禁止
+5. 自社タイトルのスコア・データも必ず記載すること（空欄禁止）
+6. 新規タイトルの場合は「目標XX」「計画XX」という形で記載
+
+このような表形式を必ず使用してください。テキストのみの出力は不可です。"""
+
+# Opus 4用: Few-Shot Examples
+OPUS_FEW_SHOT = """
+**【出力形式の重要な注意】**
+すべてのセクションは必ずMarkdown表形式で出力してください。
+
+【正しい出力例】
+| 項目 | FGO | モンスターストライク |
+|------|-----|-------------------|
+| 推定年間売上 | 950億円 | 800億円（目標） |
+| 市場ランキング | TOP 3 | TOP 10（目標） |
+
+【誤った出力例（禁止）】
+FGOの推定年間売上は950億円です。
+モンスターストライクの目標は800億円です。
+
+→ このようなテキスト形式は絶対禁止です！
+
+---
+
+"""
+
+# 出力形式テンプレート
+# 「競合タイトル」「自社タイトル」は動的サフィックスで実際のタイトル名への置き換えを指示する
+OUTPUT_TEMPLATE = """
+**【重要指示】以下を必ず守ってください:**
+1. COMPARISON_METRICSは必ずJSON形式（```json ... ```）で出力
+2. 全てのセクションで必ず表形式（Markdownテーブル）を使用
+3. 箇条書き（-や•）は使用禁止
+4. セクション名（MARKET_ANALYSIS、COMPETITOR_ANALYSIS等）を単独行で出力しない（必ず## セクション名の形式）
+5. **既知の数値情報がある場合は必ずその値を使用し、『（市場データ参照）』または『（既知情報）』と明記**
+6. **推測値の場合は必ず『（推定）』と明記し、根拠を示す**
+7. **データが不明な場合は『データなし』と記載し、無理に推測しない**
+8. **すべての数値・評価に対して、可能な限り出典・根拠を併記する**
+9. **買い切りゲームとライブサービスで指標を適切に使い分ける**
+10. **楽観的すぎる予測を避け、現実的なリスクも明示する**
+
+以下の形式で回答してください。**必ず数値データを引用**してください:
+
+## EXECUTIVE_SUMMARY
+*3-5行で結論と最重要ポイント簡潔に記載*
+
+## COMPARISON_METRICS
+
+**評価軸の定義**（100点満点）:
+- **market_position（市場ポジション）**: 市場での認知度・ランキング順位・ブランド力
+- **revenue_potential（収益性）**: 年間売上規模・ARPU・課金効率・収益安定性
+  * ライブサービス: 継続課金・イベント収益・長期ARPU
+  * 買い切り: 初回売上・DLC収益・周辺商品展開
+- **user_base（ユーザー基盤）**: DAU/MAU・ユーザー定着率・コミュニティ活性度
+- **brand_strength（ブランド力）**: IP価値・メディア露出・ファンロイヤリティ・二次展開力
+- **technology（技術力）**: グラフィック品質・システム安定性・技術革新性・開発体制の強さ
+
+**必ず以下の正確なJSON形式で出力**（評価の根拠は表の後に記載）:
+```json
+{
+  "competitor": {
+    "market_position": 85,
+    "revenue_potential": 75,
+    "user_base": 80,
+    "brand_strength": 90,
+    "technology": 70
+  },
+  "our_product": {
+    "market_position": 40,
+    "revenue_potential": 60,
+    "user_base": 30,
+    "brand_strength": 45,
+    "technology": 75
+  }
+}
+```
+
+**各評価の根拠**（必ず具体的な要素を列挙）:
+
+| 評価軸 | 競合スコア | 根拠となる具体的要素 | 自社スコア | 根拠となる具体的要素 |
+|-------|----------|-------------------|----------|-------------------|
+| 市場ポジション | XX点 | • [要素1: 例：国内売上TOP3]<br>• [要素2: 例：Google検索トレンド高位]<br>• [要素3: 例：SNS言及数多数] | XX点 | • [要素1]<br>• [要素2]<br>• [要素3] |
+| 収益性 | XX点 | • [要素1: 例：年間売上600億円]<br>• [要素2: 例：ARPU 8,000円/月]<br>• [要素3: 例：課金ユーザー率15%] | XX点 | • [要素1]<br>• [要素2]<br>• [要素3] |
+| ユーザー基盤 | XX点 | • [要素1: 例：DAU 200万人]<br>• [要素2: 例：継続率70%]<br>• [要素3: 例：コミュニティ活発] | XX点 | • [要素1]<br>• [要素2]<br>• [要素3] |
+| ブランド力 | XX点 | • [要素1: 例：IP知名度90%]<br>• [要素2: 例：コラボ実績多数]<br>• [要素3: 例：メディア露出高] | XX点 | • [要素1]<br>• [要素2]<br>• [要素3] |
+| 技術力 | XX点 | • [要素1: 例：グラフィック品質高]<br>• [要素2: 例：サーバー安定性99.9%]<br>• [要素3: 例：技術的革新性] | XX点 | • [要素1]<br>• [要素2]<br>• [要素3] |
+
+**重要**: 各評価軸について、スコアを構成する具体的要素を最低3つ挙げること。抽象的な表現ではなく、数値・事実に基づく要素を記載。
+
+
+## MARKET_ANALYSIS
+### 市場規模とトレンド
+
+**必ず以下の表形式で出力（箇条書き禁止）**:
+**既知の売上データがある場合は必ずその値を使用し、『（既知情報）』と明記してください**
+
+| 項目 | 競合タイトル | 自社タイトル |
+|------|-------------------|---------------|
+| 推定年間売上 | XXX億円（既知情報 or 市場データ参照 or 推定） | XXX億円（目標 or 推定） |
+| 市場ランキング | TOP XX（[期間]・[範囲]） | TOP XX（[期間]・[範囲]・目標） |
+
+*ランキング定義例: 「月間・国内モバイル全体」「年間・ジャンル内」「週間・iOS売上」など具体的に明記*
+
+| DAU/MAU | XX万人/XX万人（既知 or 推定） | XX万人/XX万人（目標） |
+| 主要ターゲット層 | XX代XX性 | XX代XX性 |
+| 市場シェア | X.X%（既知 or 推定） | X.X%（目標） |
+
+*既知の情報を最優先し、推測の場合は必ず根拠を付記*
+**重要**: 買い切りゲームの場合、DAU/MAUは販売本数・アクティブプレイヤー数など適切な指標に置き換えること
+（例: 「累計販売XX万本」「月間アクティブプレイヤーXX万人」など）
+
+### ジャンル特性
+
+**必ず以下の表形式で出力（箇条書き禁止）**:
+
+| 特性項目 | 競合タイトル | 自社タイトル |
+|----------|-------------------|---------------|
+| ジャンル適合度 | 高/中/低 + 理由 | 高/中/低 + 理由 |
+| 差別化ポイント | 具体的特徴 | 具体的特徴 |
+| CPI（ユーザー獲得単価） | XXX円（[出典]） | XXX円（推定・目標） |
+| 主要収益モデル | [ガチャ/サブスク等] | [想定モデル] |
+
+*CPI出典例: 「業界平均」「類似タイトル実績」「マーケティングレポート」など具体的に明記*
+*データがない場合は「推測・根拠不足」と明記すること*
+
+## COMPETITOR_ANALYSIS
+
+### ビジネスモデル比較
+
+| 項目 | 競合タイトル | 自社タイトル |
+|------|-------------------|---------------|
+| 収益化手法 | [具体的手法] | [想定手法] |
+| 課金設計 | [ガチャ/サブスク等] | [想定設計] |
+| 平均課金単価 | [推定金額] | [目標金額] |
+| 収益の柱 | [メイン収益源] | [想定収益源] |
+
+### 強み・弱み比較
+
+**必ず以下の表形式で出力（箇条書き禁止）**:
+
+| 評価軸 | 競合タイトル | 自社タイトル |
+|--------|-------------------|---------------|
+| **強み1** | [具体的な強み] | [具体的な強み] |
+| **強み2** | [具体的な強み] | [具体的な強み] |
+| **強み3** | [具体的な強み] | [具体的な強み] |
+| **弱み1** | [具体的な弱み] | [具体的な弱み] |
+| **弱み2** | [具体的な弱み] | [具体的な弱み] |
+| **弱み3** | [具体的な弱み] | [具体的な弱み] |
+
+## GAP_ANALYSIS
+
+### 主要ギャップ分析
+
+| 評価項目 | 現状のギャップ | 重要度 | 対応優先度 |
+|----------|---------------|--------|-----------|
+| 市場認知度 | 競合タイトルが[X]点優位 | 高/中/低 | 高/中/低 |
+| 収益性 | 競合タイトルが[X]点優位 | 高/中/低 | 高/中/低 |
+| ユーザー基盤 | 競合タイトルが[X]点優位 | 高/中/低 | 高/中/低 |
+| 技術力 | 自社タイトルが[X]点優位 | 高/中/低 | 高/中/低 |
+| ブランド力 | 競合タイトルが[X]点優位 | 高/中/低 | 高/中/低 |
+
+### 差別化戦略
+
+**必ず以下の表形式で出力（自社タイトルの差別化ポイントを競合タイトルと比較）**:
+
+| 差別化要素 | 競合タイトルのアプローチ | 自社タイトルの差別化ポイント | 実現可能性 |
+|-----------|----------------------------|----------------------------|----------|
+| [要素1] | [競合の現状] | [自社の差別化内容] | 高/中/低 |
+| [要素2] | [競合の現状] | [自社の差別化内容] | 高/中/低 |
+| [要素3] | [競合の現状] | [自社の差別化内容] | 高/中/低 |
+
+## ACTION_PLAN (自社タイトル向け)
+
+**自社タイトルの具体的アクションプラン**
+
+### 短期施策（3ヶ月以内）
+
+**対象タイトル: 自社タイトル**
+
+**必ず以下の表形式で出力**:
+
+| No | 施策 | 目的 | 実行内容 | 期待効果 | 優先度 |
+|----|------|------|---------|---------|--------|
+| 1 | [施策名] | [目的] | [具体的内容] | [効果・KPI] | 高/中/低 |
+| 2 | [施策名] | [目的] | [具体的内容] | [効果・KPI] | 高/中/低 |
+| 3 | [施策名] | [目的] | [具体的内容] | [効果・KPI] | 高/中/低 |
+
+### 中期施策（6-12ヶ月）
+
+**対象タイトル: 自社タイトル**
+
+**必ず以下の表形式で出力**:
+
+| No | 戦略 | 目標 | 実行計画 | マイルストーン | KPI |
+|----|------|------|---------|--------------|-----|
+| 1 | [戦略名] | [目標数値] | [計画概要] | [達成時期] | [測定指標] |
+| 2 | [戦略名] | [目標数値] | [計画概要] | [達成時期] | [測定指標] |
+
+## RISK_OPPORTUNITY (自社タイトル向け)
+
+**自社タイトルのリスクと市場機会分析**
+
+### リスク分析
+
+**対象タイトル: 自社タイトル**
+
+| リスク項目 | 内容 | 発生確率 | 影響度 | 対策 |
+|-----------|------|---------|--------|------|
+| [リスク1] | [具体的内容] | 高/中/低 | 高/中/低 | [対策] |
+| [リスク2] | [具体的内容] | 高/中/低 | 高/中/低 | [対策] |
+| [リスク3] | [具体的内容] | 高/中/低 | 高/中/低 | [対策] |
+
+### 市場機会
+
+**対象タイトル: 自社タイトル**
+
+| 機会項目 | 内容 | 実現可能性 | 期待効果 | アプローチ |
+|---------|------|-----------|---------|-----------|
+| [機会1] | [具体的内容] | 高/中/低 | [効果] | [方法] |
+| [機会2] | [具体的内容] | 高/中/低 | [効果] | [方法] |
+| [機会3] | [具体的内容] | 高/中/低 | [効果] | [方法] |
+
+**実現可能性の評価基準**:
+- **高**: 自社の現有リソース・技術で即座に実行可能。競合優位性あり。成功事例多数。
+- **中**: 追加投資・時間が必要だが実現可能。競合も狙える領域。リスクあり。
+- **低**: 大規模投資・技術革新が必要。高リスク。他社も成功例少ない。
+
+*楽観的すぎる評価は避け、現実的なリスク・障壁も併記すること*
+
+## DATA_SOURCES
+
+**必ず以下の形式で具体的な出典を明記**:
+
+### 使用したデータソース
+
+| データ項目 | 出典 | 詳細（ページ/URL） | 信頼性 |
+|----------|------|------------------|--------|
+| 市場規模 | [レポート名] | [ページ番号 or URL] | 高/中/低 |
+| 売上推定 | [情報源] | [ページ番号 or URL] | 高/中/低 |
+| DAU/MAU | [情報源] | [ページ番号 or URL] | 高/中/低 |
+| CPI | [情報源] | [ページ番号 or URL] | 高/中/低 |
+
+**記載例**:
+- PDFデータの場合: 「ファミ通ゲーム白書2025 p.45-47」
+- Webデータの場合: 「https://example.com/market-report」
+- 組み込みデータの場合: 「2024年度国内ゲーム市場データ（提供データ）」
+- 推測の場合: 「業界一般知識に基づく推測」
+
+**データの信頼性について**:
+- **高**: 公式発表、大手市場調査会社レポート、政府統計
+- **中**: 業界推定、アナリストレポート、メディア報道
+- **低**: 推測、一般的な業界知識、根拠不十分
+
+**データが不足している項目**:
+[該当する項目を明記し、推測であることを明示]
+
+**重要**: すべてのデータについて、可能な限り具体的な出典を記載すること。ページ番号やURLがある場合は必ず含めること。
+"""
+
+
+def build_static_prefix(use_opus: bool) -> str:
+    """
+    キャッシュ対象の静的プレフィックスを構築
+    
+    Args:
+        use_opus: Opus 4用のFew-Shot Examplesを含めるか
+    
+    Returns:
+        リクエスト間でバイト単位で同一のプロンプト文字列
+    """
+    return f"""
+あなたはゲーム業界の競合分析専門家です。以下の市場データと分析対象の情報を基に詳細な分析を実施してください。
+分析対象の情報はこの後のメッセージで提示します。
+
+{OPUS_FEW_SHOT if use_opus else ""}
+{MARKET_DATA}
+
+**【重要】既知の情報がある場合は、必ずその数値を優先して使用してください。推測が必要な場合は『推測』と明記してください。**
+
+---
+
+{OUTPUT_TEMPLATE}"""
+
+
+def describe_targets(inputs: dict) -> list:
+    """分析対象（競合・自社・分析タイプ・比較観点・特記事項）の説明行"""
+    lines = [
+        "【分析対象】",
+        "■ 競合タイトル",
+        f"- タイトル名: {inputs['competitor_name']}",
+        f"- ジャンル: {inputs['competitor_genre']}",
+        f"- プラットフォーム: {', '.join(inputs['competitor_platform'])}",
+    ]
+    if inputs.get("competitor_revenue"):
+        lines.append(f"- 既知の年間売上: {inputs['competitor_revenue']}")
+    if inputs.get("competitor_dau"):
+        lines.append(f"- 既知のDAU/MAU: {inputs['competitor_dau']}")
+    
+    lines += [
+        "",
+        "■ 自社タイトル",
+        f"- タイトル名: {inputs['our_product']}",
+        f"- ジャンル: {inputs['our_genre']}",
+        f"- プラットフォーム: {', '.join(inputs['our_platform'])}",
+    ]
+    if inputs.get("our_revenue_target"):
+        lines.append(f"- 売上目標: {inputs['our_revenue_target']}")
+    if inputs.get("our_dau_target"):
+        lines.append(f"- DAU/MAU目標: {inputs['our_dau_target']}")
+    
+    lines += [
+        "",
+        f"【分析タイプ】: {inputs['analysis_type']}",
+        f"【比較観点】: {', '.join(inputs['comparison_focus'])}",
+        "",
+        "【特記事項】",
+        inputs.get("additional_context") or "特になし",
+    ]
+    return lines
+
+
+def build_dynamic_suffix(inputs: dict, reference_data: str = "") -> str:
+    """
+    リクエストごとに変わる分析対象情報を構築
+    
+    Args:
+        inputs: 入力フォームの値（competitor_name, our_product 等）
+        reference_data: アップロードされた参照データ
+    
+    Returns:
+        静的プレフィックスの後ろに付けるプロンプト文字列
+    """
+    competitor_name = inputs["competitor_name"]
+    our_product = inputs["our_product"]
+    
+    lines = describe_targets(inputs)
+    if reference_data:
+        lines += ["", reference_data.strip()]
+    
+    lines += [
+        "",
+        "**【表記の置き換え】** 出力形式の中の「競合タイトル」は"
+        f"「{competitor_name}」に、「自社タイトル」は「{our_product}」に置き換えて出力してください。",
+        "上記の出力形式に従って分析結果を出力してください。",
+    ]
+    return "\n".join(lines)
+
+
+def build_claude_request(inputs: dict, use_opus: bool, reference_data: str = "") -> dict:
+    """
+    Claude Messages API用の system / messages を構築
+    
+    静的プレフィックスの末尾に cache_control を付け、
+    システムプロンプトと合わせてキャッシュさせる。
+    
+    Returns:
+        messages.create / messages.stream にそのまま渡せる辞書
+    """
+    system_prompt = OPUS_SYSTEM_PROMPT if use_opus else BASE_SYSTEM_PROMPT
+    return {
+        "system": [
+            {"type": "text", "text": system_prompt},
+            {
+                "type": "text",
+                "text": build_static_prefix(use_opus),
+                "cache_control": {"type": "ephemeral"}
+            }
+        ],
+        "messages": [
+            {"role": "user", "content": build_dynamic_suffix(inputs, reference_data)}
+        ]
+    }
+
+
+def build_openai_messages(inputs: dict, reference_data: str = "") -> list:
+    """
+    OpenAI Chat Completions API用の messages を構築
+    
+    OpenAIは1024トークン以上の先頭一致部分を自動でキャッシュするため、
+    静的プレフィックスをsystemメッセージの先頭に置く。
+    """
+    return [
+        {"role": "system", "content": BASE_SYSTEM_PROMPT + "\n" + build_static_prefix(False)},
+        {"role": "user", "content": build_dynamic_suffix(inputs, reference_data)}
+    ]
+
+
+def build_request(provider: str, inputs: dict, use_opus: bool = False, reference_data: str = "",
+                  max_tokens: int = 8000) -> dict:
+    """
+    Provider別のAPIリクエスト引数を構築（モデル・temperature・プロンプト）
+
+    Returns:
+        messages.create / chat.completions.create にそのまま渡せる辞書
+    """
+    model, temperature = select_model(provider, use_opus)
+    if provider == CLAUDE_PROVIDER:
+        return {
+            "model": model,
+            "max_tokens": max_tokens,
+            "temperature": temperature,
+            **build_claude_request(inputs, use_opus, reference_data)
+        }
+    return {
+        "model": model,
+        "max_tokens": max_tokens,
+        "temperature": temperature,
+        "messages": build_openai_messages(inputs, reference_data)
+    }
+
+
+# スコアのみを取得する小さな呼び出し（tool use / JSON schema）
+METRICS_TOOL_NAME = "record_comparison_metrics"
+METRICS_MAX_TOKENS = 400
+METRIC_KEYS = ("market_position", "revenue_potential", "user_base", "brand_strength", "technology")
+
+_SCORE_SCHEMA = {
+    "type": "object",
+    "properties": {key: {"type": "integer", "minimum": 0, "maximum": 100} for key in METRIC_KEYS},
+    "required": list(METRIC_KEYS),
+    "additionalProperties": False,
+}
+METRICS_SCHEMA = {
+    "type": "object",
+    "properties": {"competitor": _SCORE_SCHEMA, "our_product": _SCORE_SCHEMA},
+    "required": ["competitor", "our_product"],
+    "additionalProperties": False,
+}
+
+METRICS_SYSTEM_PROMPT = """あなたはゲーム業界の競合分析専門家です。
+分析対象の情報と競合分析レポートの評価内容に基づき、5つの評価軸のスコア（0-100の整数）を競合タイトル・自社タイトルそれぞれについて出力してください。
+レポートにスコアが記載されている場合はその値をそのまま使ってください。
+- market_position（市場ポジション）/ revenue_potential（収益性）/ user_base（ユーザー基盤）/ brand_strength（ブランド力）/ technology（技術力）"""
+
+
+def build_metrics_request(provider: str, inputs: dict, report_excerpt: str = "") -> dict:
+    """
+    COMPARISON_METRICS のスコアだけを構造化出力で取得するリクエスト引数を構築
+
+    Claude は tool use（ツール指定で必ず呼ばせる）、OpenAI は response_format の JSON schema（strict）で
+    スキーマに沿ったJSONを返させる。モデル・max_tokens は呼び出し側で指定する。
+
+    Args:
+        inputs: 入力フォームの値
+        report_excerpt: 生成済みレポートの評価部分（スコアの根拠表など、なければ入力値のみで評価）
+
+    Returns:
+        messages.create / chat.completions.create に渡せる辞書（model を除く）
+    """
+    lines = describe_targets(inputs)
+    if report_excerpt:
+        lines += ["", "【競合分析レポートの評価内容】", report_excerpt.strip()]
+    content = "\n".join(lines)
+
+    if provider == CLAUDE_PROVIDER:
+        return {
+            "max_tokens": METRICS_MAX_TOKENS,
+            "temperature": 0,
+            "system": METRICS_SYSTEM_PROMPT,
+            "tools": [{
+                "name": METRICS_TOOL_NAME,
+                "description": "競合タイトルと自社タイトルの評価軸ごとのスコアを記録する",
+                "input_schema": METRICS_SCHEMA,
+            }],
+            "tool_choice": {"type": "tool", "name": METRICS_TOOL_NAME},
+            "messages": [{"role": "user", "content": content}],
+        }
+    return {
+        "max_tokens": METRICS_MAX_TOKENS,
+        "temperature": 0,
+        "response_format": {
+            "type": "json_schema",
+            "json_schema": {"name": METRICS_TOOL_NAME, "strict": True, "schema": METRICS_SCHEMA},
+        },
+        "messages": [
+            {"role": "system", "content": METRICS_SYSTEM_PROMPT},
+            {"role": "user", "content": content},
+        ],
+    }
+
+
+def extract_cache_usage(usage) -> dict:
+    """
+    APIレスポンスのusageからトークン数とキャッシュ使用状況を取り出す
+    
+    Claude: cache_creation_input_tokens / cache_read_input_tokens
+    OpenAI: prompt_tokens_details.cached_tokens
+    
+    Returns:
+        input_tokens, output_tokens, cache_creation_input_tokens, cache_read_input_tokens
+    """
+    if usage is None:
+        return {}
+    
+    # Claude
+    if hasattr(usage, "input_tokens"):
+        return {
+            "input_tokens": usage.input_tokens or 0,
+            "output_tokens": usage.output_tokens or 0,
+            "cache_creation_input_tokens": getattr(usage, "cache_creation_input_tokens", 0) or 0,
+            "cache_read_input_tokens": getattr(usage, "cache_read_input_tokens", 0) or 0,
+        }
+    
+    # OpenAI（キャッシュ読み取り分もprompt_tokensに含まれる）
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached_tokens = (getattr(details, "cached_tokens", 0) or 0) if details else 0
+    return {
+        "input_tokens": (usage.prompt_tokens or 0) - cached_tokens,
+        "output_tokens": usage.completion_tokens or 0,
+        "cache_creation_input_tokens": 0,
+        "cache_read_input_tokens": cached_tokens,
+    }
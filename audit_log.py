@@ -0,0 +1,316 @@
+# -*- coding: utf-8 -*-
+"""
+アクセスログ（監査ログ）のSQLiteストア
+
+ログイン・分析・エラーなどの記録はメモリ上のキューに積むだけで即座に戻り、
+バックグラウンドのライタースレッドがまとめて1トランザクションで書き込む。
+SQLiteはWALモードで開くため、書き込み中でも管理画面の読み取りはブロックされない。
+初回起動時に従来の logs/access_log.csv を一度だけ取り込む。
+"""
+
+import atexit
+import csv
+import os
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+
+LOG_COLUMNS = ("timestamp", "username", "display_name", "action", "details")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS access_log (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    timestamp TEXT NOT NULL,
+    username TEXT NOT NULL,
+    display_name TEXT,
+    action TEXT NOT NULL,
+    details TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_access_log_timestamp ON access_log (timestamp);
+CREATE INDEX IF NOT EXISTS idx_access_log_username ON access_log (username, timestamp);
+CREATE INDEX IF NOT EXISTS idx_access_log_action ON access_log (action, timestamp);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+INSERT_SQL = (
+    "INSERT INTO access_log (timestamp, username, display_name, action, details) "
+    "VALUES (?, ?, ?, ?, ?)"
+)
+
+
+def connect(db_path, read_only=False):
+    """WALモードの接続を開く（読み取り専用接続は書き込みと並行して使える）"""
+    if read_only:
+        conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True, timeout=5.0, check_same_thread=False)
+    else:
+        conn = sqlite3.connect(db_path, timeout=30.0, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+class AuditLog:
+    """
+    バッチ書き込みのアクセスログストア
+
+    log() はキューに積むだけでディスクI/Oを待たない。キューが満杯の場合は
+    記録を諦めて dropped を数える（リクエスト処理を止めないことを優先）。
+    """
+
+    def __init__(self, db_path="logs/access_log.db", legacy_csv_path="logs/access_log.csv",
+                 batch_size=200, flush_interval=1.0, max_queue=10000):
+        self.db_path = db_path
+        self.legacy_csv_path = legacy_csv_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._ready = threading.Event()
+        self._stopped = False
+
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self._thread = threading.Thread(target=self._writer, name="audit-log-writer", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    # ---------- 書き込み ----------
+
+    def log(self, username, action, details="", display_name=None, timestamp=None):
+        """1件記録する（ノンブロッキング）"""
+        entry = (
+            timestamp or datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            username,
+            display_name if display_name is not None else username,
+            action,
+            details,
+        )
+        try:
+            self._queue.put_nowait(entry)
+        except queue.Full:
+            self.dropped += 1
+
+    def _writer(self):
+        """ライタースレッド: 初期化・CSV移行の後、キューの内容をまとめて書き込む"""
+        conn = connect(self.db_path)
+        try:
+            conn.executescript(SCHEMA)
+            self._migrate_legacy_csv(conn)
+        except Exception as e:
+            print(f"アクセスログDBの初期化エラー: {e}")
+        finally:
+            self._ready.set()
+
+        while True:
+            try:
+                first = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                if self._stopped:
+                    break
+                continue
+            if first is None:
+                self._queue.task_done()
+                break
+
+            batch = [first]
+            stop = False
+            while len(batch) < self.batch_size:
+                try:
+                    entry = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if entry is None:
+                    stop = True
+                    self._queue.task_done()
+                    break
+                batch.append(entry)
+
+            self._write_batch(conn, batch)
+            for _ in batch:
+                self._queue.task_done()
+            if stop:
+                break
+        conn.close()
+
+    def _write_batch(self, conn, batch):
+        for attempt in range(3):
+            try:
+                with conn:
+                    conn.executemany(INSERT_SQL, batch)
+                return
+            except sqlite3.OperationalError as e:
+                # 他プロセスのロック等は少し待って再試行
+                if attempt == 2:
+                    print(f"ログ記録エラー: {e}（{len(batch)}件を破棄）")
+                    self.dropped += len(batch)
+                    return
+                time.sleep(0.2 * (attempt + 1))
+
+    def _migrate_legacy_csv(self, conn):
+        """従来のCSVログを一度だけ取り込み、取り込み済みのファイルは .migrated に改名する"""
+        if not self.legacy_csv_path or not os.path.isfile(self.legacy_csv_path):
+            return
+        if conn.execute("SELECT 1 FROM meta WHERE key = 'csv_migrated'").fetchone():
+            return
+
+        with open(self.legacy_csv_path, newline="", encoding="utf-8") as f:
+            rows = [
+                tuple(row.get(column) or "" for column in LOG_COLUMNS)
+                for row in csv.DictReader(f)
+            ]
+        with conn:
+            conn.executemany(INSERT_SQL, rows)
+            conn.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('csv_migrated', ?)",
+                (f"{len(rows)} rows @ {datetime.now().isoformat(timespec='seconds')}",)
+            )
+        os.replace(self.legacy_csv_path, self.legacy_csv_path + ".migrated")
+        print(f"アクセスログ: CSVから{len(rows)}件を移行しました")
+
+    def flush(self, timeout=5.0):
+        """キューに積まれた記録の書き込み完了を待つ（管理画面表示前・終了時用）"""
+        deadline = time.monotonic() + timeout
+        self._ready.wait(timeout)
+        while self._queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def close(self):
+        if self._stopped:
+            return
+        self._stopped = True
+        try:
+            self._queue.put(None, timeout=1.0)
+        except queue.Full:
+            pass
+        self._thread.join(timeout=5.0)
+
+    # ---------- 読み取り ----------
+
+    @contextmanager
+    def _reader(self):
+        """読み取り専用接続（DB未作成ならNone）"""
+        self._ready.wait(5.0)
+        if not os.path.exists(self.db_path):
+            yield None
+            return
+        conn = connect(self.db_path, read_only=True)
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def fetch(self, limit=1000):
+        """新しい順に最大limit件を取得（dictのリスト）"""
+        rows, _ = self.query(limit=limit)
+        return rows
+
+    def query(self, start_date=None, end_date=None, username=None, action=None, cursor=None, limit=50):
+        """
+        条件に合う記録を新しい順に1ページ分取得（キーセットページネーション）
+
+        Args:
+            start_date / end_date: 期間（date、両端を含む）
+            username / action: 完全一致の絞り込み（Noneなら全件）
+            cursor: 前ページの next_cursor（(timestamp, id)）。Noneなら先頭ページ
+            limit: 1ページの件数
+
+        Returns:
+            (記録のリスト, next_cursor) 次ページがなければ next_cursor は None
+        """
+        where, params = _build_filter(start_date, end_date, username, action)
+        if cursor is not None:
+            where.append("(timestamp < ? OR (timestamp = ? AND id < ?))")
+            params.extend([cursor[0], cursor[0], cursor[1]])
+        sql = (
+            f"SELECT id, {', '.join(LOG_COLUMNS)} FROM access_log"
+            f"{' WHERE ' + ' AND '.join(where) if where else ''}"
+            " ORDER BY timestamp DESC, id DESC LIMIT ?"
+        )
+        with self._reader() as conn:
+            if conn is None:
+                return [], None
+            rows = [dict(row) for row in conn.execute(sql, params + [limit + 1]).fetchall()]
+
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = (rows[-1]["timestamp"], rows[-1]["id"])
+        return rows, next_cursor
+
+    def distinct_values(self, column):
+        """絞り込み候補（username / action の一覧、インデックスのみで取得）"""
+        if column not in ("username", "action"):
+            raise ValueError(f"unsupported column: {column}")
+        with self._reader() as conn:
+            if conn is None:
+                return []
+            return [row[0] for row in conn.execute(f"SELECT DISTINCT {column} FROM access_log ORDER BY {column}")]
+
+    def summary(self, start_date=None, end_date=None, username=None):
+        """期間内の件数サマリー（分析数・エラー数・エラー率・ログイン失敗数）"""
+        where, params = _build_filter(start_date, end_date, username, None)
+        sql = (
+            "SELECT action, COUNT(*) FROM access_log"
+            f"{' WHERE ' + ' AND '.join(where) if where else ''}"
+            " GROUP BY action"
+        )
+        with self._reader() as conn:
+            counts = dict(conn.execute(sql, params).fetchall()) if conn is not None else {}
+
+        analyses = counts.get("analysis_executed", 0)
+        errors = counts.get("analysis_error", 0)
+        return {
+            "total": sum(counts.values()),
+            "analyses": analyses,
+            "errors": errors,
+            # 失敗した分析も analysis_executed として記録済みのため、分母は実行数のみ
+            # （期間の境目で実行とエラーの日がずれた場合に100%を超えないようにする）
+            "error_rate": min(1.0, errors / analyses) if analyses else 0.0,
+            "login_failed": counts.get("login_failed", 0),
+            "by_action": counts,
+        }
+
+    def daily_analysis_counts(self, start_date=None, end_date=None, username=None):
+        """ユーザー別・日別の分析実行数（[{"day", "username", "count"}, ...]）"""
+        where, params = _build_filter(start_date, end_date, username, "analysis_executed")
+        sql = (
+            "SELECT substr(timestamp, 1, 10) AS day, username, COUNT(*) AS count FROM access_log"
+            f" WHERE {' AND '.join(where)}"
+            " GROUP BY day, username ORDER BY day, username"
+        )
+        with self._reader() as conn:
+            if conn is None:
+                return []
+            return [dict(row) for row in conn.execute(sql, params).fetchall()]
+
+
+def _build_filter(start_date, end_date, username, action):
+    """WHERE句の条件とパラメータ（timestampは範囲条件にしてインデックスを使う）"""
+    where, params = [], []
+    if start_date is not None:
+        where.append("timestamp >= ?")
+        params.append(_day_string(start_date))
+    if end_date is not None:
+        where.append("timestamp < ?")
+        params.append(_day_string(end_date + timedelta(days=1)))
+    if username is not None:
+        where.append("username = ?")
+        params.append(username)
+    if action is not None:
+        where.append("action = ?")
+        params.append(action)
+    return where, params
+
+
+def _day_string(value):
+    if isinstance(value, datetime):
+        value = value.date()
+    if isinstance(value, date):
+        return value.strftime("%Y-%m-%d")
+    return str(value)
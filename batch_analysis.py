@@ -0,0 +1,403 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+競合分析のバッチ実行（CSV入力 → レポート出力）
+
+Streamlit画面と同じプロンプト（analysis_prompt）で、CSVの各行を分析する。
+中断しても出力済みの行はスキップして再開できる。
+
+使い方:
+    python batch_analysis.py competitors.csv --output-dir batch_output --workers 4 --rpm 20
+    python batch_analysis.py competitors.csv --rate-limit-db cache/rate_limits.db   # アプリとレート制限の枠を共有
+    python batch_analysis.py competitors.csv --use-batches-api          # Message Batches API（Claudeのみ・低コスト）
+    python batch_analysis.py competitors.csv --base-url http://127.0.0.1:8765   # スタブLLMサーバーで検証
+
+CSVの列:
+    competitor_name, our_product（必須）
+    competitor_genre, competitor_platform, our_genre, our_platform,
+    analysis_type, comparison_focus,
+    competitor_revenue, competitor_dau, our_revenue_target, our_dau_target, additional_context
+    ※ platform / comparison_focus は「;」区切り（例: iOS;Android）
+"""
+
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+
+from analysis_prompt import (
+    CLAUDE_PROVIDER,
+    OPENAI_PROVIDER,
+    build_request,
+    extract_cache_usage,
+    select_model,
+)
+from llm_client import LLMClientPool
+from market_index import DEFAULT_INDEX_DIR, MarketIndex, retrieve_reference
+from rate_limiter import DEFAULT_LIMITS, RateLimit, RateLimiter, estimate_request_tokens
+from result_cache import make_cache_key
+
+# 入力フォームの初期値と同じデフォルト
+DEFAULT_INPUTS = {
+    "competitor_name": "",
+    "competitor_genre": "RPG",
+    "competitor_platform": ["iOS", "Android"],
+    "competitor_revenue": "",
+    "competitor_dau": "",
+    "our_product": "",
+    "our_genre": "RPG",
+    "our_platform": ["iOS", "Android"],
+    "our_revenue_target": "",
+    "our_dau_target": "",
+    "analysis_type": "包括的分析",
+    "comparison_focus": ["市場規模・シェア", "収益モデル"],
+    "additional_context": "",
+}
+
+LIST_FIELDS = ("competitor_platform", "our_platform", "comparison_focus")
+
+PROVIDERS = {"claude": CLAUDE_PROVIDER, "openai": OPENAI_PROVIDER}
+
+# Message Batches API のポーリング間隔（秒）
+BATCH_POLL_INTERVAL = 30
+
+
+def load_rows(csv_path: str) -> list:
+    """
+    CSVを読み込み、行ごとの分析入力値を返す
+
+    Returns:
+        [(行番号, 入力値の辞書), ...]（必須列が空の行は警告してスキップ）
+    """
+    rows = []
+    with open(csv_path, "r", encoding="utf-8-sig", newline="") as f:
+        for row_number, row in enumerate(csv.DictReader(f), start=1):
+            inputs = {}
+            for key, default in DEFAULT_INPUTS.items():
+                value = (row.get(key) or "").strip()
+                if key in LIST_FIELDS:
+                    inputs[key] = [v.strip() for v in value.split(";") if v.strip()] if value else list(default)
+                else:
+                    inputs[key] = value or default
+
+            if not inputs["competitor_name"] or not inputs["our_product"]:
+                print(f"  ⚠️  Row {row_number}: competitor_name / our_product が空のためスキップ")
+                continue
+            rows.append((row_number, inputs))
+    return rows
+
+
+def build_limiter(provider, rpm=None, tpm=None, state_path=None):
+    """
+    バッチ用のレート制限（アプリと同じ rate_limiter.RateLimiter）
+
+    rpm・tpm を指定するとProviderの既定値を上書きする（0なら制限しない）。state_path にアプリの
+    RATE_LIMIT_STATE_DB と同じファイルを指定すると、画面からの分析と枠を共有する。
+    """
+    default = DEFAULT_LIMITS.get(provider) or RateLimit()
+    limit = RateLimit(
+        default.rpm if rpm is None else (rpm or None),
+        default.tpm if tpm is None else (tpm or None),
+    )
+    return RateLimiter({**DEFAULT_LIMITS, provider: limit}, state_path=state_path)
+
+
+def run_analysis(pool, provider: str, api_key: str, request_kwargs: dict) -> tuple:
+    """
+    1件分の分析を実行（共通LLMクライアントで再試行・期限付き）
+
+    Returns:
+        (分析結果, usage)
+    """
+    model = request_kwargs["model"]
+    tokens = estimate_request_tokens(request_kwargs)
+    if provider == CLAUDE_PROVIDER:
+        message = pool.call(provider, model, api_key, lambda client: client.messages.create(**request_kwargs),
+                            tokens=tokens)
+        return message.content[0].text, extract_cache_usage(message.usage)
+    response = pool.call(provider, model, api_key, lambda client: client.chat.completions.create(**request_kwargs),
+                         tokens=tokens)
+    return response.choices[0].message.content, extract_cache_usage(response.usage)
+
+
+# ============================================
+# 出力（1行 = reports/<キー>.md + .json）
+# ============================================
+
+def report_paths(output_dir: str, row_key: str) -> tuple:
+    base = os.path.join(output_dir, "reports", row_key)
+    return f"{base}.md", f"{base}.json"
+
+
+def is_done(output_dir: str, row_key: str) -> bool:
+    """分析済み（成功）の行か"""
+    _, json_path = report_paths(output_dir, row_key)
+    try:
+        with open(json_path, "r", encoding="utf-8") as f:
+            return json.load(f).get("status") == "succeeded"
+    except (OSError, ValueError):
+        return False
+
+
+def write_json_atomic(path: str, payload: dict):
+    """中断時に壊れたファイルを残さないよう一時ファイル経由で書き込み"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(payload, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+
+def write_report(output_dir: str, row_number: int, row_key: str, inputs: dict, provider: str,
+                 model: str, result: str = None, usage: dict = None, elapsed: float = 0.0, error: str = None):
+    """1行分のレポート（Markdown）と結果JSONを書き出す"""
+    md_path, json_path = report_paths(output_dir, row_key)
+
+    if result is not None:
+        with open(md_path, "w", encoding="utf-8") as f:
+            f.write(f"""# 競合分析レポート
+
+**分析日**: {datetime.now().strftime('%Y年%m月%d日')}
+**競合**: {inputs['competitor_name']}
+**自社**: {inputs['our_product']}
+**AI Provider**: {provider} ({model})
+
+---
+
+{result}
+""")
+
+    write_json_atomic(json_path, {
+        "row_number": row_number,
+        "row_key": row_key,
+        "status": "succeeded" if error is None else "errored",
+        "error": error,
+        "provider": provider,
+        "model": model,
+        "inputs": inputs,
+        "result": result,
+        "usage": usage or {},
+        "elapsed_seconds": round(elapsed, 2),
+        "finished_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+    })
+
+
+def write_summary(output_dir: str, rows: list, row_keys: dict):
+    """全行の状態をsummary.csv / summary.jsonにまとめる"""
+    summary = []
+    for row_number, inputs in rows:
+        row_key = row_keys[row_number]
+        md_path, json_path = report_paths(output_dir, row_key)
+        try:
+            with open(json_path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            entry = {"status": "pending"}
+
+        usage = entry.get("usage") or {}
+        summary.append({
+            "row_number": row_number,
+            "competitor_name": inputs["competitor_name"],
+            "our_product": inputs["our_product"],
+            "status": entry.get("status"),
+            "elapsed_seconds": entry.get("elapsed_seconds", ""),
+            "input_tokens": usage.get("input_tokens", ""),
+            "output_tokens": usage.get("output_tokens", ""),
+            "cache_read_input_tokens": usage.get("cache_read_input_tokens", ""),
+            "report": os.path.relpath(md_path, output_dir) if entry.get("status") == "succeeded" else "",
+            "error": entry.get("error") or "",
+        })
+
+    with open(os.path.join(output_dir, "summary.csv"), "w", encoding="utf-8-sig", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=list(summary[0].keys()) if summary else ["row_number"])
+        writer.writeheader()
+        writer.writerows(summary)
+    write_json_atomic(os.path.join(output_dir, "summary.json"), {"rows": summary})
+
+    succeeded = sum(1 for s in summary if s["status"] == "succeeded")
+    errored = sum(1 for s in summary if s["status"] == "errored")
+    print(f"\n{'='*60}")
+    print(f"✅ Succeeded: {succeeded} / ❌ Errored: {errored} / ⏳ Pending: {len(summary) - succeeded - errored}")
+    print(f"📁 Summary: {os.path.join(output_dir, 'summary.csv')}")
+    print("="*60)
+
+
+# ============================================
+# 実行モード
+# ============================================
+
+def run_with_workers(pool, provider, api_key, use_opus, pending, row_keys, references, output_dir, workers):
+    """ワーカープールで1行ずつ同期APIを呼び出す（レート制限は pool の limiter で待つ）"""
+    model, _ = select_model(provider, use_opus)
+
+    def work(row_number, inputs):
+        started = time.monotonic()
+        try:
+            request_kwargs = build_request(provider, inputs, use_opus, references[row_number])
+            result, usage = run_analysis(pool, provider, api_key, request_kwargs)
+        except Exception as e:
+            write_report(output_dir, row_number, row_keys[row_number], inputs, provider, model,
+                         elapsed=time.monotonic() - started, error=str(e))
+            return row_number, False, str(e)
+        write_report(output_dir, row_number, row_keys[row_number], inputs, provider, model,
+                     result, usage, time.monotonic() - started)
+        return row_number, True, f"{time.monotonic() - started:.1f}s"
+
+    executor = ThreadPoolExecutor(max_workers=max(1, workers))
+    try:
+        futures = [executor.submit(work, row_number, inputs) for row_number, inputs in pending]
+        for done_count, future in enumerate(as_completed(futures), start=1):
+            row_number, ok, detail = future.result()
+            mark = "✅" if ok else "❌"
+            print(f"  [{done_count}/{len(futures)}] {mark} Row {row_number}: {detail}")
+    except KeyboardInterrupt:
+        print("\n⚠️  中断しました。完了済みの行は次回スキップされます。")
+        executor.shutdown(wait=False, cancel_futures=True)
+        raise
+    executor.shutdown(wait=True)
+
+
+def run_with_batches_api(pool, api_key, use_opus, pending, row_keys, references, output_dir, poll_interval):
+    """
+    Anthropic Message Batches API で一括送信し、完了後に結果を書き出す
+
+    送信済みバッチIDは batch_state.json に保存し、中断後の再実行では再送信せずに結果を待つ。
+    """
+    provider = CLAUDE_PROVIDER
+    model, _ = select_model(provider, use_opus)
+    client = pool.client(provider, api_key)
+    state_path = os.path.join(output_dir, "batch_state.json")
+    inputs_by_key = {row_keys[row_number]: (row_number, inputs) for row_number, inputs in pending}
+
+    state = {}
+    if os.path.exists(state_path):
+        with open(state_path, "r", encoding="utf-8") as f:
+            state = json.load(f)
+
+    if state.get("batch_id"):
+        print(f"▶ 送信済みのバッチを再開: {state['batch_id']}")
+    else:
+        requests = [
+            {"custom_id": row_key, "params": build_request(provider, inputs, use_opus, references[row_number])}
+            for row_key, (row_number, inputs) in inputs_by_key.items()
+        ]
+        batch = pool.call(provider, model, api_key, lambda c: c.messages.batches.create(requests=requests))
+        state = {"batch_id": batch.id, "row_keys": list(inputs_by_key.keys()),
+                 "submitted_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
+        write_json_atomic(state_path, state)
+        print(f"▶ バッチを送信: {batch.id}（{len(requests)}件）")
+
+    started = time.monotonic()
+    while True:
+        batch = pool.call(provider, model, api_key, lambda c: c.messages.batches.retrieve(state["batch_id"]))
+        counts = batch.request_counts
+        print(f"  {batch.processing_status}: processing={counts.processing} succeeded={counts.succeeded} "
+              f"errored={counts.errored} ({time.monotonic() - started:.0f}s)")
+        if batch.processing_status == "ended":
+            break
+        time.sleep(poll_interval)
+
+    for entry in client.messages.batches.results(state["batch_id"]):
+        if entry.custom_id not in inputs_by_key:
+            continue
+        row_number, inputs = inputs_by_key[entry.custom_id]
+        if entry.result.type == "succeeded":
+            message = entry.result.message
+            write_report(output_dir, row_number, entry.custom_id, inputs, provider, model,
+                         message.content[0].text, extract_cache_usage(message.usage))
+        else:
+            write_report(output_dir, row_number, entry.custom_id, inputs, provider, model,
+                         error=f"batch result: {entry.result.type}")
+
+    os.remove(state_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="競合分析のバッチ実行（CSV入力 → レポート出力）")
+    parser.add_argument("csv_path", help="分析対象のCSVファイル")
+    parser.add_argument("--output-dir", default="batch_output", help="出力ディレクトリ")
+    parser.add_argument("--provider", choices=sorted(PROVIDERS), default="claude")
+    parser.add_argument("--opus", action="store_true", help="高精度モード（Opus 4）を使用")
+    parser.add_argument("--workers", type=int, default=4, help="同時実行数")
+    parser.add_argument("--rpm", type=float, default=None,
+                        help="1分あたりの最大リクエスト数（省略時はProviderの既定値、0で無制限）")
+    parser.add_argument("--tpm", type=float, default=None,
+                        help="1分あたりの最大トークン数（省略時はProviderの既定値、0で無制限）")
+    parser.add_argument("--rate-limit-db", default=None,
+                        help="レート制限の状態を共有するSQLiteファイル（アプリの RATE_LIMIT_STATE_DB と同じにすると枠を共有）")
+    parser.add_argument("--use-batches-api", action="store_true",
+                        help="Anthropic Message Batches APIで送信（非同期・低コスト）")
+    parser.add_argument("--poll-interval", type=float, default=BATCH_POLL_INTERVAL,
+                        help="Message Batchesの状態確認間隔（秒）")
+    parser.add_argument("--base-url", default=None, help="APIのベースURL（スタブLLMサーバー等）")
+    parser.add_argument("--api-key", default=None,
+                        help="APIキー（省略時は環境変数 ANTHROPIC_API_KEY / OPENAI_API_KEY）")
+    parser.add_argument("--index-dir", default=DEFAULT_INDEX_DIR,
+                        help="市場資料の検索インデックス（create_market_data_cache_final.py で構築）")
+    parser.add_argument("--top-k", type=int, default=8, help="プロンプトに含める市場資料の抜粋数")
+    parser.add_argument("--no-index", action="store_true", help="市場資料の検索インデックスを使わない")
+    parser.add_argument("--force", action="store_true", help="分析済みの行も再実行")
+    args = parser.parse_args()
+
+    provider = PROVIDERS[args.provider]
+    if args.use_batches_api and provider != CLAUDE_PROVIDER:
+        parser.error("--use-batches-api は --provider claude でのみ使用できます")
+
+    env_name = "ANTHROPIC_API_KEY" if provider == CLAUDE_PROVIDER else "OPENAI_API_KEY"
+    api_key = args.api_key or os.environ.get(env_name) or ("stub" if args.base_url else None)
+    if not api_key:
+        parser.error(f"APIキーがありません（--api-key または環境変数 {env_name}）")
+
+    print("="*60)
+    print("Competitive analysis batch run")
+    print("="*60)
+
+    rows = load_rows(args.csv_path)
+    model, _ = select_model(provider, args.opus)
+
+    # 行ごとに市場資料の関連抜粋を検索（インデックスがなければ参照データなし）
+    market_index = None if args.no_index else MarketIndex.load(args.index_dir)
+    references = {
+        row_number: retrieve_reference(market_index, inputs, args.top_k)[0]
+        for row_number, inputs in rows
+    }
+    if market_index is not None:
+        print(f"Market index: {len(market_index.passages):,} passages (top {args.top_k} per row)")
+
+    row_keys = {
+        row_number: make_cache_key(inputs, provider, model, references[row_number])[:16]
+        for row_number, inputs in rows
+    }
+
+    os.makedirs(os.path.join(args.output_dir, "reports"), exist_ok=True)
+    pending = [
+        (row_number, inputs) for row_number, inputs in rows
+        if args.force or not is_done(args.output_dir, row_keys[row_number])
+    ]
+    print(f"Rows: {len(rows)} / 分析済み: {len(rows) - len(pending)} / 未処理: {len(pending)}")
+    print(f"Provider: {provider} ({model})")
+
+    if pending:
+        pool = LLMClientPool(
+            base_urls={provider: args.base_url},
+            limiter=build_limiter(provider, args.rpm, args.tpm, args.rate_limit_db)
+        )
+        try:
+            if args.use_batches_api:
+                run_with_batches_api(pool, api_key, args.opus, pending, row_keys, references, args.output_dir,
+                                     args.poll_interval)
+            else:
+                run_with_workers(pool, provider, api_key, args.opus, pending, row_keys, references, args.output_dir,
+                                 args.workers)
+        except KeyboardInterrupt:
+            write_summary(args.output_dir, rows, row_keys)
+            sys.exit(130)
+
+    write_summary(args.output_dir, rows, row_keys)
+
+
+if __name__ == "__main__":
+    main()
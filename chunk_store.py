@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+"""
+市場資料のチャンクストア（メモリマップ・内容アドレス）
+
+パッセージ本文をUTF-8のまま1つのバイナリ（chunks.bin）に連結し、
+各チャンクのSHA-256・オフセット・長さを固定長のテーブル（chunks_index.npy）に持つ。
+同じ内容のチャンクは1回だけ保存する。
+
+読み取り側はファイルを mmap して必要なチャンクだけをスライスするため、
+複数のStreamlitプロセスがOSのページキャッシュ上の1つのコピーを共有できる
+（プロセスごとに全文の文字列を持たない）。
+
+保存形式（store_dir 配下）:
+    chunks.bin              チャンク本文（UTF-8）の連結
+    chunks_index.npy        [(digest, offset, length), ...]（チャンクID = 行番号）
+    chunks_by_digest.npy    [(digest, チャンクID), ...] をdigest順に並べたもの（内容ハッシュからの検索用）
+"""
+
+import hashlib
+import mmap
+import os
+
+import numpy as np
+
+DIGEST_SIZE = 32
+INDEX_DTYPE = np.dtype([("digest", f"S{DIGEST_SIZE}"), ("offset", "<u8"), ("length", "<u4")])
+ORDER_DTYPE = np.dtype([("digest", f"S{DIGEST_SIZE}"), ("chunk", "<i8")])
+
+BLOB_FILE = "chunks.bin"
+INDEX_FILE = "chunks_index.npy"
+ORDER_FILE = "chunks_by_digest.npy"
+
+
+def chunk_digest(data):
+    """チャンクの内容アドレス（SHA-256）"""
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    return hashlib.sha256(data).digest()
+
+
+class ChunkStoreWriter:
+    """
+    チャンクストアの書き込み（構築時のみ使用）
+
+    with ChunkStoreWriter(store_dir) as writer:
+        chunk_id = writer.add("本文")
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        os.makedirs(store_dir, exist_ok=True)
+        self._blob_path = os.path.join(store_dir, BLOB_FILE)
+        self._blob = open(f"{self._blob_path}.tmp", "wb")
+        self._entries = []
+        self._ids = {}
+        self._offset = 0
+        self.added = 0
+        self.stats = None
+
+    def add(self, text):
+        """チャンクを追加してチャンクIDを返す（同じ内容なら既存のID）"""
+        data = text.encode("utf-8")
+        digest = chunk_digest(data)
+        self.added += 1
+        chunk_id = self._ids.get(digest)
+        if chunk_id is not None:
+            return chunk_id
+
+        chunk_id = len(self._entries)
+        self._blob.write(data)
+        self._entries.append((digest, self._offset, len(data)))
+        self._ids[digest] = chunk_id
+        self._offset += len(data)
+        return chunk_id
+
+    def close(self):
+        """ファイルを確定（本文→テーブルの順に置き換え、途中の状態を読ませない）"""
+        self._blob.close()
+        table = np.array(self._entries, dtype=INDEX_DTYPE)
+        order = np.empty(len(table), dtype=ORDER_DTYPE)
+        sorted_ids = np.argsort(table["digest"], kind="stable")
+        order["digest"] = table["digest"][sorted_ids]
+        order["chunk"] = sorted_ids
+
+        os.replace(f"{self._blob_path}.tmp", self._blob_path)
+        for name, array in ((ORDER_FILE, order), (INDEX_FILE, table)):
+            path = os.path.join(self.store_dir, name)
+            with open(f"{path}.tmp", "wb") as f:
+                np.save(f, array)
+            os.replace(f"{path}.tmp", path)
+        self.stats = {"chunks": len(self._entries), "added": self.added, "bytes": self._offset}
+        return self.stats
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self._blob.close()
+            os.remove(f"{self._blob_path}.tmp")
+
+
+class ChunkStore:
+    """チャンクストアの読み取り（mmap、プロセス間でページキャッシュを共有）"""
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self._table = np.load(os.path.join(store_dir, INDEX_FILE), mmap_mode="r")
+        self._order = np.load(os.path.join(store_dir, ORDER_FILE), mmap_mode="r")
+        with open(os.path.join(store_dir, BLOB_FILE), "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            # 空のファイルは mmap できない
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else None
+        self._view = memoryview(self._mmap) if self._mmap is not None else memoryview(b"")
+
+    def __len__(self):
+        return len(self._table)
+
+    @property
+    def nbytes(self):
+        return len(self._view)
+
+    def get_bytes(self, chunk_id):
+        """チャンク本文のバイト列（mmap上のビュー、コピーしない）"""
+        entry = self._table[chunk_id]
+        offset = int(entry["offset"])
+        return self._view[offset:offset + int(entry["length"])]
+
+    def text(self, chunk_id):
+        """チャンク本文（この時点で1チャンク分だけ文字列にデコード）"""
+        return str(self.get_bytes(chunk_id), "utf-8")
+
+    def digest(self, chunk_id):
+        # numpyの固定長バイト列は末尾のNULを落とすので補う
+        return bytes(self._table[chunk_id]["digest"]).ljust(DIGEST_SIZE, b"\0").hex()
+
+    def find(self, digest):
+        """内容ハッシュ（16進文字列またはbytes）からチャンクIDを検索（なければNone）"""
+        if isinstance(digest, str):
+            digest = bytes.fromhex(digest)
+        key = np.array([digest], dtype=ORDER_DTYPE["digest"])
+        digests = self._order["digest"]
+        position = int(np.searchsorted(digests, key)[0])
+        if position < len(digests) and digests[position] == key[0]:
+            return int(self._order[position]["chunk"])
+        return None
+
+    def close(self):
+        self._view.release()
+        if self._mmap is not None:
+            self._mmap.close()
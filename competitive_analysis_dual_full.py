@@ -1,14 +1,61 @@
 # -*- coding: utf-8 -*-
 import streamlit as st
-from openai import OpenAI
-import anthropic
-from datetime import datetime
-import pandas as pd
-import plotly.graph_objects as go
-import json
+from datetime import datetime, timedelta
+import functools
 import hmac
-import os
-import csv
+import time
+from analysis_jobs import (
+    JOB_CANCELLED,
+    JOB_DONE,
+    JOB_ERROR,
+    JOB_QUEUED,
+    JOB_RUNNING,
+    AnalysisJobQueue,
+    JobCancelledError,
+)
+from analysis_prompt import (
+    LIGHT_MODELS,
+    MARKET_DATA,
+    build_request,
+    extract_cache_usage,
+    select_model,
+)
+from audit_log import LOG_COLUMNS, AuditLog
+from llm_client import LLMClientPool, sdk_module_name, stream_claude, stream_openai
+from lazy_imports import import_report, lazy_module, preload
+from llm_hedge import HedgeCandidate, HedgedRequest
+from profiling import (
+    SpanExporter,
+    Trace,
+    current_depth,
+    current_trace,
+    profile_capture,
+    profiler_engines,
+    span,
+    tracing,
+)
+from rate_limiter import RateLimiter, RateLimitWaitCancelled, estimate_request_tokens, load_limits, notify_waits
+from report_parser import SECTION_NAMES, ReportParser, parse_report
+from report_digest import (
+    DIGEST_MODELS,
+    DigestCache,
+    DigestCancelledError,
+    ReportDigester,
+    format_digest,
+    make_llm_summarizer,
+)
+from result_cache import ResultCache, make_cache_key
+from section_fanout import SECTION_SPECS, generate_sections
+from structured_metrics import fetch_metrics
+from telemetry import MetricsStore, summarize
+
+# 重いモジュール（pandas・plotly・numpyを使う検索インデックス・PDF抽出）は最初の使用時に読み込む
+# （ログイン画面では読み込まない。読み込み時間は管理者メニューの起動時間レポートで確認できる）
+pd = lazy_module("pandas")
+# plotlyは sys.modules の pandas をそのまま参照するため、先読みスレッドが読み込み中なら完了を待ってから使う
+go = lazy_module("plotly.graph_objects", requires=("pandas",))
+market_index_lib = lazy_module("market_index")
+upload_ingest_lib = lazy_module("upload_ingest")
 
 # ページ設定
 st.set_page_config(
@@ -21,51 +68,52 @@ st.set_page_config(
 # セキュリティ機能: アクセスログ記録
 # ============================================
 
-def ensure_log_directory():
-    """ログディレクトリの作成"""
-    log_dir = "logs"
-    if not os.path.exists(log_dir):
-        os.makedirs(log_dir)
-    return log_dir
+@st.cache_resource
+def get_audit_log():
+    """アクセスログストア（SQLite・バックグラウンド書き込み、プロセス内で共有）"""
+    return AuditLog("logs/access_log.db", legacy_csv_path="logs/access_log.csv")
 
 def log_access(username, action, details=""):
-    """アクセスログの記録"""
+    """アクセスログの記録（キューに積むだけでディスクI/Oは待たない）"""
     try:
-        log_dir = ensure_log_directory()
-        log_file = os.path.join(log_dir, "access_log.csv")
-        
-        log_entry = {
-            "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-            "username": username,
-            "display_name": st.session_state.get("user_display_name", username),
-            "action": action,
-            "details": details
-        }
-        
-        file_exists = os.path.isfile(log_file)
-        
-        with open(log_file, "a", newline="", encoding="utf-8") as f:
-            writer = csv.DictWriter(f, fieldnames=["timestamp", "username", "display_name", "action", "details"])
-            if not file_exists:
-                writer.writeheader()
-            writer.writerow(log_entry)
-            
+        get_audit_log().log(
+            username,
+            action,
+            details,
+            display_name=st.session_state.get("user_display_name", username)
+        )
     except Exception as e:
         print(f"ログ記録エラー: {e}")
 
-def get_access_logs():
-    """アクセスログの取得"""
-    log_file = os.path.join("logs", "access_log.csv")
-    
-    if os.path.exists(log_file):
-        try:
-            df = pd.read_csv(log_file)
-            return df
-        except Exception as e:
-            st.error(f"ログファイルの読み込みに失敗しました: {e}")
-            return None
-    else:
-        return None
+@st.cache_resource
+def get_metrics_store():
+    """分析ごとの利用量・所要時間の記録（SQLite、プロセス内で共有）"""
+    return MetricsStore("logs/metrics.db")
+
+@st.cache_resource
+def get_span_exporter():
+    """段階ごとの処理時間（スパン）の JSON Lines 出力（日をまたいだ集計用）"""
+    return SpanExporter("logs/spans.jsonl")
+
+@st.cache_data(ttl=60, show_spinner=False)
+def get_metrics_summary(start_date, end_date):
+    """管理画面の利用状況の集計（短時間キャッシュ）"""
+    return summarize(get_metrics_store().query(start_date, end_date))
+
+@st.cache_data(ttl=300, show_spinner=False)
+def get_log_filter_options(column):
+    """管理画面の絞り込み候補（ユーザー・アクション一覧）"""
+    return get_audit_log().distinct_values(column)
+
+@st.cache_data(ttl=60, show_spinner=False)
+def get_log_summary(start_date, end_date, username):
+    """管理画面の件数サマリー（短時間キャッシュ）"""
+    return get_audit_log().summary(start_date, end_date, username)
+
+@st.cache_data(ttl=60, show_spinner=False)
+def get_daily_analysis_counts(start_date, end_date, username):
+    """管理画面のユーザー別・日別分析数（短時間キャッシュ）"""
+    return get_audit_log().daily_analysis_counts(start_date, end_date, username)
 
 # ============================================
 # セキュリティ機能: ベーシック認証
@@ -135,6 +183,45 @@ def check_password():
 if not check_password():
     st.stop()
 
+# ============================================
+# 再実行の計測（入力フォーム・フラグメント化の効果確認用）
+# ============================================
+
+# Streamlitは操作のたびにスクリプト全体を再実行する。入力欄はフォームにまとめて送信時だけ、
+# 結果表示・アクセスログはフラグメントにしてその領域だけを再実行し、回数と時間をセッションに記録する。
+RERUN_STATS_KEY = "rerun_stats"
+FULL_RUN_SCOPE = "アプリ全体"
+
+APP_RUN_STARTED = time.perf_counter()
+st.session_state["in_full_run"] = True
+
+def record_run(scope, started):
+    """実行回数と所要時間をセッションに記録"""
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    stats = st.session_state.setdefault(RERUN_STATS_KEY, {})
+    entry = stats.setdefault(scope, {"runs": 0, "total_ms": 0.0, "last_ms": 0.0})
+    entry["runs"] += 1
+    entry["total_ms"] += elapsed_ms
+    entry["last_ms"] = elapsed_ms
+
+def timed_fragment(scope, run_every=None):
+    """
+    st.fragment（この領域の操作ではこの関数だけを再実行）に計測を加えるデコレーター
+
+    アプリ全体の実行に含まれる分は数えず、フラグメント単独の再実行だけを scope に記録する。
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                if not st.session_state.get("in_full_run"):
+                    record_run(scope, started)
+        return st.fragment(wrapper, run_every=run_every)
+    return decorator
+
 # ============================================
 # ログイン後のメインアプリケーション
 # ============================================
@@ -215,6 +302,60 @@ with col_user:
 
 st.markdown("---")
 
+@st.cache_resource
+def get_result_cache():
+    """プロセス内で共有する分析結果キャッシュ"""
+    return ResultCache()
+
+@st.cache_resource
+def get_market_index():
+    """市場資料の検索インデックス（create_market_data_cache_final.py で構築、未構築ならNone）"""
+    return market_index_lib.MarketIndex.load()
+
+@st.cache_resource
+def get_upload_ingestor():
+    """アップロードPDFの取り込み（バックグラウンド抽出・SHA-256で重複排除）"""
+    return upload_ingest_lib.UploadIngestor()
+
+@st.cache_resource
+def get_digest_cache():
+    """大きな資料の要約ダイジェスト（ファイルのSHA-256ごとに保存）"""
+    return DigestCache()
+
+@st.cache_resource
+def get_rate_limiter():
+    """
+    全セッションで共有するレート制限（RPM・TPM）
+    
+    上限はSecretsの rate_limits（未設定ならProviderごとの既定値）。RATE_LIMIT_STATE_DB を設定すると
+    同じファイルを使う複数プロセス（複数のStreamlitサーバー）間で枠を共有する。
+    """
+    limits = load_limits(st.secrets["rate_limits"] if "rate_limits" in st.secrets else None)
+    state_path = st.secrets["RATE_LIMIT_STATE_DB"] if "RATE_LIMIT_STATE_DB" in st.secrets else None
+    return RateLimiter(limits, state_path=state_path)
+
+@st.cache_resource
+def get_llm_pool():
+    """プロセス内で共有するLLMクライアント（keep-alive・再試行・サーキットブレーカー・レート制限）"""
+    return LLMClientPool(limiter=get_rate_limiter())
+
+@st.cache_resource
+def get_analysis_queue():
+    """分析ジョブのワーカープール（同時実行数はSecretsの ANALYSIS_WORKERS、未設定なら4）"""
+    workers = int(st.secrets["ANALYSIS_WORKERS"]) if "ANALYSIS_WORKERS" in st.secrets else 4
+    return AnalysisJobQueue(max_workers=workers)
+
+# 表示中のジョブID（セッションとURLの ?job= に保持）と進捗のポーリング間隔（秒）
+ACTIVE_JOB_KEY = "active_analysis_job"
+JOB_POLL_INTERVAL = 1.0
+JOB_STATE_LABELS = {
+    JOB_QUEUED: "実行待ち",
+    JOB_RUNNING: "実行中",
+    JOB_DONE: "完了",
+    JOB_ERROR: "エラー",
+    JOB_CANCELLED: "中止",
+}
+
 # サイドバー
 with st.sidebar:
     st.header("■ 設定")
@@ -225,6 +366,8 @@ with st.sidebar:
         ["Claude (Anthropic)", "OpenAI (GPT)"],
         help="使用するAIモデルを選択してください"
     )
+    # 選択中のProviderのSDKだけを、入力中にバックグラウンドで読み込んでおく
+    preload(sdk_module_name(api_provider))
     
     # Claude専用: モデル選択
     claude_model_mode = "sonnet"  # デフォルト
@@ -245,6 +388,51 @@ with st.sidebar:
         else:
             st.info("⚡ **Sonnet 4**: 標準的な分析を高速で提供")
     
+    # ストリーミング表示（生成されたセクションから順に表示）
+    st.markdown("---")
+    use_streaming = st.toggle(
+        "⚡ ストリーミング表示",
+        value=True,
+        help="生成されたセクションから順に表示します（合計コストは変わりません）"
+    )
+    
+    # セクション並列生成（セクションごとに同時リクエスト）
+    use_parallel = st.toggle(
+        "🧩 セクション並列生成",
+        value=False,
+        help="各セクションを別リクエストで同時に生成し、待ち時間を短縮します"
+    )
+    parallel_concurrency = 4
+    if use_parallel:
+        parallel_concurrency = st.slider(
+            "同時リクエスト数",
+            min_value=1,
+            max_value=len(SECTION_SPECS),
+            value=4,
+            help="APIのレート制限に応じて調整してください"
+        )
+    
+    # 結果キャッシュ（同一条件の分析はAPIを呼ばずに表示）
+    result_cache = get_result_cache()
+    force_refresh = st.checkbox(
+        "🔄 キャッシュを使わず再分析",
+        value=False,
+        help="同じ条件の分析結果が保存されていても、APIを呼び出して新しく分析します"
+    )
+    
+    # スコア（レーダーチャート）の取得方法
+    always_structured_metrics = st.toggle(
+        "📐 スコアは常に構造化出力で取得",
+        value=False,
+        help="オフの場合は本文のJSONを使い、欠けている・壊れているときだけスコアを小さな別呼び出し"
+             "（Claude: tool use / OpenAI: JSON schema）で取り直します。オンの場合は常に別呼び出しで取得します"
+    )
+    cache_stats = result_cache.stats()
+    st.caption(
+        f"結果キャッシュ: ヒット {cache_stats['hits']}回 / ミス {cache_stats['misses']}回"
+        f"（ヒット率 {cache_stats['hit_rate']:.0%}）"
+    )
+    
     # API Key取得（Secretsから自動取得）
     if api_provider == "Claude (Anthropic)":
         if "ANTHROPIC_API_KEY" in st.secrets:
@@ -271,6 +459,34 @@ with st.sidebar:
             api_key = None
             vector_store_id = None
     
+    # ヘッジ実行（もう一方のProviderを予備として使う）
+    secondary_provider = "OpenAI (GPT)" if api_provider == "Claude (Anthropic)" else "Claude (Anthropic)"
+    secondary_key_name = "OPENAI_API_KEY" if secondary_provider == "OpenAI (GPT)" else "ANTHROPIC_API_KEY"
+    secondary_api_key = st.secrets[secondary_key_name] if secondary_key_name in st.secrets else None
+    use_hedging = False
+    hedge_after = 8.0
+    if secondary_api_key:
+        use_hedging = st.toggle(
+            "🏁 ヘッジ実行（速い方を採用）",
+            value=False,
+            help=f"最初の応答が遅い場合に{secondary_provider}にも同時に送信し、先に応答した方を採用します（セクション並列生成時は無効）"
+        )
+        if use_hedging:
+            hedge_after = st.number_input(
+                "ヘッジ開始までの待ち時間（秒）",
+                min_value=1.0,
+                max_value=60.0,
+                value=8.0,
+                step=0.5,
+                help="最初のトークンがこの秒数内に届かなければ予備Providerに送信します（通常時の応答開始時間のp95が目安）"
+            )
+    
+    # レート制限の混雑状況（今実行した場合に枠が空くまでの待ち時間の見込み）
+    sidebar_model = select_model(api_provider, api_provider == "Claude (Anthropic)" and "高精度" in claude_model_mode)[0]
+    expected_rate_wait = get_rate_limiter().expected_wait(api_provider, sidebar_model)
+    if expected_rate_wait >= 1.0:
+        st.warning(f"🚦 {sidebar_model} は混雑しています（APIのレート制限により開始まで約{expected_rate_wait:.0f}秒待ちます）")
+    
     st.markdown("---")
     st.header("■ データソース")
     
@@ -280,6 +496,51 @@ with st.sidebar:
         help="ファミ通白書などのPDFファイル"
     )
     
+    # アップロードPDFの取り込み（抽出はバックグラウンド、同じファイルは1回だけ処理）
+    upload_digest = None
+    use_upload_digest = False
+    if uploaded_file is not None:
+        upload_ingestor = get_upload_ingestor()
+        upload_session_key = f"upload_digest_{uploaded_file.file_id}"
+        upload_digest = st.session_state.get(upload_session_key)
+        if upload_digest is None or upload_ingestor.status(upload_digest)["state"] == "missing":
+            upload_digest = upload_ingestor.submit(uploaded_file, uploaded_file.name)
+            st.session_state[upload_session_key] = upload_digest
+        
+        upload_status = upload_ingestor.status(upload_digest)
+        if upload_status["state"] == upload_ingest_lib.STATUS_READY:
+            st.success(f"✓ {upload_status['file_name']}: {upload_status['pages']}ページ"
+                       f"（{upload_status['passages']:,}件の抜粋）を参照します")
+            use_upload_digest = st.checkbox(
+                "📝 資料全体の要約ダイジェストも参照",
+                value=False,
+                help="資料全体を安価なモデルで分割要約（map-reduce）し、事実のダイジェストを分析に含めます。"
+                     "初回のみ数分かかり、結果は同じファイルで再利用されます"
+            )
+        elif upload_status["state"] == upload_ingest_lib.STATUS_EXTRACTING:
+            pages_done = upload_status.get("pages_done", 0)
+            pages_total = upload_status.get("pages_total", 0)
+            st.progress(
+                pages_done / pages_total if pages_total else 0.0,
+                text=f"テキスト抽出中... {pages_done}/{pages_total or '?'}ページ"
+            )
+            st.button("▶ 抽出状況を更新", key="refresh_upload_status")
+        elif upload_status["state"] == upload_ingest_lib.STATUS_ERROR:
+            st.error(f"× PDFの読み込みに失敗しました: {upload_status.get('error', '')}")
+    
+    market_index = get_market_index()
+    use_market_index = False
+    market_index_top_k = 8
+    if market_index is not None:
+        use_market_index = st.toggle(
+            "📚 市場資料から関連箇所を参照",
+            value=True,
+            help="白書などの市場資料から、競合タイトル名・ジャンル・比較観点に関連する抜粋だけをプロンプトに含めます"
+        )
+        if use_market_index:
+            market_index_top_k = st.slider("参照する抜粋数", min_value=3, max_value=20, value=8)
+        st.caption(f"検索インデックス: {len(market_index.passages):,}件の抜粋（{market_index.built_at} 構築）")
+    
     st.markdown("### ▶ 組み込みデータ")
     st.markdown("""
     - 国内モバイルゲーム市場: 約1.3兆円
@@ -295,819 +556,1273 @@ with st.sidebar:
     3. インタラクティブなグラフで確認
     """)
     
+    # 分析ジョブ（別の画面から戻ったとき・再読み込みした後もここから結果を受け取れる）
+    user_jobs = get_analysis_queue().jobs_for(st.session_state.get("username", "unknown"))
+    if user_jobs:
+        st.markdown("---")
+        with st.expander(f"🗂 分析ジョブ（{len(user_jobs)}件）"):
+            queue_stats = get_analysis_queue().stats()
+            st.caption(f"全体: 実行中 {queue_stats['running']}件・待機中 {queue_stats['queued']}件"
+                       f"（同時実行 {queue_stats['workers']}件まで）・実行中の同じ分析への相乗り {queue_stats['attached']}件")
+            for listed_job in user_jobs[:10]:
+                col_job_label, col_job_open = st.columns([3, 1])
+                with col_job_label:
+                    st.caption(f"{listed_job.label}・{JOB_STATE_LABELS[listed_job.state]}・"
+                               f"{datetime.fromtimestamp(listed_job.created_at).strftime('%m/%d %H:%M')}")
+                with col_job_open:
+                    if listed_job.state != JOB_CANCELLED and st.button("表示", key=f"open_job_{listed_job.id}"):
+                        st.session_state[ACTIVE_JOB_KEY] = listed_job.id
+    
     # 管理者用: アクセスログ表示
     if st.session_state.get("username") == "admin":
         st.markdown("---")
         st.markdown("### 🔐 管理者機能")
         if st.button("アクセスログを表示"):
             st.session_state["show_logs"] = True
+        if st.button("利用状況を表示"):
+            st.session_state["show_usage"] = True
+        
+        with st.expander("⏱ 起動時間レポート"):
+            st.caption("このプロセスで遅延インポートしたモジュールと読み込み時間（ログイン画面では読み込まないもの）")
+            import_records = import_report()
+            if import_records:
+                st.markdown("| モジュール | 読み込み時間 | 起動からの経過 | 契機 |\n|---|---:|---:|---|\n" + "\n".join(
+                    f"| {record['module']} | {record['ms']:,.0f} ms | {record['at_ms'] / 1000:,.1f} 秒 | {record['trigger']} |"
+                    for record in import_records
+                ))
+            else:
+                st.caption("まだ読み込んだモジュールはありません")
+        
+        with st.expander("🚦 レート制限"):
+            st.caption("全セッションで共有するAPIの枠（1分あたりの上限と現在の残り）")
+            rate_rows = get_rate_limiter().status()
+            if rate_rows:
+                rate_lines = []
+                for row in rate_rows:
+                    rpm_text = "-" if row["rpm"] is None else f"{max(row['requests_available'], 0):,.0f} / {row['rpm']:,}"
+                    tpm_text = "-" if row["tpm"] is None else f"{max(row['tokens_available'], 0):,.0f} / {row['tpm']:,}"
+                    wait_text = "-"
+                    if row["last_wait"] is not None:
+                        waited_at, waited = row["last_wait"]
+                        wait_text = f"{waited:.0f}秒（{datetime.fromtimestamp(waited_at).strftime('%H:%M:%S')}）"
+                    rate_lines.append(f"| {row['provider']} / {row['model']} | {rpm_text} | {tpm_text} | {wait_text} |")
+                st.markdown("| Provider / モデル | RPM 残り | TPM 残り | 直近の待ち |\n|---|---:|---:|---|\n" + "\n".join(rate_lines))
+            else:
+                st.caption("まだAPIを呼び出していません")
+        
+        with st.expander("🔬 プロファイル"):
+            st.caption("分析ジョブの処理を関数単位で記録し、logs/profiles/ に出力します（結果の「処理時間の内訳」に上位の関数を表示）")
+            st.toggle("分析をプロファイルする", value=False, key="profile_analysis",
+                      help="計測の分だけ分析が遅くなります。プロファイル中は同じ条件の分析にも相乗りしません")
+            st.selectbox("プロファイラ", profiler_engines(), key="profile_engine",
+                         help="cProfile は .prof（snakeviz等で閲覧）、pyinstrument はインストール時のみ .html を出力")
+
+# メイン入力フォーム（入力中は再実行せず、分析実行ボタンで送信したときだけ再実行する）
+with st.form("analysis_form", border=False):
+    st.subheader("■ 基本情報入力")
+
+    col1, col2 = st.columns(2)
+
+    with col1:
+        st.markdown("#### ▶ 競合タイトル情報")
+        competitor_name = st.text_input(
+            "競合タイトル名 *",
+            placeholder="例: モンスターストライク",
+        )
+        
+        competitor_genre = st.selectbox(
+            "ジャンル",
+            ["RPG", "アクション", "パズル", "シミュレーション", "スポーツ", 
+             "レーシング", "アドベンチャー", "カードゲーム", "その他"]
+        )
+        
+        competitor_platform = st.multiselect(
+            "プラットフォーム",
+            ["iOS", "Android", "PlayStation", "Nintendo Switch", "Xbox", "Steam/PC"],
+            default=["iOS", "Android"]
+        )
 
-# メイン入力フォーム
-st.subheader("■ 基本情報入力")
-
-col1, col2 = st.columns(2)
-
-with col1:
-    st.markdown("#### ▶ 競合タイトル情報")
-    competitor_name = st.text_input(
-        "競合タイトル名 *",
-        placeholder="例: モンスターストライク",
-    )
-    
-    competitor_genre = st.selectbox(
-        "ジャンル",
-        ["RPG", "アクション", "パズル", "シミュレーション", "スポーツ", 
-         "レーシング", "アドベンチャー", "カードゲーム", "その他"]
-    )
-    
-    competitor_platform = st.multiselect(
-        "プラットフォーム",
-        ["iOS", "Android", "PlayStation", "Nintendo Switch", "Xbox", "Steam/PC"],
-        default=["iOS", "Android"]
-    )
+    with col2:
+        st.markdown("#### ▶ 自社タイトル情報")
+        our_product = st.text_input(
+            "自社タイトル名 *",
+            placeholder="例: [プロジェクト名]",
+        )
+        
+        our_genre = st.selectbox(
+            "自社ジャンル",
+            ["RPG", "アクション", "パズル", "シミュレーション", "スポーツ", 
+             "レーシング", "アドベンチャー", "カードゲーム", "その他"],
+            key="our_genre"
+        )
+        
+        our_platform = st.multiselect(
+            "自社プラットフォーム",
+            ["iOS", "Android", "PlayStation", "Nintendo Switch", "Xbox", "Steam/PC"],
+            default=["iOS", "Android"],
+            key="our_platform"
+        )
 
-with col2:
-    st.markdown("#### ▶ 自社タイトル情報")
-    our_product = st.text_input(
-        "自社タイトル名 *",
-        placeholder="例: [プロジェクト名]",
-    )
-    
-    our_genre = st.selectbox(
-        "自社ジャンル",
-        ["RPG", "アクション", "パズル", "シミュレーション", "スポーツ", 
-         "レーシング", "アドベンチャー", "カードゲーム", "その他"],
-        key="our_genre"
-    )
-    
-    our_platform = st.multiselect(
-        "自社プラットフォーム",
-        ["iOS", "Android", "PlayStation", "Nintendo Switch", "Xbox", "Steam/PC"],
-        default=["iOS", "Android"],
-        key="our_platform"
-    )
+    st.markdown("---")
+    st.subheader("■ 分析設定")
 
-st.markdown("---")
-st.subheader("■ 分析設定")
+    col3, col4 = st.columns(2)
 
-col3, col4 = st.columns(2)
+    with col3:
+        analysis_type = st.radio(
+            "分析タイプ",
+            ["包括的分析", "マーケティング特化", "マネタイゼーション特化"],
+        )
 
-with col3:
-    analysis_type = st.radio(
-        "分析タイプ",
-        ["包括的分析", "マーケティング特化", "マネタイゼーション特化"],
-    )
+    with col4:
+        comparison_focus = st.multiselect(
+            "比較観点",
+            ["市場規模・シェア", "収益モデル", "ユーザー獲得戦略", 
+             "ゲーム設計・機能", "運営手法", "IP・コラボ戦略"],
+            default=["市場規模・シェア", "収益モデル"]
+        )
 
-with col4:
-    comparison_focus = st.multiselect(
-        "比較観点",
-        ["市場規模・シェア", "収益モデル", "ユーザー獲得戦略", 
-         "ゲーム設計・機能", "運営手法", "IP・コラボ戦略"],
-        default=["市場規模・シェア", "収益モデル"]
-    )
+    # 詳細情報
+    st.markdown("---")
+    st.subheader("■ 詳細情報")
 
-# 詳細情報
-st.markdown("---")
-st.subheader("■ 詳細情報")
+    col_add1, col_add2 = st.columns(2)
 
-col_add1, col_add2 = st.columns(2)
+    with col_add1:
+        st.markdown("#### ▶ 競合タイトルの既知情報")
+        competitor_revenue = st.text_input(
+            "既知の年間売上（任意）",
+            placeholder="例: 200億円",
+            help="既知の売上データがあれば入力してください"
+        )
+        competitor_dau = st.text_input(
+            "既知のDAU/MAU（任意）",
+            placeholder="例: 50万人/200万人"
+        )
 
-with col_add1:
-    st.markdown("#### ▶ 競合タイトルの既知情報")
-    competitor_revenue = st.text_input(
-        "既知の年間売上（任意）",
-        placeholder="例: 200億円",
-        help="既知の売上データがあれば入力してください"
-    )
-    competitor_dau = st.text_input(
-        "既知のDAU/MAU（任意）",
-        placeholder="例: 50万人/200万人"
-    )
+    with col_add2:
+        st.markdown("#### ▶ 自社タイトルの目標数値")
+        our_revenue_target = st.text_input(
+            "売上目標（任意）",
+            placeholder="例: 100億円"
+        )
+        our_dau_target = st.text_input(
+            "DAU/MAU目標（任意）",
+            placeholder="例: 30万人/100万人"
+        )
 
-with col_add2:
-    st.markdown("#### ▶ 自社タイトルの目標数値")
-    our_revenue_target = st.text_input(
-        "売上目標（任意）",
-        placeholder="例: 100億円"
-    )
-    our_dau_target = st.text_input(
-        "DAU/MAU目標（任意）",
-        placeholder="例: 30万人/100万人"
+    additional_context = st.text_area(
+        "特記事項・既知の情報",
+        height=100,
+        placeholder="例: 競合の月間売上50億円、主要ターゲット20-30代男性 など"
     )
+    
+    # 分析実行ボタン
+    st.markdown("---")
+    run_analysis = st.form_submit_button("▶ 競合分析を実行", type="primary", use_container_width=True)
 
-additional_context = st.text_area(
-    "特記事項・既知の情報",
-    height=100,
-    placeholder="例: 競合の月間売上50億円、主要ターゲット20-30代男性 など"
-)
 
-# 参照データの処理
-reference_data = ""
-if uploaded_file is not None:
-    st.info("▶ アップロードされたPDFを参照データとして使用します")
-    reference_data = "\n【アップロードされた市場データ】\n市場レポートの内容を参照中..."
-
-# 組み込み市場データ
-MARKET_DATA = """
-【2024年度 国内ゲーム市場データ】
-■ 総市場規模
-- モバイルゲーム: 約1.3兆円
-- 家庭用ゲーム: 約0.4兆円
-- PCゲーム: 約0.2兆円
-
-■ ジャンル別シェア（モバイル）
-- RPG: 28%
-- パズル: 15%
-- アクション: 12%
-- カードゲーム: 10%
-- その他: 35%
-
-■ 主要タイトル推定年間売上（2024年）
-1. モンスターストライク: 約500億円
-2. パズル&ドラゴンズ: 約300億円
-3. Fate/Grand Order: 約400億円
-4. プロジェクトセカイ: 約250億円
-5. ウマ娘 プリティーダービー: 約600億円
-
-■ プラットフォーム比率
-- iOS: 55%
-- Android: 45%
-
-■ ユーザー獲得単価（CPI）
-- RPG: 800-1,500円
-- パズル: 300-600円
-- アクション: 500-1,000円
-"""
+# ============================================
+# ストリーミング表示
+# ============================================
 
-# 分析実行ボタン
-st.markdown("---")
-if st.button("▶ 競合分析を実行", type="primary", use_container_width=True):
-    if not api_key:
-        st.error("● API Keyが設定されていません。管理者にStreamlit SecretsでANTHROPIC_API_KEYを設定するよう連絡してください。")
-    elif not competitor_name or not our_product:
-        st.error("● 競合タイトル名と自社タイトル名を入力してください")
-    else:
-        # アクセスログ記録
-        log_access(
-            st.session_state.get("username", "unknown"),
-            "analysis_executed",
-            f"競合:{competitor_name} vs 自社:{our_product}"
-        )
+def render_stream_sections(parser):
+    """完成済みセクションをBOX表示し、生成中のセクションは途中経過を表示"""
+    finished_count = parser.completed_count
+    for index, (title, content) in enumerate(parser.snapshot()):
+        in_progress = index >= finished_count
         
-        with st.spinner(f"{api_provider}で分析中... (60-90秒)"):
-            try:
-                # モデルモード判定
-                use_opus = "高精度" in claude_model_mode if api_provider == "Claude (Anthropic)" else False
-                
-                # プロンプト構築
-                prompt_intro = ""
-                if use_opus:
-                    # Opus 4用: Few-Shot Examples追加
-                    prompt_intro = """
-**【出力形式の重要な注意】**
-すべてのセクションは必ずMarkdown表形式で出力してください。
-
-【正しい出力例】
-| 項目 | FGO | モンスターストライク |
-|------|-----|-------------------|
-| 推定年間売上 | 950億円 | 800億円（目標） |
-| 市場ランキング | TOP 3 | TOP 10（目標） |
-
-【誤った出力例（禁止）】
-FGOの推定年間売上は950億円です。
-モンスターストライクの目標は800億円です。
-
-→ このようなテキスト形式は絶対禁止です！
-
----
-
-"""
-                
-                prompt = f"""
-あなたはゲーム業界の競合分析専門家です。以下の市場データと情報を基に詳細な分析を実施してください。
-
-{prompt_intro}
-{MARKET_DATA}
-
-{reference_data}
+        if title == "EXECUTIVE_SUMMARY":
+            st.markdown(f"""
+            <div style="padding: 20px; border-radius: 10px; background-color: #1e3a5f; margin: 20px 0; border: 2px solid #4a90e2; color: white;">
+                <h3 style="color: #4a90e2; margin-top: 0;">■ エグゼクティブサマリー</h3>
+                <p style="color: white; line-height: 1.6;">{content}</p>
+            </div>
+            """, unsafe_allow_html=True)
+        elif title == "COMPARISON_METRICS":
+            # JSONはレーダーチャートとして完了後に表示
+            st.caption("■ COMPARISON_METRICS: " + ("スコアデータ受信中..." if in_progress else "受信完了（分析完了後にレーダーチャートを表示）"))
+        else:
+            st.markdown(f"""
+            <div style="padding: 15px; border-radius: 8px; background-color: #2d2d2d; margin: 15px 0; border-left: 4px solid #4a90e2;">
+                <h3 style="color: #4a90e2; margin-top: 0;">■ {title}{" ⏳" if in_progress else ""}</h3>
+            </div>
+            """, unsafe_allow_html=True)
+            st.markdown(content)
 
-【分析対象】
-■ 競合タイトル
-- タイトル名: {competitor_name}
-- ジャンル: {competitor_genre}
-- プラットフォーム: {', '.join(competitor_platform)}
-{f"- 既知の年間売上: {competitor_revenue}" if competitor_revenue else ""}
-{f"- 既知のDAU/MAU: {competitor_dau}" if competitor_dau else ""}
+# ============================================
+# Prompt Caching: キャッシュ使用状況の表示
+# ============================================
 
-■ 自社タイトル
-- タイトル名: {our_product}
-- ジャンル: {our_genre}
-- プラットフォーム: {', '.join(our_platform)}
-{f"- 売上目標: {our_revenue_target}" if our_revenue_target else ""}
-{f"- DAU/MAU目標: {our_dau_target}" if our_dau_target else ""}
+def render_cache_usage(usage):
+    """リクエストごとのトークン数とキャッシュ作成/読み取りを表示"""
+    if not usage:
+        return
+    
+    cache_read = usage["cache_read_input_tokens"]
+    cache_creation = usage["cache_creation_input_tokens"]
+    
+    if cache_read:
+        st.info(f"✅ キャッシュヒット！（{cache_read:,} tokens読み取り、入力コスト削減）")
+    elif cache_creation:
+        st.info(f"🔄 キャッシュ作成（{cache_creation:,} tokens、次回から読み取り）")
+    
+    st.caption(
+        f"入力: {usage['input_tokens']:,} tokens / 出力: {usage['output_tokens']:,} tokens / "
+        f"キャッシュ作成: {cache_creation:,} tokens / キャッシュ読み取り: {cache_read:,} tokens"
+    )
 
-【分析タイプ】: {analysis_type}
-【比較観点】: {', '.join(comparison_focus)}
+# ============================================
+# 分析結果の保持と表示用データのメモ化
+# ============================================
 
-【特記事項】
-{additional_context if additional_context else "特になし"}
+# 分析結果はセッションに保持し、ダウンロードボタンやサイドバーの操作で再実行されても再表示する
+# （APIは呼ばない）。レーダーチャート・比較表・エクスポート内容は結果ごとにメモ化する。
+ANALYSIS_RESULT_KEY = "analysis_result"
+
+def save_analysis_result(analysis_id, report, competitor_name, our_product, provider, analyzed_at, details=None):
+    """表示中の分析結果をセッションに保存（analysis_id は結果キャッシュのキー、details は参照抜粋・通知等）"""
+    st.session_state[ANALYSIS_RESULT_KEY] = {
+        "id": analysis_id,
+        "result": report.raw,
+        "metrics": report.metrics,
+        "metrics_error": report.metrics_error,
+        "competitor_name": competitor_name,
+        "our_product": our_product,
+        "provider": provider,
+        "analyzed_at": analyzed_at,
+        "details": details,
+    }
 
-**【重要】既知の情報がある場合は、必ずその数値を優先して使用してください。推測が必要な場合は『推測』と明記してください。**
+def restore_analysis_report(saved):
+    """セッションに保存した分析結果を構造化し直す（スコアは構造化出力で取り直した値を使う）"""
+    report = parse_report(saved["result"])
+    report.metrics, report.metrics_error = saved["metrics"], saved["metrics_error"]
+    return report
+
+def render_trace_waterfall(job_trace, render_trace, profile=None):
+    """管理者用: 分析ジョブと結果表示の段階ごとの処理時間（ウォーターフォール）とプロファイル結果"""
+    traces = [trace for trace in (job_trace, render_trace) if trace is not None and trace.records()]
+    if not traces:
+        return
+    with st.expander("⏱ 処理時間の内訳（" + "・".join(f"{trace.name} {trace.duration_ms / 1000:,.1f}秒" for trace in traces) + "）"):
+        for trace in traces:
+            records = trace.records()
+            labels = [f"{'　' * record['depth']}{record['span']}" for record in records]
+            fig = go.Figure(go.Bar(
+                base=[record["start_ms"] for record in records],
+                x=[record["duration_ms"] for record in records],
+                y=labels,
+                orientation="h",
+                text=[f"{record['duration_ms']:,.0f} ms" for record in records],
+                textposition="auto",
+                marker_color=["#4a90e2" if record["depth"] == 0 else "#9bbfe8" for record in records],
+            ))
+            fig.update_layout(
+                title=f"{trace.name}（{trace.duration_ms:,.0f} ms）",
+                xaxis_title="開始からの経過 (ms)",
+                yaxis=dict(autorange="reversed"),
+                height=120 + 28 * len(records),
+                margin=dict(l=10, r=10, t=40, b=10),
+                showlegend=False
+            )
+            st.plotly_chart(fig, use_container_width=True)
+        if profile and profile.get("path"):
+            st.caption(f"プロファイル: {profile['path']}（分析ジョブのスレッドのみ）")
+            st.code(profile["summary"], language=None)
+
+@st.cache_resource(max_entries=32, show_spinner=False)
+def build_radar_figure(metric_rows, competitor_name, our_product):
+    """レーダーチャート（同じスコア・タイトル名なら同じFigureを再利用、描画側では変更しない）"""
+    categories = [label for label, _, _ in metric_rows]
+    fig = go.Figure()
+    
+    # 競合データ
+    fig.add_trace(go.Scatterpolar(
+        r=[competitor for _, competitor, _ in metric_rows],
+        theta=categories,
+        fill='toself',
+        name=competitor_name,
+        line=dict(color='#FF6B6B', width=2)
+    ))
+    
+    # 自社データ
+    fig.add_trace(go.Scatterpolar(
+        r=[ours for _, _, ours in metric_rows],
+        theta=categories,
+        fill='toself',
+        name=our_product,
+        line=dict(color='#4ECDC4', width=2)
+    ))
+    
+    fig.update_layout(
+        polar=dict(
+            radialaxis=dict(
+                visible=True,
+                range=[0, 100],
+                tickfont=dict(size=12)
+            )
+        ),
+        showlegend=True,
+        title={
+            'text': "■ 競合比較レーダーチャート（100点満点）",
+            'x': 0.5,
+            'xanchor': 'center'
+        },
+        height=500,
+        font=dict(size=14)
+    )
+    return fig
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def build_comparison_table(metric_rows, competitor_name, our_product):
+    """詳細スコア比較の表"""
+    return pd.DataFrame({
+        '評価項目': [label for label, _, _ in metric_rows],
+        competitor_name: [competitor for _, competitor, _ in metric_rows],
+        our_product: [ours for _, _, ours in metric_rows],
+        '差分': [competitor - ours for _, competitor, ours in metric_rows]
+    })
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def build_export_payloads(result, competitor_name, our_product, analyzed_at):
+    """ダウンロード用のテキスト・Markdown（ファイル名・日付は分析日時で固定）"""
+    analyzed = datetime.fromtimestamp(analyzed_at)
+    file_stem = f"{competitor_name}_analysis_{analyzed.strftime('%Y%m%d')}"
+    md_content = f"""# 競合分析レポート
+
+**分析日**: {analyzed.strftime('%Y年%m月%d日')}
+**競合**: {competitor_name}
+**自社**: {our_product}
 
 ---
 
-**【重要指示】以下を必ず守ってください:**
-1. COMPARISON_METRICSは必ずJSON形式（```json ... ```）で出力
-2. 全てのセクションで必ず表形式（Markdownテーブル）を使用
-3. 箇条書き（-や•）は使用禁止
-4. セクション名（MARKET_ANALYSIS、COMPETITOR_ANALYSIS等）を単独行で出力しない（必ず## セクション名の形式）
-5. **既知の数値情報がある場合は必ずその値を使用し、『（市場データ参照）』または『（既知情報）』と明記**
-6. **推測値の場合は必ず『（推定）』と明記し、根拠を示す**
-7. **データが不明な場合は『データなし』と記載し、無理に推測しない**
-8. **すべての数値・評価に対して、可能な限り出典・根拠を併記する**
-9. **買い切りゲームとライブサービスで指標を適切に使い分ける**
-10. **楽観的すぎる予測を避け、現実的なリスクも明示する**
-
-以下の形式で回答してください。**必ず数値データを引用**してください:
-
-## EXECUTIVE_SUMMARY
-*3-5行で結論と最重要ポイント簡潔に記載*
-
-## COMPARISON_METRICS
-
-**評価軸の定義**（100点満点）:
-- **market_position（市場ポジション）**: 市場での認知度・ランキング順位・ブランド力
-- **revenue_potential（収益性）**: 年間売上規模・ARPU・課金効率・収益安定性
-  * ライブサービス: 継続課金・イベント収益・長期ARPU
-  * 買い切り: 初回売上・DLC収益・周辺商品展開
-- **user_base（ユーザー基盤）**: DAU/MAU・ユーザー定着率・コミュニティ活性度
-- **brand_strength（ブランド力）**: IP価値・メディア露出・ファンロイヤリティ・二次展開力
-- **technology（技術力）**: グラフィック品質・システム安定性・技術革新性・開発体制の強さ
-
-**必ず以下の正確なJSON形式で出力**（評価の根拠は表の後に記載）:
-```json
-{{
-  "competitor": {{
-    "market_position": 85,
-    "revenue_potential": 75,
-    "user_base": 80,
-    "brand_strength": 90,
-    "technology": 70
-  }},
-  "our_product": {{
-    "market_position": 40,
-    "revenue_potential": 60,
-    "user_base": 30,
-    "brand_strength": 45,
-    "technology": 75
-  }}
-}}
-```
-
-**各評価の根拠**（必ず具体的な要素を列挙）:
-
-| 評価軸 | 競合スコア | 根拠となる具体的要素 | 自社スコア | 根拠となる具体的要素 |
-|-------|----------|-------------------|----------|-------------------|
-| 市場ポジション | XX点 | • [要素1: 例：国内売上TOP3]<br>• [要素2: 例：Google検索トレンド高位]<br>• [要素3: 例：SNS言及数多数] | XX点 | • [要素1]<br>• [要素2]<br>• [要素3] |
-| 収益性 | XX点 | • [要素1: 例：年間売上600億円]<br>• [要素2: 例：ARPU 8,000円/月]<br>• [要素3: 例：課金ユーザー率15%] | XX点 | • [要素1]<br>• [要素2]<br>• [要素3] |
-| ユーザー基盤 | XX点 | • [要素1: 例：DAU 200万人]<br>• [要素2: 例：継続率70%]<br>• [要素3: 例：コミュニティ活発] | XX点 | • [要素1]<br>• [要素2]<br>• [要素3] |
-| ブランド力 | XX点 | • [要素1: 例：IP知名度90%]<br>• [要素2: 例：コラボ実績多数]<br>• [要素3: 例：メディア露出高] | XX点 | • [要素1]<br>• [要素2]<br>• [要素3] |
-| 技術力 | XX点 | • [要素1: 例：グラフィック品質高]<br>• [要素2: 例：サーバー安定性99.9%]<br>• [要素3: 例：技術的革新性] | XX点 | • [要素1]<br>• [要素2]<br>• [要素3] |
-
-**重要**: 各評価軸について、スコアを構成する具体的要素を最低3つ挙げること。抽象的な表現ではなく、数値・事実に基づく要素を記載。
-
-
-## MARKET_ANALYSIS
-### 市場規模とトレンド
-
-**必ず以下の表形式で出力（箇条書き禁止）**:
-**既知の売上データがある場合は必ずその値を使用し、『（既知情報）』と明記してください**
-
-| 項目 | {competitor_name} | {our_product} |
-|------|-------------------|---------------|
-| 推定年間売上 | XXX億円（既知情報 or 市場データ参照 or 推定） | XXX億円（目標 or 推定） |
-| 市場ランキング | TOP XX（[期間]・[範囲]） | TOP XX（[期間]・[範囲]・目標） |
-
-*ランキング定義例: 「月間・国内モバイル全体」「年間・ジャンル内」「週間・iOS売上」など具体的に明記*
-
-| DAU/MAU | XX万人/XX万人（既知 or 推定） | XX万人/XX万人（目標） |
-| 主要ターゲット層 | XX代XX性 | XX代XX性 |
-| 市場シェア | X.X%（既知 or 推定） | X.X%（目標） |
-
-*既知の情報を最優先し、推測の場合は必ず根拠を付記*
-**重要**: 買い切りゲームの場合、DAU/MAUは販売本数・アクティブプレイヤー数など適切な指標に置き換えること
-（例: 「累計販売XX万本」「月間アクティブプレイヤーXX万人」など）
-
-### ジャンル特性
-
-**必ず以下の表形式で出力（箇条書き禁止）**:
-
-| 特性項目 | {competitor_name} | {our_product} |
-|----------|-------------------|---------------|
-| ジャンル適合度 | 高/中/低 + 理由 | 高/中/低 + 理由 |
-| 差別化ポイント | 具体的特徴 | 具体的特徴 |
-| CPI（ユーザー獲得単価） | XXX円（[出典]） | XXX円（推定・目標） |
-| 主要収益モデル | [ガチャ/サブスク等] | [想定モデル] |
-
-*CPI出典例: 「業界平均」「類似タイトル実績」「マーケティングレポート」など具体的に明記*
-*データがない場合は「推測・根拠不足」と明記すること*
-
-## COMPETITOR_ANALYSIS
-
-### ビジネスモデル比較
-
-| 項目 | {competitor_name} | {our_product} |
-|------|-------------------|---------------|
-| 収益化手法 | [具体的手法] | [想定手法] |
-| 課金設計 | [ガチャ/サブスク等] | [想定設計] |
-| 平均課金単価 | [推定金額] | [目標金額] |
-| 収益の柱 | [メイン収益源] | [想定収益源] |
-
-### 強み・弱み比較
-
-**必ず以下の表形式で出力（箇条書き禁止）**:
-
-| 評価軸 | {competitor_name} | {our_product} |
-|--------|-------------------|---------------|
-| **強み1** | [具体的な強み] | [具体的な強み] |
-| **強み2** | [具体的な強み] | [具体的な強み] |
-| **強み3** | [具体的な強み] | [具体的な強み] |
-| **弱み1** | [具体的な弱み] | [具体的な弱み] |
-| **弱み2** | [具体的な弱み] | [具体的な弱み] |
-| **弱み3** | [具体的な弱み] | [具体的な弱み] |
-
-## GAP_ANALYSIS
-
-### 主要ギャップ分析
-
-| 評価項目 | 現状のギャップ | 重要度 | 対応優先度 |
-|----------|---------------|--------|-----------|
-| 市場認知度 | {competitor_name}が[X]点優位 | 高/中/低 | 高/中/低 |
-| 収益性 | {competitor_name}が[X]点優位 | 高/中/低 | 高/中/低 |
-| ユーザー基盤 | {competitor_name}が[X]点優位 | 高/中/低 | 高/中/低 |
-| 技術力 | {our_product}が[X]点優位 | 高/中/低 | 高/中/低 |
-| ブランド力 | {competitor_name}が[X]点優位 | 高/中/低 | 高/中/低 |
-
-### 差別化戦略
-
-**必ず以下の表形式で出力（{our_product}の差別化ポイントを{competitor_name}と比較）**:
-
-| 差別化要素 | {competitor_name}のアプローチ | {our_product}の差別化ポイント | 実現可能性 |
-|-----------|----------------------------|----------------------------|----------|
-| [要素1] | [競合の現状] | [自社の差別化内容] | 高/中/低 |
-| [要素2] | [競合の現状] | [自社の差別化内容] | 高/中/低 |
-| [要素3] | [競合の現状] | [自社の差別化内容] | 高/中/低 |
-
-## ACTION_PLAN ({our_product}向け)
-
-**{our_product}の具体的アクションプラン**
-
-### 短期施策（3ヶ月以内）
-
-**対象タイトル: {our_product}**
-
-**必ず以下の表形式で出力**:
-
-| No | 施策 | 目的 | 実行内容 | 期待効果 | 優先度 |
-|----|------|------|---------|---------|--------|
-| 1 | [施策名] | [目的] | [具体的内容] | [効果・KPI] | 高/中/低 |
-| 2 | [施策名] | [目的] | [具体的内容] | [効果・KPI] | 高/中/低 |
-| 3 | [施策名] | [目的] | [具体的内容] | [効果・KPI] | 高/中/低 |
-
-### 中期施策（6-12ヶ月）
-
-**対象タイトル: {our_product}**
-
-**必ず以下の表形式で出力**:
-
-| No | 戦略 | 目標 | 実行計画 | マイルストーン | KPI |
-|----|------|------|---------|--------------|-----|
-| 1 | [戦略名] | [目標数値] | [計画概要] | [達成時期] | [測定指標] |
-| 2 | [戦略名] | [目標数値] | [計画概要] | [達成時期] | [測定指標] |
-
-## RISK_OPPORTUNITY ({our_product}向け)
-
-**{our_product}のリスクと市場機会分析**
-
-### リスク分析
-
-**対象タイトル: {our_product}**
-
-| リスク項目 | 内容 | 発生確率 | 影響度 | 対策 |
-|-----------|------|---------|--------|------|
-| [リスク1] | [具体的内容] | 高/中/低 | 高/中/低 | [対策] |
-| [リスク2] | [具体的内容] | 高/中/低 | 高/中/低 | [対策] |
-| [リスク3] | [具体的内容] | 高/中/低 | 高/中/低 | [対策] |
-
-### 市場機会
-
-**対象タイトル: {our_product}**
-
-| 機会項目 | 内容 | 実現可能性 | 期待効果 | アプローチ |
-|---------|------|-----------|---------|-----------|
-| [機会1] | [具体的内容] | 高/中/低 | [効果] | [方法] |
-| [機会2] | [具体的内容] | 高/中/低 | [効果] | [方法] |
-| [機会3] | [具体的内容] | 高/中/低 | [効果] | [方法] |
-
-**実現可能性の評価基準**:
-- **高**: 自社の現有リソース・技術で即座に実行可能。競合優位性あり。成功事例多数。
-- **中**: 追加投資・時間が必要だが実現可能。競合も狙える領域。リスクあり。
-- **低**: 大規模投資・技術革新が必要。高リスク。他社も成功例少ない。
-
-*楽観的すぎる評価は避け、現実的なリスク・障壁も併記すること*
-
-## DATA_SOURCES
-
-**必ず以下の形式で具体的な出典を明記**:
-
-### 使用したデータソース
-
-| データ項目 | 出典 | 詳細（ページ/URL） | 信頼性 |
-|----------|------|------------------|--------|
-| 市場規模 | [レポート名] | [ページ番号 or URL] | 高/中/低 |
-| 売上推定 | [情報源] | [ページ番号 or URL] | 高/中/低 |
-| DAU/MAU | [情報源] | [ページ番号 or URL] | 高/中/低 |
-| CPI | [情報源] | [ページ番号 or URL] | 高/中/低 |
+{result}
+"""
+    return {
+        "text": (result, f"{file_stem}.txt"),
+        "markdown": (md_content, f"{file_stem}.md"),
+    }
 
-**記載例**:
-- PDFデータの場合: 「ファミ通ゲーム白書2025 p.45-47」
-- Webデータの場合: 「https://example.com/market-report」
-- 組み込みデータの場合: 「2024年度国内ゲーム市場データ（提供データ）」
-- 推測の場合: 「業界一般知識に基づく推測」
+# ============================================
+# 分析結果の表示
+# ============================================
 
-**データの信頼性について**:
-- **高**: 公式発表、大手市場調査会社レポート、政府統計
-- **中**: 業界推定、アナリストレポート、メディア報道
-- **低**: 推測、一般的な業界知識、根拠不十分
+@timed_fragment("結果表示")
+def render_analysis_result(report, competitor_name, our_product, analyzed_at):
+    """分析結果（APIレスポンス・キャッシュ・保存済み共通、parse_report で構造化済み）を視覚化して表示"""
+    result = report.raw
+    
+    # 結果を視覚化
+    st.markdown("## ■ 分析結果")
+    
+    # エグゼクティブサマリー（ダークモード対応）
+    if report.section("EXECUTIVE_SUMMARY") is not None:
+        summary_text = report.summary
+        
+        st.markdown(f"""
+        <div style="padding: 20px; border-radius: 10px; background-color: #1e3a5f; margin: 20px 0; border: 2px solid #4a90e2; color: white;">
+            <h3 style="color: #4a90e2; margin-top: 0;">■ エグゼクティブサマリー</h3>
+            <p style="color: white; line-height: 1.6;">{summary_text}</p>
+        </div>
+        """, unsafe_allow_html=True)
+    
+    # スコアからレーダーチャート作成
+    if report.metrics:
+        metric_rows = tuple(report.metric_rows())
+        
+        with span("レーダーチャート作成"):
+            radar_figure = build_radar_figure(metric_rows, competitor_name, our_product)
+        with span("レーダーチャート表示"):
+            st.plotly_chart(radar_figure, use_container_width=True)
+        
+        # 比較テーブル
+        st.markdown("### ■ 詳細スコア比較")
+        
+        with span("スコア比較表の作成"):
+            comparison_df = build_comparison_table(metric_rows, competitor_name, our_product)
+        
+        # 差分に色をつける（ダークモード対応）
+        def highlight_diff(val):
+            if isinstance(val, (int, float)):
+                if val > 0:
+                    return 'background-color: #8B0000; color: white'
+                elif val < 0:
+                    return 'background-color: #006400; color: white'
+            return ''
+        
+        with span("スコア比較表の表示"):
+            styled_df = comparison_df.style.applymap(highlight_diff, subset=['差分'])
+            st.dataframe(styled_df, use_container_width=True, height=250)
+        
+        # 各評価の根拠を表示
+        st.markdown("---")
+        st.markdown("### ■ 評価軸の定義")
+        
+        definition_text = """
+| 評価軸 | 定義 |
+|-------|------|
+| **市場ポジション** | 市場での認知度・ランキング順位・ブランド力 |
+| **収益性** | 年間売上規模・ARPU・課金効率・収益安定性<br>ライブサービス: 継続課金・イベント収益・長期ARPU<br>買い切り: 初回売上・DLC収益・周辺商品展開 |
+| **ユーザー基盤** | DAU/MAU・ユーザー定着率・コミュニティ活性度 |
+| **ブランド力** | IP価値・メディア露出・ファンロイヤリティ・二次展開力 |
+| **技術力** | グラフィック品質・システム安定性・技術革新性・開発体制の強さ |
+        """
+        st.markdown(definition_text)
+        
+        st.markdown("---")
+        st.markdown("### ■ 各スコアの評価根拠")
+        st.info("各評価項目のスコアがどのような要素で構成されているかを確認できます")
+        
+        if report.rationale:
+            st.markdown(report.rationale)
+        else:
+            st.warning("● 評価根拠の詳細が見つかりませんでした")
+    
+    elif report.metrics_error:
+        st.warning(f"● レーダーチャートの生成に失敗しました: {report.metrics_error}")
+    else:
+        st.warning("● レーダーチャート用のデータが見つかりませんでした")
+    
+    # 詳細分析結果
+    st.markdown("---")
+    tab1, tab2, tab3 = st.tabs(["■ 詳細分析", "■ エクスポート", "■ 市場データ"])
+    
+    with tab1, span("詳細セクション表示"):
+        # セクションごとにBOX化（サマリー・スコアは上に表示済み）
+        for section in report.detail_sections():
+            st.markdown(f"""
+            <div style="padding: 15px; border-radius: 8px; background-color: #2d2d2d; margin: 15px 0; border-left: 4px solid #4a90e2;">
+                <h3 style="color: #4a90e2; margin-top: 0;">■ {section.title}</h3>
+                <div style="color: #e0e0e0;">
+            """, unsafe_allow_html=True)
+            
+            st.markdown(section.body)
+            
+            st.markdown("</div></div>", unsafe_allow_html=True)
+        if report.preamble:
+            st.markdown(report.preamble)
+    
+    with tab2:
+        col_exp1, col_exp2 = st.columns(2)
+        with span("エクスポートの作成"):
+            exports = build_export_payloads(result, competitor_name, our_product, analyzed_at)
+        
+        with col_exp1:
+            text_data, text_file_name = exports["text"]
+            st.download_button(
+                label="▶ テキスト形式",
+                data=text_data,
+                file_name=text_file_name,
+                mime="text/plain",
+                on_click="ignore",
+                use_container_width=True
+            )
+        
+        with col_exp2:
+            md_data, md_file_name = exports["markdown"]
+            st.download_button(
+                label="▶ Markdown形式",
+                data=md_data,
+                file_name=md_file_name,
+                mime="text/markdown",
+                on_click="ignore",
+                use_container_width=True
+            )
+    
+    with tab3:
+        st.markdown("### ■ 参照した市場データ")
+        
+        # DATA_SOURCESセクションを表示
+        sources_section = report.section("DATA_SOURCES")
+        if sources_section is not None and sources_section.body:
+            st.markdown("""
+            <div style="padding: 15px; border-radius: 8px; background-color: #1e3a5f; margin: 15px 0; border: 2px solid #4a90e2;">
+                <h4 style="color: #4a90e2; margin-top: 0;">📚 今回の分析で使用したデータソース</h4>
+            </div>
+            """, unsafe_allow_html=True)
+            
+            st.markdown(sources_section.body)
+            
+            st.markdown("---")
+        
+        st.markdown("### ■ 組み込み市場データ（参考）")
+        st.markdown("""
+        <div style="padding: 15px; border-radius: 8px; background-color: #1a1a1a; border: 1px solid #4a90e2;">
+        """, unsafe_allow_html=True)
+        
+        st.code(MARKET_DATA, language="text")
+        
+        st.markdown("</div>", unsafe_allow_html=True)
 
-**データが不足している項目**:
-[該当する項目を明記し、推測であることを明示]
+# ============================================
+# 分析ジョブ（ワーカープールで実行し、画面は状態を取得して表示）
+# ============================================
 
-**重要**: すべてのデータについて、可能な限り具体的な出典を記載すること。ページ番号やURLがある場合は必ず含めること。
-"""
-                
-                # ===== Claude を使うパターン =====
-                if api_provider == "Claude (Anthropic)":
-                    client = anthropic.Anthropic(api_key=api_key)
-                    
-                    # モデルとtemperatureを選択
-                    use_opus = "高精度" in claude_model_mode
-                    selected_model = "claude-opus-4-20250514" if use_opus else "claude-sonnet-4-20250514"
-                    selected_temperature = 0.1 if use_opus else 0.7
-                    
-                    # Opus 4使用時の通知
-                    if use_opus:
-                        st.info(f"🚀 {selected_model}（Opus 4）で分析を実行中...")
-                    
-                    # システムプロンプト（Opus 4使用時のみ）
-                    system_prompt = None
-                    if use_opus:
-                        system_prompt = """あなたはゲーム業界の競合分析専門家です。
-
-【絶対に守るべきルール】
-1. すべての情報は必ずMarkdown表形式で出力すること
-2. 表の形式: | 項目 | 値1 | 値2 | のように必ず縦棒(|)で区切ること
-3. 箇条書き（-や•）は絶対に使用禁止
-4. テキストのみの羅列は禁止
-5. 自社タイトルのスコア・データも必ず記載すること（空欄禁止）
-6. 新規タイトルの場合は「目標XX」「計画XX」という形で記載
-
-このような表形式を必ず使用してください。テキストのみの出力は不可です。"""
+def consume_stream(job, chunks):
+    """ストリーミング応答をジョブに書き込みながら受信し、全文を返す（断片ごとに中止を確認）"""
+    trace, depth = current_trace(), current_depth()
+    started = time.perf_counter()
+    first_chunk_at = None
+    try:
+        for chunk in chunks:
+            if first_chunk_at is None:
+                first_chunk_at = time.perf_counter()
+            job.append_text(chunk)
+            job.check_cancelled()
+    finally:
+        close = getattr(chunks, "close", None)
+        if close is not None:
+            close()
+        # 送信から最初のトークンまで（レート制限の待ち・再試行を含む）と、受信し終わるまでを分けて記録
+        if trace is not None:
+            finished = time.perf_counter()
+            trace.add("API応答待ち（最初のトークンまで）", started, first_chunk_at or finished, depth)
+            if first_chunk_at is not None:
+                trace.add("生成（ストリーミング受信）", first_chunk_at, finished, depth)
+    return "".join(job.chunks)
+
+def run_analysis_job(job, params):
+    """
+    分析ジョブの本体（ワーカースレッドで実行するため st.* の描画は行わない）
+    
+    進捗・通知・ストリーミングの途中経過は job に書き込み、画面側がポーリングして表示する。
+    
+    Returns:
+        結果表示に必要な値の dict（collect_analysis_job で受け取る）
+    """
+    api_provider = params["provider"]
+    api_key = params["api_key"]
+    selected_model = params["model"]
+    analysis_inputs = params["inputs"]
+    llm_pool = params["llm_pool"]
+    result_cache = params["result_cache"]
+    use_opus = params["use_opus"]
+    
+    def on_rate_wait(provider, model, seconds):
+        job.set_progress(f"⏳ {model} のレート制限のため待機中（約{seconds:.0f}秒）...", job.progress)
+    
+    # 利用状況の記録（完了・エラー・中止のいずれでも分析1件につき1行）
+    telemetry = {
+        "job_id": job.id,
+        "kind": "analysis",
+        "username": params["username"],
+        "provider": api_provider,
+        "model": selected_model,
+        "temperature": params["temperature"],
+    }
+    
+    # 段階ごとの処理時間（管理者画面のウォーターフォール・JSON Lines出力）
+    job_trace = Trace("分析ジョブ", job_id=job.id, username=params["username"], provider=api_provider, model=selected_model)
+    
+    def record_telemetry(status, error=None):
+        params["telemetry"].record({
+            **telemetry,
+            "status": status,
+            "error": error,
+            "latency_ms": (time.time() - job.started_at) * 1000,
+        })
+        params["span_exporter"].export(job_trace, status=status)
+    
+    try:
+        # レート制限の待ちは進捗に表示し、中止されたら送信せずに枠を戻す
+        # （管理者がプロファイルを指定した場合は、このスレッドの処理を cProfile / pyinstrument で記録する）
+        with notify_waits(on_rate_wait, job.cancel_event), tracing(job_trace), \
+                profile_capture(params["profile_path"], params["profile_engine"]) as profile:
+            # 市場資料・アップロード資料から関連箇所を検索して参照データにする（資料全体はプロンプトに含めない）
+            reference_parts = []
+            references = []
+            for reference_label, reference_index, reference_title in params["reference_indexes"]:
+                with span(f"参照資料の検索（{reference_label}）"):
+                    retrieved_text, retrieved_hits, retrieval_ms = market_index_lib.retrieve_reference(
+                        reference_index, analysis_inputs, params["top_k"], reference_title
+                    )
+                if retrieved_text:
+                    reference_parts.append(retrieved_text)
+                    references.append((reference_label, retrieved_hits, retrieval_ms))
+            
+            # 資料全体の要約ダイジェスト（map-reduce、初回のみ作成）
+            digest_info = None
+            upload = params["upload"]
+            if upload is not None:
+                upload_pages = upload["ingestor"].pages(upload["digest"])
+                if upload_pages is not None:
+                    digest_model = DIGEST_MODELS[api_provider]
+                    digester = ReportDigester(
+                        make_llm_summarizer(llm_pool, api_provider, api_key, digest_model),
+                        digest_model,
+                        cache=params["digest_cache"],
+                        max_concurrency=params["parallel_concurrency"]
+                    )
+                    digest_phases = {"map": "分割要約", "reduce": "要約の統合", "final": "ダイジェスト作成"}
                     
-                    # API呼び出し
-                    if system_prompt:
-                        message = client.messages.create(
-                            model=selected_model,
-                            max_tokens=8000,
-                            temperature=selected_temperature,
-                            system=system_prompt,
-                            messages=[{"role": "user", "content": prompt}]
-                        )
-                    else:
-                        message = client.messages.create(
-                            model=selected_model,
-                            max_tokens=8000,
-                            temperature=selected_temperature,
-                            messages=[{"role": "user", "content": prompt}]
-                        )
+                    def on_digest_progress(phase, done, total):
+                        job.set_progress(f"資料の{digest_phases[phase]}中... {done}/{total}", done / total if total else 0.0)
                     
-                    result = message.content[0].text
+                    upload_file_name = upload["ingestor"].status(upload["digest"])["file_name"]
+                    try:
+                        # 中止すると実行中の要約リクエストはキャンセルされ、未発行のチャンクは送信しない
+                        # （完了したチャンクの要約は保存済みのため、次回はその続きから処理する）
+                        with span("要約ダイジェスト"):
+                            digest_text, digest_entry, digest_cached = digester.digest(
+                                llm_pool, upload_pages, upload["digest"], upload_file_name,
+                                on_progress=on_digest_progress, cancel_event=job.cancel_event
+                            )
+                    except DigestCancelledError as e:
+                        raise JobCancelledError(str(e)) from None
+                    if digest_text:
+                        reference_parts.append(format_digest(digest_text, upload_file_name))
+                        digest_info = {
+                            "file_name": upload_file_name,
+                            "text": digest_text,
+                            "chunks": digest_entry["chunks"],
+                            "source": "保存済み" if digest_cached else f"{digest_entry['seconds']:.0f}秒で作成",
+                        }
+            analysis_reference = "\n\n".join(reference_parts)
+            job.check_cancelled()
+            
+            usage_holder = {}
+            
+            # 実際に応答したProvider・モデル（ヘッジ実行時はセカンダリになり得る）
+            answered_provider, answered_model = api_provider, selected_model
+            
+            # 結果キャッシュの確認（同一条件ならAPIを呼ばない）
+            with span("結果キャッシュの確認"):
+                cache_key = make_cache_key(analysis_inputs, api_provider, selected_model, analysis_reference)
+                cached_entry = None if params["force_refresh"] else result_cache.get(cache_key)
+            generation_started = time.time()
+            if cached_entry:
+                telemetry["mode"] = "cache"
+            elif params["use_parallel"]:
+                telemetry["mode"] = "parallel"
+            elif params["use_hedging"]:
+                telemetry["mode"] = "hedge"
+            else:
+                telemetry["mode"] = "stream" if params["use_streaming"] else "call"
+            
+            if cached_entry:
+                result = cached_entry["result"]
+                cached_at = datetime.fromtimestamp(cached_entry["created_at"]).strftime("%Y/%m/%d %H:%M")
+                job.note(f"⚡ キャッシュ済みの分析結果を表示しています（{cached_at} 分析・APIは呼び出していません）", "success")
+            
+            # ===== セクション並列生成パターン =====
+            elif params["use_parallel"]:
+                job.set_progress(f"{len(SECTION_SPECS)}セクションを並列生成中...", 0.0)
                 
-                # ===== OpenAI を使うパターン =====
-                else:
-                    client = OpenAI(api_key=api_key)
-                    
-                    # Chat Completions API
-                    response = client.chat.completions.create(
-                        model="gpt-4o",
-                        messages=[
-                            {"role": "system", "content": "あなたはゲーム業界の競合分析専門家です。"},
-                            {"role": "user", "content": prompt}
-                        ],
-                        temperature=0.7,
-                        max_tokens=8000
+                def on_section(section_name, text, done, total):
+                    job.set_progress(f"{section_name} 完了（{done}/{total}）", done / total)
+                
+                with span("セクション並列生成", sections=len(SECTION_SPECS)):
+                    result, usage_holder["summary"] = generate_sections(
+                        llm_pool,
+                        api_provider,
+                        api_key,
+                        selected_model,
+                        params["temperature"],
+                        analysis_inputs,
+                        use_opus=use_opus,
+                        reference_data=analysis_reference,
+                        max_concurrency=params["parallel_concurrency"],
+                        on_section=on_section
+                    )
+            
+            # ===== ヘッジ実行パターン（速い方を採用） =====
+            elif params["use_hedging"]:
+                secondary_provider = params["secondary_provider"]
+                with span("プロンプト作成"):
+                    hedge = HedgedRequest(
+                        llm_pool,
+                        HedgeCandidate(
+                            api_provider, selected_model, api_key,
+                            build_request(api_provider, analysis_inputs, use_opus, analysis_reference)
+                        ),
+                        HedgeCandidate(
+                            secondary_provider, select_model(secondary_provider)[0], params["secondary_api_key"],
+                            build_request(secondary_provider, analysis_inputs, False, analysis_reference)
+                        ),
+                        hedge_after=params["hedge_after"]
                     )
-                    
-                    result = response.choices[0].message.content
                 
-                st.success(f"■ 分析完了 ({api_provider})")
-                st.markdown("---")
+                job.set_progress(f"{api_provider}で分析中...")
+                if params["use_streaming"]:
+                    result = consume_stream(job, hedge.stream())
+                else:
+                    with span("API呼び出し（ヘッジ）"):
+                        result = hedge.complete()
+                usage_holder["usage"] = hedge.winner.usage
+                answered_provider, answered_model = hedge.winner.provider, hedge.winner.model
                 
-                # 結果を視覚化
-                st.markdown("## ■ 分析結果")
+                if hedge.winner.provider != api_provider:
+                    job.note(f"🏁 {api_provider}の応答が遅いため、{hedge.winner.provider}（{hedge.winner.model}）の結果を採用しました")
+                elif hedge.hedged:
+                    job.note(f"🏁 予備の{secondary_provider}にも送信しましたが、{api_provider}の結果を採用しました")
+            
+            # ===== Claude を使うパターン =====
+            elif api_provider == "Claude (Anthropic)":
+                # Opus 4使用時の通知
+                if use_opus:
+                    job.set_progress(f"🚀 {selected_model}（Opus 4）で分析を実行中...")
+                else:
+                    job.set_progress(f"{api_provider}で分析中...")
                 
-                # エグゼクティブサマリー抽出（ダークモード対応）
-                if "EXECUTIVE_SUMMARY" in result:
-                    summary_start = result.find("EXECUTIVE_SUMMARY")
-                    summary_end = result.find("##", summary_start + 1)
-                    if summary_end == -1:
-                        summary_end = len(result)
-                    
-                    summary_text = result[summary_start:summary_end].replace("EXECUTIVE_SUMMARY", "").strip()
-                    
-                    st.markdown(f"""
-                    <div style="padding: 20px; border-radius: 10px; background-color: #1e3a5f; margin: 20px 0; border: 2px solid #4a90e2; color: white;">
-                        <h3 style="color: #4a90e2; margin-top: 0;">■ エグゼクティブサマリー</h3>
-                        <p style="color: white; line-height: 1.6;">{summary_text}</p>
-                    </div>
-                    """, unsafe_allow_html=True)
+                # API呼び出し（静的プレフィックスはPrompt Cachingの対象）
+                with span("プロンプト作成"):
+                    request_kwargs = build_request(api_provider, analysis_inputs, use_opus, analysis_reference)
                 
-                # JSONデータを抽出してレーダーチャート作成
-                json_data_found = False
-                if "```json" in result:
-                    json_start = result.find("```json") + 7
-                    json_end = result.find("```", json_start)
-                    json_str = result[json_start:json_end].strip()
-                    
-                    try:
-                        metrics_data = json.loads(json_str)
-                        json_data_found = True
-                        
-                        # レーダーチャート作成
-                        categories = ['市場ポジション', '収益性', 'ユーザー基盤', 'ブランド力', '技術力']
-                        
-                        fig = go.Figure()
-                        
-                        # 競合データ
-                        fig.add_trace(go.Scatterpolar(
-                            r=[
-                                metrics_data['competitor']['market_position'],
-                                metrics_data['competitor']['revenue_potential'],
-                                metrics_data['competitor']['user_base'],
-                                metrics_data['competitor']['brand_strength'],
-                                metrics_data['competitor']['technology']
-                            ],
-                            theta=categories,
-                            fill='toself',
-                            name=competitor_name,
-                            line=dict(color='#FF6B6B', width=2)
-                        ))
-                        
-                        # 自社データ
-                        fig.add_trace(go.Scatterpolar(
-                            r=[
-                                metrics_data['our_product']['market_position'],
-                                metrics_data['our_product']['revenue_potential'],
-                                metrics_data['our_product']['user_base'],
-                                metrics_data['our_product']['brand_strength'],
-                                metrics_data['our_product']['technology']
-                            ],
-                            theta=categories,
-                            fill='toself',
-                            name=our_product,
-                            line=dict(color='#4ECDC4', width=2)
-                        ))
-                        
-                        fig.update_layout(
-                            polar=dict(
-                                radialaxis=dict(
-                                    visible=True,
-                                    range=[0, 100],
-                                    tickfont=dict(size=12)
-                                )
-                            ),
-                            showlegend=True,
-                            title={
-                                'text': "■ 競合比較レーダーチャート（100点満点）",
-                                'x': 0.5,
-                                'xanchor': 'center'
-                            },
-                            height=500,
-                            font=dict(size=14)
+                if params["use_streaming"]:
+                    result = consume_stream(job, llm_pool.stream(
+                        api_provider, selected_model, api_key,
+                        lambda client: stream_claude(client, request_kwargs, usage_holder),
+                        tokens=estimate_request_tokens(request_kwargs),
+                        usage_holder=usage_holder
+                    ))
+                else:
+                    with span("API呼び出し"):
+                        message = llm_pool.call(
+                            api_provider, selected_model, api_key,
+                            lambda client: client.messages.create(**request_kwargs),
+                            tokens=estimate_request_tokens(request_kwargs)
                         )
-                        
-                        st.plotly_chart(fig, use_container_width=True)
-                        
-                        # 比較テーブル
-                        st.markdown("### ■ 詳細スコア比較")
-                        
-                        comparison_df = pd.DataFrame({
-                            '評価項目': categories,
-                            competitor_name: [
-                                metrics_data['competitor']['market_position'],
-                                metrics_data['competitor']['revenue_potential'],
-                                metrics_data['competitor']['user_base'],
-                                metrics_data['competitor']['brand_strength'],
-                                metrics_data['competitor']['technology']
-                            ],
-                            our_product: [
-                                metrics_data['our_product']['market_position'],
-                                metrics_data['our_product']['revenue_potential'],
-                                metrics_data['our_product']['user_base'],
-                                metrics_data['our_product']['brand_strength'],
-                                metrics_data['our_product']['technology']
-                            ],
-                            '差分': [
-                                metrics_data['competitor']['market_position'] - metrics_data['our_product']['market_position'],
-                                metrics_data['competitor']['revenue_potential'] - metrics_data['our_product']['revenue_potential'],
-                                metrics_data['competitor']['user_base'] - metrics_data['our_product']['user_base'],
-                                metrics_data['competitor']['brand_strength'] - metrics_data['our_product']['brand_strength'],
-                                metrics_data['competitor']['technology'] - metrics_data['our_product']['technology']
-                            ]
-                        })
-                        
-                        # 差分に色をつける（ダークモード対応）
-                        def highlight_diff(val):
-                            if isinstance(val, (int, float)):
-                                if val > 0:
-                                    return 'background-color: #8B0000; color: white'
-                                elif val < 0:
-                                    return 'background-color: #006400; color: white'
-                            return ''
-                        
-                        styled_df = comparison_df.style.applymap(highlight_diff, subset=['差分'])
-                        st.dataframe(styled_df, use_container_width=True, height=250)
-                        
-                        # 各評価の根拠を表示
-                        st.markdown("---")
-                        st.markdown("### ■ 評価軸の定義")
-                        
-                        definition_text = """
-| 評価軸 | 定義 |
-|-------|------|
-| **市場ポジション** | 市場での認知度・ランキング順位・ブランド力 |
-| **収益性** | 年間売上規模・ARPU・課金効率・収益安定性<br>ライブサービス: 継続課金・イベント収益・長期ARPU<br>買い切り: 初回売上・DLC収益・周辺商品展開 |
-| **ユーザー基盤** | DAU/MAU・ユーザー定着率・コミュニティ活性度 |
-| **ブランド力** | IP価値・メディア露出・ファンロイヤリティ・二次展開力 |
-| **技術力** | グラフィック品質・システム安定性・技術革新性・開発体制の強さ |
-                        """
-                        st.markdown(definition_text)
-                        
-                        st.markdown("---")
-                        st.markdown("### ■ 各スコアの評価根拠")
-                        st.info("各評価項目のスコアがどのような要素で構成されているかを確認できます")
-                        
-                        # 結果から根拠表を抽出
-                        if "**各評価の根拠**" in result:
-                            # 根拠表の開始位置を探す
-                            rationale_start = result.find("**各評価の根拠**")
-                            # 次のセクション（##）までを取得
-                            rationale_end = result.find("##", rationale_start + 10)
-                            if rationale_end == -1:
-                                rationale_end = len(result)
-                            
-                            rationale_content = result[rationale_start:rationale_end].strip()
-                            st.markdown(rationale_content)
-                        else:
-                            st.warning("● 評価根拠の詳細が見つかりませんでした")
-                        
-                    except (json.JSONDecodeError, KeyError) as e:
-                        st.warning(f"● レーダーチャートの生成に失敗しました: {str(e)}")
-                
-                if not json_data_found:
-                    st.warning("● レーダーチャート用のデータが見つかりませんでした")
+                    result = message.content[0].text
+                    usage_holder["usage"] = message.usage
+            
+            # ===== OpenAI を使うパターン =====
+            else:
+                job.set_progress(f"{api_provider}で分析中...")
                 
-                # 詳細分析結果
-                st.markdown("---")
-                tab1, tab2, tab3 = st.tabs(["■ 詳細分析", "■ エクスポート", "■ 市場データ"])
+                # Chat Completions API
+                with span("プロンプト作成"):
+                    request_kwargs = build_request(api_provider, analysis_inputs, reference_data=analysis_reference)
                 
-                with tab1:
-                    # 表示用のresultを作成
-                    display_result = result
-                    
-                    # COMPARISON_METRICSセクション全体を非表示
-                    if "## COMPARISON_METRICS" in display_result:
-                        metrics_start = display_result.find("## COMPARISON_METRICS")
-                        metrics_end = display_result.find("##", metrics_start + 20)
-                        if metrics_end == -1:
-                            metrics_end = len(display_result)
-                        display_result = display_result[:metrics_start] + display_result[metrics_end:]
-                    
-                    # セクション名だけのテキスト行を削除
-                    for section_name in ['MARKET_ANALYSIS', 'COMPETITOR_ANALYSIS', 'GAP_ANALYSIS', 'ACTION_PLAN', 'RISK_OPPORTUNITY', 'DATA_SOURCES']:
-                        display_result = display_result.replace(f"{section_name}\n\n", "")
-                        display_result = display_result.replace(f"{section_name}\n", "")
-                        display_result = display_result.replace(section_name, "")
-                    
-                    # セクションごとにBOX化
-                    sections = display_result.split('##')
-                    for section in sections:
-                        if section.strip():
-                            lines = section.strip().split('\n', 1)
-                            if len(lines) == 2:
-                                title = lines[0].strip()
-                                content = lines[1].strip()
-                                
-                                if title in ['EXECUTIVE_SUMMARY']:
-                                    continue
-                                
-                                st.markdown(f"""
-                                <div style="padding: 15px; border-radius: 8px; background-color: #2d2d2d; margin: 15px 0; border-left: 4px solid #4a90e2;">
-                                    <h3 style="color: #4a90e2; margin-top: 0;">■ {title}</h3>
-                                    <div style="color: #e0e0e0;">
-                                """, unsafe_allow_html=True)
-                                
-                                st.markdown(content)
-                                
-                                st.markdown("</div></div>", unsafe_allow_html=True)
-                            else:
-                                if section.strip() not in ['MARKET_ANALYSIS', 'COMPETITOR_ANALYSIS', 'GAP_ANALYSIS', 'ACTION_PLAN', 'RISK_OPPORTUNITY']:
-                                    st.markdown(section)
+                if params["use_streaming"]:
+                    result = consume_stream(job, llm_pool.stream(
+                        api_provider, selected_model, api_key,
+                        lambda client: stream_openai(client, request_kwargs, usage_holder),
+                        tokens=estimate_request_tokens(request_kwargs),
+                        usage_holder=usage_holder
+                    ))
+                else:
+                    with span("API呼び出し"):
+                        response = llm_pool.call(
+                            api_provider, selected_model, api_key,
+                            lambda client: client.chat.completions.create(**request_kwargs),
+                            tokens=estimate_request_tokens(request_kwargs)
+                        )
+                    result = response.choices[0].message.content
+                    usage_holder["usage"] = response.usage
+            
+            usage = None
+            if not cached_entry:
+                usage = usage_holder.get("summary") or extract_cache_usage(usage_holder.get("usage"))
+                if result and result.strip():
+                    with span("結果キャッシュの保存"):
+                        result_cache.put(cache_key, result, {
+                            "provider": answered_provider,
+                            "model": answered_model,
+                            "usage": usage
+                        })
                 
-                with tab2:
-                    col_exp1, col_exp2 = st.columns(2)
-                    
-                    with col_exp1:
-                        st.download_button(
-                            label="▶ テキスト形式",
-                            data=result,
-                            file_name=f"{competitor_name}_analysis_{datetime.now().strftime('%Y%m%d')}.txt",
-                            mime="text/plain",
-                            use_container_width=True
+                job.note(f"■ 分析完了 ({answered_provider})", "success")
+            telemetry.update(usage or {})
+            telemetry.update({
+                "provider": answered_provider,
+                "model": answered_model,
+                "result_cache_hit": bool(cached_entry),
+                "ttft_ms": (job.first_chunk_at - generation_started) * 1000 if job.first_chunk_at else None,
+            })
+            job.check_cancelled()
+            
+            # スコアは本文のJSONが使えなければ構造化出力の小さな呼び出しで取り直す（分析全体は再実行しない）
+            with span("レポート解析"):
+                report = parse_report(result)
+            stored_metrics = cached_entry["metadata"].get("metrics") if cached_entry else None
+            metrics_source = "本文" if report.metrics is not None else None
+            if stored_metrics:
+                report.metrics, report.metrics_error = stored_metrics, None
+                metrics_source = "保存済み"
+            elif params["always_structured_metrics"] or report.metrics is None:
+                metrics_started = time.time()
+                metrics_telemetry = {
+                    "job_id": job.id,
+                    "kind": "metrics",
+                    "username": params["username"],
+                    "provider": api_provider,
+                    "model": LIGHT_MODELS[api_provider],
+                    "mode": "call",
+                }
+                try:
+                    job.set_progress("スコアを構造化出力で取得中...")
+                    with span("スコアの構造化出力"):
+                        report.metrics, metrics_usage = fetch_metrics(
+                            llm_pool, api_provider, api_key, LIGHT_MODELS[api_provider], analysis_inputs, report
                         )
-                    
-                    with col_exp2:
-                        md_content = f"""# 競合分析レポート
-
-**分析日**: {datetime.now().strftime('%Y年%m月%d日')}
-**競合**: {competitor_name}
-**自社**: {our_product}
+                    report.metrics_error = None
+                    metrics_source = "構造化出力"
+                    metrics_telemetry.update(metrics_usage, status="done")
+                    if result and result.strip():
+                        result_cache.update_metadata(cache_key, metrics=report.metrics)
+                except Exception as e:
+                    metrics_telemetry.update(status="error", error=str(e))
+                    if report.metrics is None:
+                        report.metrics_error = f"構造化出力でのスコア取得にも失敗しました: {e}"
+                params["telemetry"].record({**metrics_telemetry, "latency_ms": (time.time() - metrics_started) * 1000})
+            
+            telemetry.update({
+                "parse_ok": all(report.section(name) is not None for name in SECTION_NAMES),
+                "radar_ok": report.metrics is not None,
+                "metrics_source": metrics_source,
+            })
+            record_telemetry("done")
+            return {
+                "report": report,
+                "cache_key": cache_key,
+                "provider": answered_provider,
+                "usage": usage,
+                "analyzed_at": cached_entry["created_at"] if cached_entry else time.time(),
+                "references": references,
+                "digest": digest_info,
+                "trace": job_trace,
+                "profile": profile,
+            }
+    
+    except RateLimitWaitCancelled as e:
+        record_telemetry("cancelled", str(e))
+        raise JobCancelledError(str(e)) from None
+    except Exception as e:
+        record_telemetry("cancelled" if isinstance(e, JobCancelledError) else "error", str(e))
+        if not isinstance(e, JobCancelledError):
+            # 画面で結果を受け取らなくても記録する（ワーカースレッドにはセッションがないため直接書き込む）
+            params["audit_log"].log(
+                params["username"],
+                "analysis_error",
+                f"{api_provider} | エラー: {str(e)}",
+                display_name=params["display_name"]
+            )
+        raise
+
+def clear_active_job():
+    st.session_state.pop(ACTIVE_JOB_KEY, None)
+    if "job" in st.query_params:
+        del st.query_params["job"]
+
+def collect_analysis_job(job):
+    """完了したジョブの結果を受け取り、表示用にセッションへ保存（エラー・中止はここで表示）"""
+    if job.state == JOB_CANCELLED:
+        st.warning(f"⏹ {job.label}: {job.error}")
+        return
+    if job.state == JOB_ERROR:
+        st.error(f"× {job.context['provider']} APIエラー: {job.error}")
+        st.info("▶ トラブルシューティング: APIキーを確認してください")
+        return
+    payload = job.result
+    save_analysis_result(
+        payload["cache_key"], payload["report"], job.context["competitor_name"], job.context["our_product"],
+        payload["provider"], payload["analyzed_at"],
+        details={
+            "job_id": job.id,
+            "notes": list(job.notes),
+            "usage": payload["usage"],
+            "references": payload["references"],
+            "digest": payload["digest"],
+            "trace": payload["trace"],
+            "profile": payload["profile"],
+        }
+    )
 
----
+@timed_fragment("ジョブ進捗", run_every=JOB_POLL_INTERVAL)
+def render_job_progress(job_id):
+    """実行中のジョブの状態・進捗・ストリーミングの途中経過を表示（この領域だけを定期的に再実行）"""
+    job = get_analysis_queue().get(job_id)
+    if job is None or job.finished:
+        # アプリ全体を再実行して結果を受け取る
+        st.rerun()
+    
+    col_job_info, col_job_cancel = st.columns([4, 1])
+    with col_job_info:
+        st.info(f"⏳ {job.label}: {JOB_STATE_LABELS[job.state]}（{job.phase}・{job.elapsed:.0f}秒経過）")
+    with col_job_cancel:
+        if st.button("⏹ 分析を中止", key=f"cancel_job_{job.id}", disabled=job.cancel_event.is_set(),
+                     use_container_width=True):
+            # 同じ分析を待っている他のユーザーがいれば、自分だけ受け取りをやめる（分析は続ける）
+            if get_analysis_queue().detach(job.id, current_user):
+                clear_active_job()
+                st.rerun()
+            get_analysis_queue().cancel(job.id)
+    if job.state == JOB_QUEUED:
+        queue_stats = get_analysis_queue().stats()
+        st.caption(f"同時実行数の上限（{queue_stats['workers']}件）に達しているため待機しています"
+                   f"（実行中 {queue_stats['running']}件・待機中 {queue_stats['queued']}件）")
+    if len(job.owners) > 1:
+        st.caption(f"👥 同じ条件の分析を{len(job.owners)}人で待っています（APIの呼び出しは1回だけで、同じ結果を表示します）")
+    if job.progress is not None:
+        st.progress(job.progress, text=job.phase)
+    for level, message in job.notes:
+        getattr(st, level)(message)
+    st.caption("このページを離れても分析は続きます。戻ってくると結果を表示します（サイドバーの「分析ジョブ」からも確認できます）")
+    
+    # ストリーミングの途中経過（受信済みの断片のうち未処理の分だけをパーサーに渡す）
+    if job.chunks:
+        stream_state = st.session_state.setdefault(f"job_stream_{job.id}", {"parser": ReportParser(), "fed": 0})
+        new_chunks = job.chunks[stream_state["fed"]:]
+        for chunk in new_chunks:
+            stream_state["parser"].feed(chunk)
+        stream_state["fed"] += len(new_chunks)
+        render_stream_sections(stream_state["parser"])
+
+analysis_queue = get_analysis_queue()
+current_user = st.session_state.get("username", "unknown")
+
+# 分析実行（ジョブとして登録し、この実行では完了を待たない）
+if run_analysis:
+    if not api_key:
+        st.error("● API Keyが設定されていません。管理者にStreamlit SecretsでANTHROPIC_API_KEYを設定するよう連絡してください。")
+    elif not competitor_name or not our_product:
+        st.error("● 競合タイトル名と自社タイトル名を入力してください")
+    else:
+        # 結果表示で使うグラフ・表のライブラリはAPIの応答待ちの間に読み込む
+        preload("pandas", "plotly.graph_objects")
+        
+        # アクセスログ記録
+        log_access(
+            current_user,
+            "analysis_executed",
+            f"競合:{competitor_name} vs 自社:{our_product}"
+        )
+        
+        # モデルとtemperatureを選択
+        use_opus = api_provider == "Claude (Anthropic)" and "高精度" in claude_model_mode
+        selected_model, selected_temperature = select_model(api_provider, use_opus)
+        
+        # 分析対象の入力値（プロンプトの動的サフィックスに使用）
+        analysis_inputs = {
+            "competitor_name": competitor_name,
+            "competitor_genre": competitor_genre,
+            "competitor_platform": competitor_platform,
+            "competitor_revenue": competitor_revenue,
+            "competitor_dau": competitor_dau,
+            "our_product": our_product,
+            "our_genre": our_genre,
+            "our_platform": our_platform,
+            "our_revenue_target": our_revenue_target,
+            "our_dau_target": our_dau_target,
+            "analysis_type": analysis_type,
+            "comparison_focus": comparison_focus,
+            "additional_context": additional_context,
+        }
+        reference_indexes = []
+        if use_market_index:
+            reference_indexes.append(("市場資料", market_index, "市場資料からの関連抜粋"))
+        if upload_digest:
+            upload_index = get_upload_ingestor().load_index(upload_digest)
+            if upload_index is not None:
+                reference_indexes.append(("アップロード資料", upload_index, "アップロードされた市場データからの関連抜粋"))
+            else:
+                st.warning("アップロードされたPDFは抽出中のため、今回の分析には含まれません")
+        
+        # 管理者がプロファイルを指定した分析は、計測結果を本人に返すため他のジョブに相乗りしない
+        profile_analysis = current_user == "admin" and st.session_state.get("profile_analysis", False)
+        
+        # ワーカースレッドからは st.secrets・st.cache_resource・セッションを使わないため、必要なものを渡す
+        analysis_params = {
+            "provider": api_provider,
+            "api_key": api_key,
+            "model": selected_model,
+            "temperature": selected_temperature,
+            "use_opus": use_opus,
+            "inputs": analysis_inputs,
+            "use_streaming": use_streaming,
+            "use_parallel": use_parallel,
+            "parallel_concurrency": parallel_concurrency,
+            "use_hedging": use_hedging,
+            "secondary_provider": secondary_provider,
+            "secondary_api_key": secondary_api_key,
+            "hedge_after": hedge_after,
+            "force_refresh": force_refresh,
+            "always_structured_metrics": always_structured_metrics,
+            "reference_indexes": reference_indexes,
+            "top_k": market_index_top_k,
+            "upload": {"ingestor": get_upload_ingestor(), "digest": upload_digest}
+                      if use_upload_digest and upload_digest else None,
+            "digest_cache": get_digest_cache(),
+            "result_cache": result_cache,
+            "llm_pool": get_llm_pool(),
+            "audit_log": get_audit_log(),
+            "telemetry": get_metrics_store(),
+            "span_exporter": get_span_exporter(),
+            "profile_path": f"logs/profiles/{datetime.now().strftime('%Y%m%d_%H%M%S')}_{current_user}"
+                            if profile_analysis else None,
+            "profile_engine": st.session_state.get("profile_engine", "cProfile"),
+            "username": current_user,
+            "display_name": st.session_state.get("user_display_name", current_user),
+        }
+        # 同じ条件の分析が実行中なら新しく実行せず、そのジョブの途中経過・結果を共有する
+        # （キーは結果キャッシュと同じ正規化した入力値 + 結果に影響する参照資料・生成方法の設定。
+        #   キャッシュを使わない再実行は、キャッシュを使う実行に相乗りしない）
+        coalesce_settings = repr((
+            [reference_label for reference_label, _, _ in reference_indexes], market_index_top_k,
+            upload_digest, use_upload_digest, use_parallel,
+            secondary_provider if use_hedging else None, always_structured_metrics, force_refresh
+        ))
+        job_id = analysis_queue.submit(
+            current_user,
+            f"{competitor_name} vs {our_product}",
+            lambda job: run_analysis_job(job, analysis_params),
+            context={"provider": api_provider, "competitor_name": competitor_name, "our_product": our_product},
+            key=None if profile_analysis
+                else make_cache_key(analysis_inputs, api_provider, selected_model, coalesce_settings)
+        )
+        # ブラウザを再読み込みしてもURLのジョブIDから結果を受け取れるようにする
+        st.session_state[ACTIVE_JOB_KEY] = job_id
+        st.query_params["job"] = job_id
+        st.session_state.pop(ANALYSIS_RESULT_KEY, None)
+
+# 実行中のジョブの進捗表示と、完了したジョブの結果の受け取り
+active_job_id = st.session_state.get(ACTIVE_JOB_KEY) or st.query_params.get("job")
+if active_job_id:
+    active_job = analysis_queue.get(active_job_id)
+    if active_job is None or current_user not in active_job.owners:
+        st.warning("● 分析ジョブが見つかりません（保持期限が過ぎたか、サーバーが再起動されました）")
+        clear_active_job()
+    elif active_job.finished:
+        clear_active_job()
+        collect_analysis_job(active_job)
+    else:
+        render_job_progress(active_job_id)
+
+# 分析結果の表示（ダウンロードボタン・サイドバー操作などによる再実行でも再表示する）
+if st.session_state.get(ANALYSIS_RESULT_KEY) and not st.session_state.get(ACTIVE_JOB_KEY):
+    saved_analysis = st.session_state[ANALYSIS_RESULT_KEY]
+    saved_details = saved_analysis.get("details") or {}
+    saved_at = datetime.fromtimestamp(saved_analysis["analyzed_at"]).strftime("%Y/%m/%d %H:%M")
+    col_saved_info, col_saved_clear = st.columns([4, 1])
+    with col_saved_info:
+        st.caption(
+            f"{saved_analysis['competitor_name']} vs {saved_analysis['our_product']}・"
+            f"{saved_analysis['provider']}・{saved_at} 分析・ID {saved_analysis['id'][:12]}"
+        )
+    with col_saved_clear:
+        if st.button("🗑 結果を閉じる", key="clear_analysis_result", use_container_width=True):
+            del st.session_state[ANALYSIS_RESULT_KEY]
+            st.rerun()
+    
+    for reference_label, retrieved_hits, retrieval_ms in saved_details.get("references", []):
+        with st.expander(f"📚 {reference_label}の関連抜粋 {len(retrieved_hits)}件を参照（検索 {retrieval_ms:.1f}ms）"):
+            for score, passage in retrieved_hits:
+                page = f" p.{passage['page']}" if passage.get("page") else ""
+                st.markdown(f"**{passage['source']}{page}**（スコア {score:.1f}）")
+                st.caption(passage["text"][:200] + ("…" if len(passage["text"]) > 200 else ""))
+    digest_info = saved_details.get("digest")
+    if digest_info:
+        with st.expander(f"📝 {digest_info['file_name']} の要約ダイジェストを参照"
+                         f"（{digest_info['chunks']}チャンク・{digest_info['source']}）"):
+            st.markdown(digest_info["text"])
+    for level, message in saved_details.get("notes", []):
+        getattr(st, level)(message)
+    render_cache_usage(saved_details.get("usage"))
+    
+    st.markdown("---")
+    # 結果表示の段階ごとの時間（ブラウザ側の描画は含まず、Streamlitの要素を作るまで）
+    render_trace = Trace("結果表示", job_id=saved_details.get("job_id"), username=current_user)
+    with tracing(render_trace):
+        with span("レポート解析"):
+            saved_report = restore_analysis_report(saved_analysis)
+        render_analysis_result(
+            saved_report,
+            saved_analysis["competitor_name"],
+            saved_analysis["our_product"],
+            saved_analysis["analyzed_at"]
+        )
+    # JSON Lines には分析後の最初の表示だけを書き出す（操作ごとの再表示は数えない）
+    if saved_details.get("job_id") and st.session_state.get("exported_render_trace") != saved_details["job_id"]:
+        get_span_exporter().export(render_trace)
+        st.session_state["exported_render_trace"] = saved_details["job_id"]
+    
+    if current_user == "admin":
+        render_trace_waterfall(saved_details.get("trace"), render_trace, saved_details.get("profile"))
 
-{result}
-"""
-                        st.download_button(
-                            label="▶ Markdown形式",
-                            data=md_content,
-                            file_name=f"{competitor_name}_analysis_{datetime.now().strftime('%Y%m%d')}.md",
-                            mime="text/markdown",
-                            use_container_width=True
-                        )
-                
-                with tab3:
-                    st.markdown("### ■ 参照した市場データ")
-                    
-                    # DATA_SOURCESセクションを抽出して表示
-                    if "## DATA_SOURCES" in result:
-                        sources_start = result.find("## DATA_SOURCES")
-                        sources_content = result[sources_start:]
-                        
-                        st.markdown("""
-                        <div style="padding: 15px; border-radius: 8px; background-color: #1e3a5f; margin: 15px 0; border: 2px solid #4a90e2;">
-                            <h4 style="color: #4a90e2; margin-top: 0;">📚 今回の分析で使用したデータソース</h4>
-                        </div>
-                        """, unsafe_allow_html=True)
-                        
-                        # DATA_SOURCESの内容を表示（セクション名を除く）
-                        sources_display = sources_content.replace("## DATA_SOURCES", "").strip()
-                        st.markdown(sources_display)
-                        
-                        st.markdown("---")
-                    
-                    st.markdown("### ■ 組み込み市場データ（参考）")
-                    st.markdown("""
-                    <div style="padding: 15px; border-radius: 8px; background-color: #1a1a1a; border: 1px solid #4a90e2;">
-                    """, unsafe_allow_html=True)
-                    
-                    st.code(MARKET_DATA, language="text")
-                    
-                    st.markdown("</div>", unsafe_allow_html=True)
-                    
-            except Exception as e:
-                st.error(f"× {api_provider} APIエラー: {str(e)}")
-                st.info("▶ トラブルシューティング: APIキーを確認してください")
-                log_access(
-                    st.session_state.get("username", "unknown"),
-                    "analysis_error",
-                    f"{api_provider} | エラー: {str(e)}"
-                )
-
-# 管理者用: アクセスログ表示
-if st.session_state.get("show_logs", False):
+# 管理者用: アクセスログ表示（絞り込み・ページ送りではこの領域だけを再実行）
+@timed_fragment("アクセスログ")
+def render_access_logs():
     st.markdown("---")
     st.subheader("🔐 アクセスログ")
     
-    logs_df = get_access_logs()
-    if logs_df is not None and not logs_df.empty:
-        st.dataframe(logs_df.sort_values('timestamp', ascending=False), use_container_width=True)
+    ALL_LABEL = "すべて"
+    today = datetime.now().date()
+    
+    col_l1, col_l2, col_l3, col_l4 = st.columns([2, 1, 1, 1])
+    with col_l1:
+        log_period = st.date_input(
+            "期間",
+            value=(today - timedelta(days=30), today),
+            max_value=today,
+            key="log_period"
+        )
+    with col_l2:
+        log_user = st.selectbox("ユーザー", [ALL_LABEL] + get_log_filter_options("username"), key="log_user")
+    with col_l3:
+        log_action = st.selectbox("アクション", [ALL_LABEL] + get_log_filter_options("action"), key="log_action")
+    with col_l4:
+        log_page_size = st.selectbox("表示件数", [50, 100, 200], key="log_page_size")
+    
+    # 期間は開始日のみ選択中の場合もある
+    if isinstance(log_period, (tuple, list)):
+        log_start = log_period[0] if len(log_period) > 0 else None
+        log_end = log_period[1] if len(log_period) > 1 else log_start
+    else:
+        log_start = log_end = log_period
+    log_filters = {
+        "start_date": log_start,
+        "end_date": log_end,
+        "username": None if log_user == ALL_LABEL else log_user,
+        "action": None if log_action == ALL_LABEL else log_action,
+    }
+    
+    # 集計（期間・ユーザーごとにキャッシュ）
+    log_summary = get_log_summary(log_start, log_end, log_filters["username"])
+    col_m1, col_m2, col_m3, col_m4 = st.columns(4)
+    col_m1.metric("記録数", f"{log_summary['total']:,}")
+    col_m2.metric("分析実行", f"{log_summary['analyses']:,}")
+    col_m3.metric("分析エラー率", f"{log_summary['error_rate']:.1%}", help=f"エラー {log_summary['errors']:,}件")
+    col_m4.metric("ログイン失敗", f"{log_summary['login_failed']:,}")
+    
+    daily_counts = get_daily_analysis_counts(log_start, log_end, log_filters["username"])
+    if daily_counts:
+        daily_df = pd.DataFrame(daily_counts)
+        fig_daily = go.Figure()
+        for user, user_df in daily_df.groupby("username"):
+            fig_daily.add_trace(go.Bar(x=user_df["day"], y=user_df["count"], name=user))
+        fig_daily.update_layout(
+            barmode="stack",
+            title="ユーザー別・日別の分析実行数",
+            height=300,
+            margin=dict(l=20, r=20, t=40, b=20)
+        )
+        st.plotly_chart(fig_daily, use_container_width=True)
+    
+    # キーセットページネーション（条件が変わったら先頭ページに戻す）
+    filter_signature = (log_start, log_end, log_filters["username"], log_filters["action"], log_page_size)
+    if st.session_state.get("log_filter_signature") != filter_signature:
+        st.session_state["log_filter_signature"] = filter_signature
+        st.session_state["log_page_cursors"] = [None]
+    page_cursors = st.session_state["log_page_cursors"]
+    
+    audit_log = get_audit_log()
+    audit_log.flush()
+    log_rows, next_cursor = audit_log.query(cursor=page_cursors[-1], limit=log_page_size, **log_filters)
+    
+    if log_rows:
+        st.dataframe(
+            pd.DataFrame(log_rows, columns=list(LOG_COLUMNS)),
+            use_container_width=True,
+            hide_index=True
+        )
     else:
         st.info("アクセスログがありません")
     
+    col_p1, col_p2, col_p3 = st.columns([1, 2, 1])
+    with col_p1:
+        if st.button("◀ 前へ", disabled=len(page_cursors) <= 1):
+            page_cursors.pop()
+            st.rerun(scope="fragment")
+    with col_p2:
+        st.caption(f"{len(page_cursors)}ページ目（{len(log_rows)}件表示）")
+    with col_p3:
+        if st.button("次へ ▶", disabled=next_cursor is None):
+            page_cursors.append(next_cursor)
+            st.rerun(scope="fragment")
+    
     if st.button("ログを閉じる"):
         st.session_state["show_logs"] = False
+        # ログ表示の領域を消すためアプリ全体を再実行
+        st.rerun()
+
+if st.session_state.get("show_logs", False):
+    render_access_logs()
+
+# 管理者用: 利用状況（所要時間・トークン数・キャッシュ・概算コスト）
+@timed_fragment("利用状況")
+def render_usage_dashboard():
+    st.markdown("---")
+    st.subheader("📈 利用状況")
+    
+    today = datetime.now().date()
+    usage_period = st.date_input(
+        "期間",
+        value=(today - timedelta(days=30), today),
+        max_value=today,
+        key="usage_period"
+    )
+    if isinstance(usage_period, (tuple, list)):
+        usage_start = usage_period[0] if len(usage_period) > 0 else None
+        usage_end = usage_period[1] if len(usage_period) > 1 else usage_start
+    else:
+        usage_start = usage_end = usage_period
+    
+    def format_ms(value):
+        return "-" if value is None else f"{value / 1000:,.1f}秒"
+    
+    def format_rate(value):
+        return "-" if value is None else f"{value:.0%}"
+    
+    usage_summary = get_metrics_summary(usage_start, usage_end)
+    col_u1, col_u2, col_u3, col_u4 = st.columns(4)
+    col_u1.metric("分析数", f"{usage_summary['analyses']:,}", help=f"エラー {usage_summary['errors']:,}件")
+    col_u2.metric("所要時間 p50 / p95",
+                  f"{format_ms(usage_summary['latency_p50'])} / {format_ms(usage_summary['latency_p95'])}",
+                  help="結果キャッシュのヒットを除く、正常に完了した分析の開始から完了まで")
+    col_u3.metric("最初のトークン p50 / p95",
+                  f"{format_ms(usage_summary['ttft_p50'])} / {format_ms(usage_summary['ttft_p95'])}",
+                  help="ストリーミング表示した分析のみ")
+    col_u4.metric("概算コスト", f"${usage_summary['cost']:,.2f}", help="公開価格による概算（単価が不明なモデルは含まない）")
+    col_u5, col_u6, col_u7, col_u8 = st.columns(4)
+    col_u5.metric("結果キャッシュのヒット率", format_rate(usage_summary["result_cache_hit_rate"]))
+    col_u6.metric("プロンプトキャッシュ読み取り率", format_rate(usage_summary["prompt_cache_rate"]),
+                  help="APIを呼び出した分析の入力トークンのうち、キャッシュから読み取った割合")
+    col_u7.metric("レポート解析の成功率", format_rate(usage_summary["parse_rate"]), help="全セクションを読み取れた割合")
+    col_u8.metric("レーダーチャートの成功率", format_rate(usage_summary["radar_rate"]))
+    
+    if usage_summary["by_model"]:
+        st.markdown("#### モデル別")
+        st.dataframe(
+            pd.DataFrame([
+                {
+                    "モデル": entry["model"],
+                    "呼び出し": entry["calls"],
+                    "入力": entry["input_tokens"],
+                    "出力": entry["output_tokens"],
+                    "キャッシュ作成": entry["cache_creation_input_tokens"],
+                    "キャッシュ読み取り": entry["cache_read_input_tokens"],
+                    "概算コスト（USD）": entry["cost"],
+                    "所要時間 p50（秒）": None if entry["latency_p50"] is None else entry["latency_p50"] / 1000,
+                    "所要時間 p95（秒）": None if entry["latency_p95"] is None else entry["latency_p95"] / 1000,
+                }
+                for entry in usage_summary["by_model"]
+            ]),
+            use_container_width=True,
+            hide_index=True
+        )
+        
+        daily_usage_df = pd.DataFrame(usage_summary["daily"])
+        fig_usage = go.Figure()
+        for model_name, model_df in daily_usage_df.groupby("model"):
+            fig_usage.add_trace(go.Bar(x=model_df["day"], y=model_df["tokens"], name=model_name))
+        fig_usage.update_layout(
+            barmode="stack",
+            title="モデル別・日別のトークン数（入力・出力・キャッシュの合計）",
+            height=300,
+            margin=dict(l=20, r=20, t=40, b=20)
+        )
+        st.plotly_chart(fig_usage, use_container_width=True)
+    else:
+        st.info("この期間の記録がありません")
+    
+    if st.button("利用状況を閉じる"):
+        st.session_state["show_usage"] = False
         st.rerun()
 
+if st.session_state.get("show_usage", False):
+    render_usage_dashboard()
+
 # フッター
 st.markdown("---")
 col_f1, col_f2, col_f3 = st.columns(3)
@@ -1117,3 +1832,14 @@ with col_f2:
     st.markdown(f"*Powered by {api_provider if 'api_provider' in locals() else 'AI'}*")
 with col_f3:
     st.markdown(f"*{datetime.now().strftime('%Y/%m/%d')}*")
+
+# 再実行の計測（管理者のみ表示）
+st.session_state["in_full_run"] = False
+record_run(FULL_RUN_SCOPE, APP_RUN_STARTED)
+if st.session_state.get("username") == "admin":
+    with st.sidebar.expander("🔁 再実行の計測"):
+        st.caption("このセッションでの実行回数と所要時間（フラグメントは単独で再実行された分のみ）")
+        st.markdown("| 範囲 | 回数 | 直近 | 平均 |\n|---|---:|---:|---:|\n" + "\n".join(
+            f"| {scope} | {entry['runs']:,} | {entry['last_ms']:,.0f} ms | {entry['total_ms'] / entry['runs']:,.0f} ms |"
+            for scope, entry in st.session_state[RERUN_STATS_KEY].items()
+        ))
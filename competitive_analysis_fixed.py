@@ -1,14 +1,12 @@
 # -*- coding: utf-8 -*-
 import streamlit as st
-from openai import OpenAI
-import anthropic
 from datetime import datetime
 import pandas as pd
 import plotly.graph_objects as go
 import json
 import hmac
-import os
-import csv
+from audit_log import LOG_COLUMNS, AuditLog
+from llm_client import LLMClientPool
 
 # ============================================
 # ページ設定（最初に実行）
@@ -23,51 +21,35 @@ st.set_page_config(
 # セキュリティ機能: アクセスログ記録
 # ============================================
 
-def ensure_log_directory():
-    """ログディレクトリの作成"""
-    log_dir = "logs"
-    if not os.path.exists(log_dir):
-        os.makedirs(log_dir)
-    return log_dir
+@st.cache_resource
+def get_audit_log():
+    """アクセスログストア（SQLite・バックグラウンド書き込み、プロセス内で共有）"""
+    return AuditLog("logs/access_log.db", legacy_csv_path="logs/access_log.csv")
 
 def log_access(username, action, details=""):
-    """アクセスログの記録"""
+    """アクセスログの記録（キューに積むだけでディスクI/Oは待たない）"""
     try:
-        log_dir = ensure_log_directory()
-        log_file = os.path.join(log_dir, "access_log.csv")
-        
-        log_entry = {
-            "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-            "username": username,
-            "display_name": st.session_state.get("user_display_name", username),
-            "action": action,
-            "details": details
-        }
-        
-        file_exists = os.path.isfile(log_file)
-        
-        with open(log_file, "a", newline="", encoding="utf-8") as f:
-            writer = csv.DictWriter(f, fieldnames=["timestamp", "username", "display_name", "action", "details"])
-            if not file_exists:
-                writer.writeheader()
-            writer.writerow(log_entry)
-            
+        get_audit_log().log(
+            username,
+            action,
+            details,
+            display_name=st.session_state.get("user_display_name", username)
+        )
     except Exception as e:
         print(f"ログ記録エラー: {e}")
 
-def get_access_logs():
-    """アクセスログの取得"""
-    log_file = os.path.join("logs", "access_log.csv")
-    
-    if os.path.exists(log_file):
-        try:
-            df = pd.read_csv(log_file)
-            return df
-        except Exception as e:
-            st.error(f"ログファイルの読み込みに失敗しました: {e}")
-            return None
-    else:
+def get_access_logs(limit=1000):
+    """アクセスログの取得（新しい順）"""
+    audit_log = get_audit_log()
+    audit_log.flush()
+    try:
+        rows = audit_log.fetch(limit)
+    except Exception as e:
+        st.error(f"ログの読み込みに失敗しました: {e}")
+        return None
+    if not rows:
         return None
+    return pd.DataFrame(rows, columns=list(LOG_COLUMNS))
 
 # ============================================
 # セキュリティ機能: ベーシック認証
@@ -194,6 +176,11 @@ with col_user:
 
 st.markdown("---")
 
+@st.cache_resource
+def get_llm_pool():
+    """プロセス内で共有するLLMクライアント（keep-alive・再試行・サーキットブレーカー）"""
+    return LLMClientPool()
+
 # ============================================
 # AI Provider選択
 # ============================================
@@ -330,12 +317,13 @@ if st.button("▶ 競合分析を実行", type="primary", use_container_width=Tr
         if provider == "Claude (Anthropic)":
             with st.spinner("Claude (Sonnet 4) で分析中... (30-60秒)"):
                 try:
-                    client = anthropic.Anthropic(api_key=api_key)
-                    
-                    message = client.messages.create(
-                        model="claude-sonnet-4-20250514",
-                        max_tokens=4000,
-                        messages=[{"role": "user", "content": full_prompt}]
+                    message = get_llm_pool().call(
+                        provider, "claude-sonnet-4-20250514", api_key,
+                        lambda client: client.messages.create(
+                            model="claude-sonnet-4-20250514",
+                            max_tokens=4000,
+                            messages=[{"role": "user", "content": full_prompt}]
+                        )
                     )
                     
                     result = message.content[0].text
@@ -350,17 +338,18 @@ if st.button("▶ 競合分析を実行", type="primary", use_container_width=Tr
         else:
             with st.spinner("OpenAI (GPT-4o) で分析中... (30-60秒)"):
                 try:
-                    client = OpenAI(api_key=api_key)
-                    
                     # Chat Completions API（正しい方法）
-                    response = client.chat.completions.create(
-                        model="gpt-4o",  # 最新モデル
-                        messages=[
-                            {"role": "system", "content": "あなたはゲーム業界の競合分析専門家です。"},
-                            {"role": "user", "content": full_prompt}
-                        ],
-                        temperature=0.7,
-                        max_tokens=4000
+                    response = get_llm_pool().call(
+                        provider, "gpt-4o", api_key,
+                        lambda client: client.chat.completions.create(
+                            model="gpt-4o",  # 最新モデル
+                            messages=[
+                                {"role": "system", "content": "あなたはゲーム業界の競合分析専門家です。"},
+                                {"role": "user", "content": full_prompt}
+                            ],
+                            temperature=0.7,
+                            max_tokens=4000
+                        )
                     )
                     
                     result = response.choices[0].message.content
@@ -448,7 +437,7 @@ if st.session_state.get("show_logs", False):
     
     logs_df = get_access_logs()
     if logs_df is not None and not logs_df.empty:
-        st.dataframe(logs_df.sort_values('timestamp', ascending=False), use_container_width=True)
+        st.dataframe(logs_df, use_container_width=True)
     else:
         st.info("アクセスログがありません")
     
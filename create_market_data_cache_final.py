@@ -1,11 +1,30 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 """
-テキストファイルから市場データキャッシュを生成（Prompt Caching用）
+PDF・テキストファイルから市場データキャッシュを生成（Prompt Caching用）
+
+PDFはページ単位でプロセスプールにより並列抽出し、抽出結果を
+cache/pdf_pages/ に保存する（再実行時は変更されたファイルのみ処理）。
 """
 
+import argparse
 import os
 import re
+import time
+
+from market_index import DEFAULT_INDEX_DIR, MarketIndex, build_query
+from pdf_extract import PageTextCache, extract_pdf_pages, join_pages
+from token_budget import (
+    TokenCounter,
+    pack_sections,
+    reference_token_count,
+    render_sections,
+    split_sections,
+)
+
+# 市場データに割り当てるトークン数（200Kのうちプロンプト本体・入力・出力の分を残す）
+DEFAULT_TOKEN_BUDGET = 150000
+DEFAULT_CALIBRATION_PATH = "cache/token_calibration.json"
 
 def load_text_file(file_path: str, max_chars: int = None) -> str:
     """
@@ -31,7 +50,7 @@ def load_text_file(file_path: str, max_chars: int = None) -> str:
         text = clean_text(text)
         
         char_count = len(text)
-        token_estimate = char_count // 4
+        token_estimate = TokenCounter().count(text)
         
         print(f"  Loaded: {char_count:,} characters (~{token_estimate:,} tokens)")
         
@@ -41,6 +60,67 @@ def load_text_file(file_path: str, max_chars: int = None) -> str:
         print(f"  Error: {e}")
         return ""
 
+def load_pdf_file(file_path: str, pages: list, max_chars: int = None) -> str:
+    """
+    抽出済みのPDFページテキストを結合
+    
+    Args:
+        file_path: ファイルパス
+        pages: ページごとのテキスト
+        max_chars: 最大文字数（Noneなら全て）
+    
+    Returns:
+        テキスト（各ページの先頭に [p.N] の目印付き）
+    """
+    print(f"Loading: {os.path.basename(file_path)} ({len(pages)} pages)")
+    
+    text = clean_text(join_pages(pages))
+    
+    if max_chars:
+        text = text[:max_chars]
+    
+    char_count = len(text)
+    token_estimate = TokenCounter().count(text)
+    
+    print(f"  Loaded: {char_count:,} characters (~{token_estimate:,} tokens)")
+    
+    return text
+
+def extract_pdfs(paths: list, workers: int = None, cache_dir: str = "cache/pdf_pages") -> dict:
+    """
+    PDFのページテキストを並列抽出（キャッシュ済みのページは再処理しない）
+    
+    Args:
+        paths: PDFファイルパスのリスト
+        workers: プロセス数（Noneなら CPU 数）
+        cache_dir: ページキャッシュの保存先（Noneならキャッシュしない）
+    
+    Returns:
+        {path: [ページテキスト, ...]}
+    """
+    if not paths:
+        return {}
+    
+    print("="*60)
+    print(f"Extracting PDF text: {len(paths)} files")
+    
+    last_reported = {}
+    
+    def on_progress(path, done, total):
+        # 10%刻みで進捗を表示
+        step = done * 10 // max(total, 1)
+        if last_reported.get(path) != step:
+            last_reported[path] = step
+            print(f"  {os.path.basename(path)}: {done:,}/{total:,} pages")
+    
+    cache = PageTextCache(cache_dir) if cache_dir else None
+    pages_by_path, stats = extract_pdf_pages(paths, cache=cache, workers=workers, on_progress=on_progress)
+    
+    print(f"  Pages: {stats['pages']:,} (extracted {stats['extracted']:,} / cached {stats['cached']:,})")
+    print(f"  Time: {stats['seconds']:.1f}s (extraction {stats['pages_per_sec']:.1f} pages/s)")
+    
+    return pages_by_path
+
 def clean_text(text: str) -> str:
     """
     テキストをクリーニング
@@ -56,59 +136,105 @@ def clean_text(text: str) -> str:
     
     return text.strip()
 
-def load_market_data() -> str:
+def load_market_data(workers: int = None, cache_dir: str = "cache/pdf_pages",
+                     token_budget: int = DEFAULT_TOKEN_BUDGET,
+                     calibration_path: str = DEFAULT_CALIBRATION_PATH, calibrate: bool = False,
+                     index_dir: str = DEFAULT_INDEX_DIR) -> str:
     """
-    市場データを読み込んで結合
+    市場データを読み込み、トークン予算に収まるようセクション単位で選んで結合
+    
+    Args:
+        workers: PDF抽出のプロセス数（Noneなら CPU 数）
+        cache_dir: ページキャッシュの保存先（Noneならキャッシュしない）
+        token_budget: 市場データに割り当てるトークン数
+        calibration_path: トークン推定の校正値ファイル
+        calibrate: 実測トークン数で推定の重みを校正して保存するか
+        index_dir: 検索インデックスの保存先（Noneなら構築しない）
     
     Returns:
         結合されたテキスト
     """
-    # Prompt Cachingの制限: 200,000 tokens (約800,000文字)
-    # 安全のため、各ファイル200,000文字までに制限
+    # Prompt Cachingの制限: 200,000 tokens（システムプロンプト・入力・出力の分を残す）
+    # 各資料は途中で切らず、優先度（priority）の高いセクションから予算いっぱいまで選ぶ
     
     files = [
         {
             "path": "/mnt/project/PDF書籍_ファミ通ゲーム白書2025.pdf",
-            "max_chars": 200000,
+            "priority": 1.0,
             "name": "ファミ通ゲーム白書2025"
         },
         {
             "path": "/mnt/project/PDF書籍_ファミ通モバイルゲーム白書2025.pdf",
-            "max_chars": 200000,
+            "priority": 1.0,
             "name": "ファミ通モバイルゲーム白書2025"
         },
         {
             "path": "/mnt/project/JOGAオンラインゲーム市場調査レポート2025.pdf",
-            "max_chars": 150000,
+            "priority": 0.75,
             "name": "JOGAオンラインゲーム市場調査レポート2025"
         }
     ]
     
-    combined_text = ""
-    total_chars = 0
+    pdf_paths = [
+        file_info["path"] for file_info in files
+        if file_info["path"].lower().endswith(".pdf") and os.path.isfile(file_info["path"])
+    ]
+    try:
+        pdf_pages = extract_pdfs(pdf_paths, workers, cache_dir)
+    except Exception as e:
+        print(f"  Error: PDF抽出に失敗しました: {e}")
+        pdf_pages = {}
+    
+    sources = []
     
     for file_info in files:
         print(f"\n{'='*60}")
-        text = load_text_file(file_info["path"], file_info["max_chars"])
+        if file_info["path"] in pdf_pages:
+            text = load_pdf_file(file_info["path"], pdf_pages[file_info["path"]])
+        elif file_info["path"].lower().endswith(".pdf"):
+            print(f"Loading: {os.path.basename(file_info['path'])}")
+            print("  Error: ファイルが見つかりません")
+            text = ""
+        else:
+            text = load_text_file(file_info["path"])
         
         if text:
-            combined_text += f"\n\n【出典: {file_info['name']}】\n{text}"
-            total_chars += len(text)
+            sources.append({"name": file_info["name"], "text": text, "priority": file_info["priority"]})
+    
+    if index_dir and sources:
+        build_market_index(sources, index_dir)
+    
+    counter = TokenCounter.load(calibration_path)
+    if calibrate and sources:
+        counter = calibrate_counter(counter, sources, calibration_path)
+    
+    # トークン予算に合わせてセクションを選択
+    sections, report = pack_sections(sources, token_budget, counter)
+    combined_text = render_sections(sections)
     
     print(f"\n{'='*60}")
-    print(f"Total combined text: {total_chars:,} characters")
-    estimated_tokens = total_chars // 4
-    print(f"Estimated tokens: {estimated_tokens:,} tokens")
+    print(f"Token budget: {report['token_budget']:,} tokens")
+    for name, source_report in report["per_source"].items():
+        print(f"  {name}: {source_report['sections']}/{source_report['total_sections']} sections, "
+              f"{source_report['tokens']:,}/{source_report['total_tokens']:,} tokens")
+    print(f"Total combined text: {len(combined_text):,} characters, "
+          f"{report['sections']}/{report['total_sections']} sections ({report['partial_sections']} partial)")
+    estimated_tokens = report["estimated_tokens"]
+    print(f"Estimated tokens: {estimated_tokens:,} tokens (unused budget: {report['unused_tokens']:,})")
+    
+    # 推定値と実測値（count_tokens API、なければ tiktoken）の比較
+    reference_tokens = reference_token_count(combined_text, api_key=os.environ.get("ANTHROPIC_API_KEY"))
+    if reference_tokens:
+        error = (estimated_tokens - reference_tokens) / reference_tokens
+        print(f"Reference tokens: {reference_tokens:,} tokens (estimate error: {error:+.1%})")
+        estimated_tokens = max(estimated_tokens, reference_tokens)
     
     # Prompt Cachingの制限チェック
     TOKEN_LIMIT = 200000
     
     if estimated_tokens > TOKEN_LIMIT:
         print(f"\n⚠️  WARNING: Estimated tokens ({estimated_tokens:,}) exceeds limit ({TOKEN_LIMIT:,})")
-        print("   Recommend: Reduce max_chars in this script")
-        excess = estimated_tokens - TOKEN_LIMIT
-        reduction_needed = excess * 4
-        print(f"   Need to reduce: ~{reduction_needed:,} characters")
+        print("   Recommend: Reduce --token-budget")
     elif estimated_tokens > TOKEN_LIMIT * 0.9:
         print(f"\n⚠️  CAUTION: Estimated tokens ({estimated_tokens:,}) is close to limit ({TOKEN_LIMIT:,})")
     else:
@@ -116,7 +242,72 @@ def load_market_data() -> str:
     
     return combined_text
 
-def save_market_data(output_path: str = "/home/claude/market_data_cache.txt"):
+def build_market_index(sources: list, index_dir: str = DEFAULT_INDEX_DIR) -> MarketIndex:
+    """
+    全資料から検索インデックス（文字n-gram BM25）を構築して保存
+    
+    分析時はこのインデックスから関連パッセージだけをプロンプトに含める。
+    """
+    print(f"\n{'='*60}")
+    print("Building market index...")
+    
+    started = time.perf_counter()
+    index = MarketIndex.build(sources)
+    index.save(index_dir)
+    build_seconds = time.perf_counter() - started
+    
+    print(f"  Passages: {len(index.passages):,}, terms: {len(index.vocabulary):,}")
+    print(f"  Build time: {build_seconds:.1f}s")
+    
+    # アプリ側と同じく保存済みのインデックス（チャンクストアをmmap）で確認
+    index = MarketIndex.load(index_dir)
+    print(f"  Chunk store: {len(index.store):,} unique chunks, {index.store.nbytes / 1024:.1f} KB")
+    
+    # 検索速度の確認（代表的なクエリ）
+    sample_inputs = {"competitor_name": "モンスターストライク", "competitor_genre": "RPG",
+                     "comparison_focus": ["市場ポジション", "収益性"]}
+    started = time.perf_counter()
+    hits = index.search(build_query(sample_inputs), k=8)
+    search_ms = (time.perf_counter() - started) * 1000
+    print(f"  Sample search: {len(hits)} hits in {search_ms:.1f}ms")
+    print(f"  Saved: {index_dir}")
+    
+    return index
+
+def calibrate_counter(counter: TokenCounter, sources: list, calibration_path: str,
+                      samples_per_source: int = 8) -> TokenCounter:
+    """
+    各資料から満遍なく選んだセクションの実測トークン数で推定の重みを校正
+    
+    Returns:
+        校正後のTokenCounter（実測値が取れなければ元のまま）
+    """
+    print(f"\n{'='*60}")
+    print("Calibrating token counter...")
+    
+    samples = []
+    for source in sources:
+        parts = split_sections(source["text"], counter=counter)
+        step = max(1, len(parts) // samples_per_source)
+        for _, body, _ in parts[::step][:samples_per_source]:
+            actual = reference_token_count(body, api_key=os.environ.get("ANTHROPIC_API_KEY"))
+            if actual is None:
+                print("  Skipped: 実測トークン数を取得できません（ANTHROPIC_API_KEY または tiktoken が必要）")
+                return counter
+            samples.append((body, actual))
+    
+    calibrated = counter.calibrate(samples)
+    calibrated.save(calibration_path)
+    before = sum(abs(counter.count(text) - actual) for text, actual in samples) / sum(a for _, a in samples)
+    after = sum(abs(calibrated.count(text) - actual) for text, actual in samples) / sum(a for _, a in samples)
+    print(f"  Samples: {len(samples)} sections, error {before:.1%} -> {after:.1%}")
+    print(f"  Saved: {calibration_path}")
+    return calibrated
+
+def save_market_data(output_path: str = "/home/claude/market_data_cache.txt", workers: int = None,
+                     cache_dir: str = "cache/pdf_pages", token_budget: int = DEFAULT_TOKEN_BUDGET,
+                     calibration_path: str = DEFAULT_CALIBRATION_PATH, calibrate: bool = False,
+                     index_dir: str = DEFAULT_INDEX_DIR):
     """
     市場データをファイルに保存
     """
@@ -124,7 +315,7 @@ def save_market_data(output_path: str = "/home/claude/market_data_cache.txt"):
     print("Generating market data cache for Prompt Caching...")
     print("="*60)
     
-    market_data = load_market_data()
+    market_data = load_market_data(workers, cache_dir, token_budget, calibration_path, calibrate, index_dir)
     
     with open(output_path, 'w', encoding='utf-8') as f:
         f.write(market_data)
@@ -139,13 +330,31 @@ def save_market_data(output_path: str = "/home/claude/market_data_cache.txt"):
     return output_path
 
 if __name__ == "__main__":
-    # 市場データキャッシュを生成
-    cache_file = save_market_data()
+    parser = argparse.ArgumentParser(description="PDF・テキストファイルから市場データキャッシュを生成")
+    parser.add_argument("--output", default="/home/claude/market_data_cache.txt", help="出力ファイル")
+    parser.add_argument("--workers", type=int, default=None, help="PDF抽出のプロセス数（デフォルト: CPU数）")
+    parser.add_argument("--cache-dir", default="cache/pdf_pages", help="ページ単位の抽出キャッシュの保存先")
+    parser.add_argument("--no-cache", action="store_true", help="抽出キャッシュを使わずに全ページを処理")
+    parser.add_argument("--token-budget", type=int, default=DEFAULT_TOKEN_BUDGET,
+                        help=f"市場データのトークン予算（デフォルト: {DEFAULT_TOKEN_BUDGET:,}）")
+    parser.add_argument("--calibration", default=DEFAULT_CALIBRATION_PATH, help="トークン推定の校正値ファイル")
+    parser.add_argument("--calibrate", action="store_true",
+                        help="実測トークン数（ANTHROPIC_API_KEY の count_tokens API、なければ tiktoken）で推定を校正")
+    parser.add_argument("--index-dir", default=DEFAULT_INDEX_DIR, help="検索インデックスの保存先")
+    parser.add_argument("--no-index", action="store_true", help="検索インデックスを構築しない")
+    args = parser.parse_args()
+    
+    # 市場データキャッシュと検索インデックスを生成
+    cache_file = save_market_data(
+        args.output, args.workers, None if args.no_cache else args.cache_dir,
+        args.token_budget, args.calibration, args.calibrate,
+        None if args.no_index else args.index_dir
+    )
     
     print("\n✅ Market data cache created successfully!")
     print(f"\n📁 Cache file: {cache_file}")
     print("\nNext steps:")
     print("1. Review the cache file content")
-    print("2. If too large, adjust max_chars in this script")
+    print("2. If too large, lower --token-budget")
     print("3. Integrate into competitive_analysis_dual_full.py")
     print("4. Deploy and test!")
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+重いライブラリの遅延インポートとインポート時間の記録
+
+Streamlitはログイン画面も含めて操作のたびにスクリプトを再実行するため、先頭で
+anthropic・openai・pandas・plotly・numpy などを読み込むとコールドスタート（初回表示）が遅くなる。
+lazy_module() は属性に最初にアクセスした時点で読み込むモジュールの代理を返し、
+読み込みにかかった時間をプロセス内で記録する（管理者画面の起動時間レポートで表示）。
+
+    pd = lazy_module("pandas")   # ここでは読み込まない
+    pd.DataFrame(...)            # 最初の使用時に読み込み・計測
+
+コマンドラインから実行すると、各モジュールを新しいプロセスで読み込んだ時間（コールドスタート時の内訳）を表示する:
+    python lazy_imports.py [モジュール名 ...]
+"""
+
+import importlib
+import subprocess
+import sys
+import threading
+import time
+
+# このモジュールの読み込み時刻（プロセス起動直後の目安）
+PROCESS_STARTED = time.perf_counter()
+
+# コマンドラインの既定の計測対象（アプリが使う重い依存）
+HEAVY_MODULES = ("streamlit", "anthropic", "openai", "pandas", "plotly.graph_objects", "numpy", "pypdf")
+
+_records = {}
+_lock = threading.Lock()
+
+
+def import_module(name, trigger="使用時"):
+    """モジュールを読み込み、このプロセスで初めて読み込んだ場合は所要時間を記録"""
+    if name in sys.modules:
+        # 別スレッドが読み込み中の場合は import_module が完了を待つ
+        return importlib.import_module(name)
+    started = time.perf_counter()
+    module = importlib.import_module(name)
+    finished = time.perf_counter()
+    with _lock:
+        _records.setdefault(name, {
+            "module": name,
+            "ms": (finished - started) * 1000,
+            "at_ms": (started - PROCESS_STARTED) * 1000,
+            "trigger": trigger,
+        })
+    return module
+
+
+class LazyModule:
+    """
+    属性への最初のアクセスで読み込むモジュールの代理
+
+    requires のモジュールは本体より先に import_module で読み込む。本体が sys.modules の
+    モジュールを直接参照する場合（plotly は pandas を参照する）、先読みスレッドが
+    読み込み中の不完全なモジュールを使わないよう、完了を待ってから本体を使う。
+    """
+
+    def __init__(self, name, requires=()):
+        self._name = name
+        self._requires = tuple(requires)
+        self._module = None
+
+    def _load(self):
+        if self._module is None:
+            for name in self._requires:
+                import_module(name)
+            self._module = import_module(self._name)
+        return self._module
+
+    @property
+    def is_loaded(self):
+        return self._module is not None or self._name in sys.modules
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __repr__(self):
+        state = "loaded" if self.is_loaded else "not loaded"
+        return f"<LazyModule {self._name} ({state})>"
+
+
+def lazy_module(name, requires=()):
+    return LazyModule(name, requires)
+
+
+def preload(*names):
+    """
+    バックグラウンドスレッドで先に読み込む（次の操作で必要になることが分かっている場合）
+
+    使用時に読み込み中であれば、Pythonのインポートロックにより完了を待ってから使われる。
+    """
+    missing = [name for name in names if name not in sys.modules]
+    if not missing:
+        return None
+
+    def run():
+        for name in missing:
+            try:
+                import_module(name, trigger="先読み")
+            except ImportError as e:
+                print(f"先読みに失敗しました: {name}: {e}")
+
+    thread = threading.Thread(target=run, name="lazy-preload", daemon=True)
+    thread.start()
+    return thread
+
+
+def import_report():
+    """このプロセスで遅延インポートしたモジュールと所要時間（読み込んだ順）"""
+    with _lock:
+        return sorted(_records.values(), key=lambda record: record["at_ms"])
+
+
+def measure_cold_import(name):
+    """新しいPythonプロセスで name を読み込む時間（ミリ秒、失敗したらNone）"""
+    code = (
+        "import time, importlib; t = time.perf_counter(); "
+        f"importlib.import_module({name!r}); print((time.perf_counter() - t) * 1000)"
+    )
+    completed = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True)
+    if completed.returncode != 0:
+        return None
+    return float(completed.stdout.strip().splitlines()[-1])
+
+
+def main():
+    names = sys.argv[1:] or HEAVY_MODULES
+    print("コールドスタート時のインポート時間（新しいプロセスで1つずつ計測、依存ライブラリの読み込みを含む）")
+    results = [(name, measure_cold_import(name)) for name in names]
+    for name, ms in sorted(results, key=lambda item: -(item[1] or 0)):
+        print(f"  {name:<24} {'読み込み失敗' if ms is None else f'{ms:8.0f} ms'}")
+
+
+if __name__ == "__main__":
+    main()
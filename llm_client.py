@@ -0,0 +1,596 @@
+# -*- coding: utf-8 -*-
+"""
+LLMクライアント共通レイヤー
+
+- Provider・APIキーごとにクライアントを1つだけ作り、HTTPのkeep-aliveコネクションを再利用する
+- 1回の呼び出し全体に期限（deadline）を設け、各試行のタイムアウトを残り時間に合わせる
+- 429 / 529 / 5xx / 接続エラーは Retry-After を尊重したジッター付き指数バックオフで再試行
+- Provider・モデルごとのサーキットブレーカーで、連続失敗中は即座にエラーを返す
+- limiter（rate_limiter.RateLimiter）を渡すと、各試行の送信前にRPM・TPMの枠を予約して待つ
+
+Streamlitアプリでは st.cache_resource でプロセス内に1つだけ生成して共有する。
+"""
+
+import asyncio
+import concurrent.futures
+import contextvars
+import email.utils
+import queue
+import random
+import threading
+import time
+
+from analysis_prompt import CLAUDE_PROVIDER
+from lazy_imports import lazy_module
+from rate_limiter import usage_tokens
+
+# SDKは選択されたProviderのクライアントを最初に作るときに読み込む（ログイン画面では読み込まない）
+anthropic = lazy_module("anthropic")
+openai = lazy_module("openai")
+
+
+def sdk_module_name(provider):
+    """Providerが使うSDKのモジュール名（先読み用）"""
+    return "anthropic" if provider == CLAUDE_PROVIDER else "openai"
+
+
+# 再試行対象のHTTPステータス（529: Anthropic overloaded）
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504, 529}
+
+
+class CircuitOpenError(Exception):
+    """サーキットブレーカーが開いている（連続失敗中のため呼び出しを停止中）"""
+
+    def __init__(self, key, retry_in):
+        self.key = key
+        self.retry_in = retry_in
+        super().__init__(f"{key[0]} / {key[1]} は連続エラーのため一時停止中です（約{retry_in:.0f}秒後に再開）")
+
+
+class DeadlineExceededError(Exception):
+    """呼び出し全体の期限を超えた"""
+
+
+class RetryPolicy:
+    """再試行・タイムアウトの設定"""
+
+    def __init__(self, max_attempts=4, base_delay=1.0, max_delay=30.0, deadline=300.0, connect_timeout=10.0):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.connect_timeout = connect_timeout
+
+    def backoff(self, attempt, retry_after=None):
+        """
+        次の試行までの待ち時間（秒）
+
+        Full Jitter方式の指数バックオフ。Retry-Afterがあればそれより短くしない。
+        """
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+
+class CircuitBreaker:
+    """
+    Provider・モデル単位のサーキットブレーカー
+
+    closed: 通常 / open: failure_threshold回連続失敗でreset_timeout秒停止 /
+    half_open: 停止明けに1件だけ試し、成功でclosed、失敗で再びopen
+    （試した1件が結果を出さずに終わった場合は release_probe で枠を開放する）
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=60.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def before_call(self, key):
+        with self._lock:
+            if self.state == "open":
+                elapsed = time.monotonic() - self.opened_at
+                if elapsed < self.reset_timeout:
+                    raise CircuitOpenError(key, self.reset_timeout - elapsed)
+                self.state = "half_open"
+            elif self.state == "half_open":
+                # 試行中の1件の結果が出るまで他は通さない
+                raise CircuitOpenError(key, self.reset_timeout)
+
+    def record_success(self):
+        with self._lock:
+            self.state = "closed"
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                self.state = "open"
+                self.opened_at = time.monotonic()
+
+    def release_probe(self, request_sent=True):
+        """
+        成功・失敗を記録せずに試行を終えたとき（キャンセル等）に half_open の試行枠を開放する
+
+        送信後に打ち切った場合はProviderの状態が分からないため停止時間を数え直し、
+        送信前に終えた場合は停止明けのまま（次の呼び出しが改めて試す）にする。
+        """
+        with self._lock:
+            if self.state == "half_open":
+                self.state = "open"
+                if request_sent:
+                    self.opened_at = time.monotonic()
+
+
+def error_status_code(exc):
+    """SDKの例外からHTTPステータスを取り出す（なければNone）"""
+    return getattr(exc, "status_code", None)
+
+
+def is_retryable(exc):
+    """再試行すべきエラーか（レート制限・過負荷・5xx・接続エラー）"""
+    status = error_status_code(exc)
+    if status is not None:
+        return status in RETRYABLE_STATUS_CODES
+    # APIConnectionError / APITimeoutError（anthropic・openai共通の名前）
+    return any(cls.__name__ == "APIConnectionError" for cls in type(exc).__mro__)
+
+
+def retry_after_seconds(exc):
+    """レスポンスヘッダのRetry-After（秒またはHTTP日付）を秒で返す"""
+    response = getattr(exc, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+
+    retry_after_ms = headers.get("retry-after-ms")
+    if retry_after_ms:
+        try:
+            return float(retry_after_ms) / 1000
+        except ValueError:
+            pass
+
+    retry_after = headers.get("retry-after")
+    if not retry_after:
+        return None
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(retry_after)
+        return max(0.0, retry_at.timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+# ============================================
+# ストリーミング応答のテキスト断片化
+# ============================================
+
+def stream_claude(client, request_kwargs, usage_holder):
+    """Claude APIのストリーミング応答をテキスト断片として返す（usageはusage_holderに格納）"""
+    with client.messages.stream(**request_kwargs) as stream:
+        for text in stream.text_stream:
+            yield text
+        usage_holder["usage"] = stream.get_final_message().usage
+
+
+def stream_openai(client, request_kwargs, usage_holder):
+    """OpenAI APIのストリーミング応答をテキスト断片として返す（usageはusage_holderに格納）"""
+    stream = client.chat.completions.create(
+        stream=True,
+        stream_options={"include_usage": True},
+        **request_kwargs
+    )
+    try:
+        for chunk in stream:
+            if chunk.usage:
+                usage_holder["usage"] = chunk.usage
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+    finally:
+        # 途中で打ち切られた場合もHTTP接続を解放する
+        stream.close()
+
+
+def stream_text(client, provider, request_kwargs, usage_holder):
+    """Providerに応じたストリーミング応答のテキスト断片"""
+    if provider == CLAUDE_PROVIDER:
+        return stream_claude(client, request_kwargs, usage_holder)
+    return stream_openai(client, request_kwargs, usage_holder)
+
+
+async def stream_claude_async(client, request_kwargs, usage_holder):
+    """stream_claude の非同期版（client は非同期クライアント）"""
+    async with client.messages.stream(**request_kwargs) as stream:
+        async for text in stream.text_stream:
+            yield text
+        usage_holder["usage"] = (await stream.get_final_message()).usage
+
+
+async def stream_openai_async(client, request_kwargs, usage_holder):
+    """stream_openai の非同期版（client は非同期クライアント）"""
+    stream = await client.chat.completions.create(
+        stream=True,
+        stream_options={"include_usage": True},
+        **request_kwargs
+    )
+    try:
+        async for chunk in stream:
+            if chunk.usage:
+                usage_holder["usage"] = chunk.usage
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+    finally:
+        await stream.close()
+
+
+def stream_text_async(client, provider, request_kwargs, usage_holder):
+    """stream_text の非同期版"""
+    if provider == CLAUDE_PROVIDER:
+        return stream_claude_async(client, request_kwargs, usage_holder)
+    return stream_openai_async(client, request_kwargs, usage_holder)
+
+
+class LLMClientPool:
+    """
+    プロセス内で共有するLLMクライアント群
+
+    同期クライアントは呼び出し元スレッドで、非同期クライアントは専用のイベントループ
+    スレッド上で使う（非同期のコネクションプールはイベントループに紐づくため）。
+    """
+
+    def __init__(self, policy=None, failure_threshold=5, reset_timeout=60.0, base_urls=None, limiter=None):
+        self.policy = policy or RetryPolicy()
+        self.limiter = limiter
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.base_urls = base_urls or {}
+        self._clients = {}
+        self._breakers = {}
+        self._lock = threading.Lock()
+        self._loop = None
+
+    # ---------- クライアント ----------
+
+    def _timeout(self, provider):
+        if provider == CLAUDE_PROVIDER:
+            return anthropic.Timeout(self.policy.deadline, connect=self.policy.connect_timeout)
+        return openai.Timeout(self.policy.deadline, connect=self.policy.connect_timeout)
+
+    def client(self, provider, api_key, is_async=False):
+        """Provider・APIキーごとのクライアント（SDK側の再試行は無効にしてこのレイヤーで制御）"""
+        key = (provider, api_key, is_async)
+        with self._lock:
+            if key not in self._clients:
+                options = {
+                    "api_key": api_key,
+                    "base_url": self.base_urls.get(provider),
+                    "timeout": self._timeout(provider),
+                    "max_retries": 0,
+                }
+                if provider == CLAUDE_PROVIDER:
+                    client_class = anthropic.AsyncAnthropic if is_async else anthropic.Anthropic
+                else:
+                    client_class = openai.AsyncOpenAI if is_async else openai.OpenAI
+                self._clients[key] = client_class(**options)
+            return self._clients[key]
+
+    def async_client(self, provider, api_key):
+        """非同期クライアント（run_async で実行するコルーチン内でのみ使用）"""
+        return self.client(provider, api_key, is_async=True)
+
+    def breaker(self, provider, model):
+        key = (provider, model)
+        with self._lock:
+            if key not in self._breakers:
+                self._breakers[key] = CircuitBreaker(self.failure_threshold, self.reset_timeout)
+            return self._breakers[key]
+
+    def breaker_states(self):
+        """管理画面向け: Provider・モデルごとのブレーカー状態"""
+        with self._lock:
+            return {key: (breaker.state, breaker.failures) for key, breaker in self._breakers.items()}
+
+    # ---------- レート制限 ----------
+
+    def _reserve(self, provider, model, tokens, deadline, deadline_at):
+        """
+        1回の送信分の枠を予約（limiterがなければNone）
+
+        枠が空くまでの待ちが期限を超える場合は、予約を取り消して DeadlineExceededError。
+        """
+        if self.limiter is None:
+            return None
+        reservation = self.limiter.reserve(provider, model, tokens)
+        if time.monotonic() + reservation.wait >= deadline_at:
+            reservation.cancel()
+            raise DeadlineExceededError(
+                f"{provider} / {model}: レート制限の待ち（約{reservation.wait:.0f}秒）が期限（{deadline:.0f}秒）を超えます"
+            )
+        return reservation
+
+    # ---------- 同期呼び出し ----------
+
+    def call(self, provider, model, api_key, fn, deadline=None, tokens=0):
+        """
+        fn(client) を再試行・期限・ブレーカー付きで実行
+
+        Args:
+            provider: AI Provider名
+            model: モデル名（ブレーカーの単位）
+            api_key: APIキー
+            fn: クライアントを受け取ってAPIを呼ぶ関数
+            deadline: 全試行を通した期限（秒、省略時はpolicy.deadline）
+            tokens: レート制限で計量する推定トークン数（rate_limiter.estimate_request_tokens）
+
+        Returns:
+            fn の戻り値
+        """
+        result, reservation = self._run_with_retry(provider, model, api_key, deadline, fn, tokens)
+        if reservation is not None:
+            reservation.settle(usage_tokens(result))
+        return result
+
+    def stream(self, provider, model, api_key, make_iter, deadline=None, tokens=0, usage_holder=None):
+        """
+        make_iter(client) が返すテキスト断片のイテレータを再試行付きで返す
+
+        最初の断片を受け取るまでのエラーのみ再試行する（途中まで表示した応答は再送しない）。
+        usage_holder（make_iter が usage を格納する dict）を渡すと、受信完了後に実際のトークン数で
+        レート制限の推定を補正する。
+        """
+        breaker = self.breaker(provider, model)
+
+        def open_stream(client):
+            iterator = iter(make_iter(client))
+            try:
+                first = next(iterator)
+            except StopIteration:
+                first = None
+            return first, iterator
+
+        (first, iterator), reservation = self._run_with_retry(provider, model, api_key, deadline, open_stream, tokens)
+        if first is not None:
+            yield first
+            try:
+                yield from iterator
+            except Exception as e:
+                if is_retryable(e):
+                    breaker.record_failure()
+                raise
+        if reservation is not None and usage_holder is not None:
+            reservation.settle(usage_tokens(usage_holder.get("usage")))
+
+    def _run_with_retry(self, provider, model, api_key, deadline, attempt_fn, tokens=0):
+        """
+        再試行ループ本体。attempt_fn(client) が成功するまで繰り返す
+
+        Returns:
+            (attempt_fn の戻り値, 成功した試行のレート制限の予約 or None)
+        """
+        breaker = self.breaker(provider, model)
+        breaker_key = (provider, model)
+        deadline = deadline or self.policy.deadline
+        deadline_at = time.monotonic() + deadline
+        base_client = self.client(provider, api_key)
+
+        for attempt in range(self.policy.max_attempts):
+            breaker.before_call(breaker_key)
+            try:
+                remaining = deadline_at - time.monotonic()
+                if remaining <= 0:
+                    raise DeadlineExceededError(f"{provider} / {model}: 期限（{deadline:.0f}秒）を超えました")
+
+                reservation = self._reserve(provider, model, tokens, deadline, deadline_at)
+                if reservation is not None:
+                    reservation.sleep()
+                    remaining = deadline_at - time.monotonic()
+            except BaseException:
+                # 期限切れ・レート制限の待ちの中止で送信せずに終えた（half_open の試行枠を戻す）
+                breaker.release_probe(request_sent=False)
+                raise
+
+            try:
+                result = attempt_fn(base_client.with_options(timeout=remaining))
+            except Exception as e:
+                if not is_retryable(e):
+                    # 4xx等は呼び出し側の問題でProviderは応答しているため、ブレーカーの失敗に数えない
+                    breaker.record_success()
+                    raise
+                breaker.record_failure()
+                if attempt == self.policy.max_attempts - 1:
+                    raise
+                delay = self.policy.backoff(attempt, retry_after_seconds(e))
+                if time.monotonic() + delay >= deadline_at:
+                    raise
+                print(f"LLM再試行 ({provider} / {model}): {attempt + 1}回目失敗 {e} → {delay:.1f}秒後")
+                time.sleep(delay)
+                continue
+            except BaseException:
+                # KeyboardInterrupt 等で結果が出ないまま終えた
+                breaker.release_probe()
+                raise
+
+            breaker.record_success()
+            return result, reservation
+
+    # ---------- 非同期呼び出し ----------
+
+    def _ensure_loop(self):
+        """非同期クライアント用のイベントループスレッドを起動"""
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever, name="llm-client-loop", daemon=True).start()
+            return self._loop
+
+    def submit_async(self, coro):
+        """
+        コルーチンを共有イベントループで開始し、完了を待たずに concurrent.futures.Future を返す
+
+        Future.cancel() でタスクをキャンセルでき、応答待ちのリクエストもその場で打ち切られる。
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self._ensure_loop())
+
+    def run_async(self, coro, on_event=None, poll_interval=0.1):
+        """
+        コルーチンを共有イベントループで実行し、完了まで待つ
+
+        コルーチン内で post_event(...) された値は、呼び出し元スレッドで on_event に渡される
+        （Streamlitの描画は呼び出し元のスクリプトスレッドでしか行えないため）。
+        """
+        events = queue.Queue()
+        future = self.submit_async(_with_event_queue(coro, events))
+
+        def drain():
+            while True:
+                try:
+                    event = events.get_nowait()
+                except queue.Empty:
+                    return
+                if on_event:
+                    on_event(*event)
+
+        try:
+            while True:
+                try:
+                    result = future.result(timeout=poll_interval)
+                    break
+                except concurrent.futures.TimeoutError:
+                    drain()
+        except BaseException:
+            future.cancel()
+            raise
+        drain()
+        return result
+
+    async def call_async(self, provider, model, fn, deadline=None, tokens=0):
+        """
+        非同期版の call（fn() は試行ごとに新しいコルーチンを返す関数）
+
+        レート制限の待ちは asyncio.sleep で行う（待っている間も他のタスクは進む）。
+        """
+        result, reservation = await self._run_async_with_retry(provider, model, fn, deadline, tokens)
+        if reservation is not None:
+            reservation.settle(usage_tokens(result))
+        return result
+
+    async def stream_async(self, provider, model, api_key, make_iter, deadline=None, tokens=0, usage_holder=None):
+        """
+        非同期版の stream（make_iter(client) は非同期クライアントを受け取り、非同期イテレータを返す）
+
+        最初の断片を受け取るまでのエラーのみ再試行する。実行中のタスクをキャンセルすると、
+        応答待ちのリクエストもその場で打ち切られる。
+        """
+        breaker = self.breaker(provider, model)
+        client = self.async_client(provider, api_key)
+
+        async def open_stream():
+            iterator = make_iter(client)
+            try:
+                first = await anext(iterator)
+            except StopAsyncIteration:
+                first = None
+            except BaseException:
+                await iterator.aclose()
+                raise
+            return first, iterator
+
+        (first, iterator), reservation = await self._run_async_with_retry(provider, model, open_stream, deadline, tokens)
+        try:
+            if first is not None:
+                yield first
+                try:
+                    async for chunk in iterator:
+                        yield chunk
+                except Exception as e:
+                    if is_retryable(e):
+                        breaker.record_failure()
+                    raise
+        finally:
+            # 打ち切り時もHTTP接続を解放
+            await iterator.aclose()
+        if reservation is not None and usage_holder is not None:
+            reservation.settle(usage_tokens(usage_holder.get("usage")))
+
+    async def _run_async_with_retry(self, provider, model, fn, deadline, tokens=0):
+        """
+        非同期版の再試行ループ本体。fn() が成功するまで繰り返す
+
+        Returns:
+            (fn() の戻り値, 成功した試行のレート制限の予約 or None)
+        """
+        breaker = self.breaker(provider, model)
+        breaker_key = (provider, model)
+        deadline = deadline or self.policy.deadline
+        deadline_at = time.monotonic() + deadline
+
+        for attempt in range(self.policy.max_attempts):
+            breaker.before_call(breaker_key)
+            try:
+                remaining = deadline_at - time.monotonic()
+                if remaining <= 0:
+                    raise DeadlineExceededError(f"{provider} / {model}: 期限（{deadline:.0f}秒）を超えました")
+
+                reservation = self._reserve(provider, model, tokens, deadline, deadline_at)
+                if reservation is not None and reservation.wait > 0:
+                    try:
+                        await asyncio.sleep(reservation.wait)
+                    except asyncio.CancelledError:
+                        # 送信前にキャンセルされた（ヘッジ・要約の中止等）ので枠を戻す
+                        reservation.cancel()
+                        raise
+                    remaining = deadline_at - time.monotonic()
+            except BaseException:
+                # 期限切れ・送信前のキャンセルで送信せずに終えた（half_open の試行枠を戻す）
+                breaker.release_probe(request_sent=False)
+                raise
+
+            try:
+                result = await asyncio.wait_for(fn(), timeout=remaining)
+            except asyncio.TimeoutError:
+                breaker.record_failure()
+                raise DeadlineExceededError(f"{provider} / {model}: 期限（{deadline:.0f}秒）を超えました")
+            except Exception as e:
+                if not is_retryable(e):
+                    # 4xx等は呼び出し側の問題でProviderは応答しているため、ブレーカーの失敗に数えない
+                    breaker.record_success()
+                    raise
+                breaker.record_failure()
+                if attempt == self.policy.max_attempts - 1:
+                    raise
+                delay = self.policy.backoff(attempt, retry_after_seconds(e))
+                if time.monotonic() + delay >= deadline_at:
+                    raise
+                await asyncio.sleep(delay)
+                continue
+            except BaseException:
+                # 兄弟タスクの失敗・ジョブの中止によるキャンセル（CancelledError）で結果が出ないまま終えた
+                breaker.release_probe()
+                raise
+
+            breaker.record_success()
+            return result, reservation
+
+
+# run_async 実行中のコルーチン（と子タスク）から呼び出し元スレッドへ値を渡すキュー
+_event_queue = contextvars.ContextVar("llm_event_queue", default=None)
+
+
+async def _with_event_queue(coro, events):
+    _event_queue.set(events)
+    return await coro
+
+
+def post_event(*event):
+    """run_async で実行中のコルーチンから、呼び出し元スレッドのon_eventへ値を渡す"""
+    events = _event_queue.get()
+    if events is not None:
+        events.put(event)
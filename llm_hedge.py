@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+ヘッジリクエスト（速い方を採用）とProvider間の自動フェイルオーバー
+
+プライマリに送信し、hedge_after 秒以内に最初のトークンが届かなければ
+セカンダリ（もう一方のProvider）にも同じ分析を送信する。
+プライマリが最初のトークン前にエラー（過負荷・サーキットブレーカー等）になった場合は
+待たずにセカンダリへ切り替える。プライマリの最初のトークンが期限内に届けば、その後の生成に
+時間がかかってもセカンダリには送信しない。
+
+各候補は LLMClientPool の共有イベントループ上のタスクとして実行し、採用しなかった方はタスクを
+キャンセルして打ち切る（応答待ちで最初のトークンがまだ届いていないリクエストも中断する）。
+
+- stream(): 最初のトークンを返した方を採用してそのままストリーミング表示
+- complete(): 妥当な出力（is_valid）を最後まで返した最初の方を採用
+"""
+
+import queue
+import time
+
+from llm_client import stream_text_async
+from rate_limiter import estimate_request_tokens
+
+
+def default_is_valid(text):
+    """分析レポートとして妥当な出力か（エグゼクティブサマリーの見出しを含む）"""
+    return bool(text) and "EXECUTIVE_SUMMARY" in text
+
+
+class HedgeCandidate:
+    """ヘッジ対象の1リクエスト（Provider・モデル・リクエスト引数）"""
+
+    def __init__(self, provider, model, api_key, request_kwargs):
+        self.provider = provider
+        self.model = model
+        self.api_key = api_key
+        self.request_kwargs = request_kwargs
+        self.usage_holder = {}
+        self.first_token_at = None
+        self.error = None
+
+    @property
+    def usage(self):
+        return self.usage_holder.get("usage")
+
+
+class HedgedRequest:
+    """
+    プライマリ→（遅延時）セカンダリの順に送信し、速い方を採用する
+
+    Attributes:
+        winner: 採用したHedgeCandidate（決定前はNone）
+        hedged: セカンダリを送信したか
+    """
+
+    def __init__(self, pool, primary, secondary, hedge_after=8.0, is_valid=default_is_valid):
+        self.pool = pool
+        self.candidates = [primary, secondary]
+        self.hedge_after = hedge_after
+        self.is_valid = is_valid
+        self.winner = None
+        self.hedged = False
+        self.started_at = None
+        self._events = queue.Queue()
+        self._futures = [None, None]
+
+    # ---------- ワーカー ----------
+
+    def _start(self, index):
+        if self._futures[index] is not None:
+            return
+        if index == 1:
+            self.hedged = True
+        self._futures[index] = self.pool.submit_async(self._worker(index))
+
+    async def _worker(self, index):
+        """1候補のストリームを読み、断片・完了・エラーをキューに流す（キャンセルされたら何も流さない）"""
+        candidate = self.candidates[index]
+        chunks = self.pool.stream_async(
+            candidate.provider, candidate.model, candidate.api_key,
+            lambda client: stream_text_async(client, candidate.provider, candidate.request_kwargs,
+                                             candidate.usage_holder),
+            tokens=estimate_request_tokens(candidate.request_kwargs),
+            usage_holder=candidate.usage_holder
+        )
+        try:
+            async for chunk in chunks:
+                if candidate.first_token_at is None:
+                    candidate.first_token_at = time.monotonic()
+                self._events.put((index, "chunk", chunk))
+            self._events.put((index, "done", None))
+        except Exception as e:
+            candidate.error = e
+            self._events.put((index, "error", e))
+        finally:
+            # 打ち切り時もHTTP接続を解放
+            await chunks.aclose()
+
+    def _cancel_except(self, keep_index=None):
+        """keep_index 以外の候補のタスクをキャンセル（送信中のリクエストも打ち切る）"""
+        for index, future in enumerate(self._futures):
+            if index != keep_index and future is not None:
+                future.cancel()
+
+    def _next_event(self, deadline_for_hedge):
+        """
+        次のイベントを待つ
+
+        プライマリの最初のトークンが届かないままヘッジ期限を過ぎたらセカンダリを起動する
+        （最初のトークンが届いた後は期限なしで待つ）。
+        """
+        primary = self.candidates[0]
+        while True:
+            timeout = None
+            if self._futures[1] is None and primary.first_token_at is None:
+                timeout = max(0.0, deadline_for_hedge - time.monotonic())
+            try:
+                return self._events.get(timeout=timeout)
+            except queue.Empty:
+                if primary.first_token_at is None:
+                    self._start(1)
+
+    def _raise_all_failed(self):
+        errors = [f"{c.provider}: {c.error}" for c in self.candidates if c.error is not None]
+        raise RuntimeError("すべてのProviderで失敗しました（" + " / ".join(errors) + "）")
+
+    # ---------- 公開API ----------
+
+    def stream(self):
+        """最初のトークンを返した候補を採用し、そのテキスト断片を返す"""
+        self.started_at = time.monotonic()
+        hedge_deadline = self.started_at + self.hedge_after
+        self._start(0)
+        failed = set()
+
+        try:
+            while self.winner is None:
+                index, kind, payload = self._next_event(hedge_deadline)
+                if kind == "chunk":
+                    self.winner = self.candidates[index]
+                    self._cancel_except(index)
+                    yield payload
+                elif kind == "error" or kind == "done":
+                    # 最初のトークン前に終了した候補は失格、もう一方へフェイルオーバー
+                    failed.add(index)
+                    self._start(1)
+                    if len(failed) == 2:
+                        self._raise_all_failed()
+
+            winner_index = self.candidates.index(self.winner)
+            while True:
+                index, kind, payload = self._events.get()
+                if index != winner_index:
+                    continue
+                if kind == "chunk":
+                    yield payload
+                elif kind == "done":
+                    return
+                else:
+                    raise payload
+        finally:
+            # 読み手が途中で止めた場合（ジョブの中止等）も実行中のリクエストを打ち切る
+            self._cancel_except()
+
+    def complete(self):
+        """妥当な出力を最後まで返した最初の候補を採用し、全文を返す"""
+        self.started_at = time.monotonic()
+        hedge_deadline = self.started_at + self.hedge_after
+        self._start(0)
+        buffers = [[], []]
+        failed = set()
+
+        try:
+            while True:
+                index, kind, payload = self._next_event(hedge_deadline)
+                if kind == "chunk":
+                    buffers[index].append(payload)
+                    continue
+
+                text = "".join(buffers[index])
+                if kind == "done" and self.is_valid(text):
+                    self.winner = self.candidates[index]
+                    return text
+
+                if kind == "done":
+                    self.candidates[index].error = ValueError("出力形式が不正です")
+                failed.add(index)
+                self._start(1)
+                if len(failed) == 2:
+                    self._raise_all_failed()
+        finally:
+            # 採用しなかった方（最初のトークン前のリクエストを含む）を打ち切る
+            self._cancel_except()
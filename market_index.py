@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+"""
+市場資料（白書PDF等）のローカル検索インデックス
+
+資料を500文字前後のパッセージに分割し、日本語は文字2-gram・英数字は単語を
+語としたBM25の転置インデックスを作ってディスクに保存する（create_market_data_cache_final.py で構築）。
+分析時は競合タイトル名・ジャンル・比較観点で上位k件のパッセージだけを取り出し、
+資料全体ではなく関連箇所のみをプロンプトに含める。
+
+保存形式（index_dir 配下）:
+    meta.json       パラメータ・統計・語彙
+    passages.json   パッセージの出典・ページ・チャンクID
+    chunks/         パッセージ本文のチャンクストア（chunk_store.py、mmapで共有）
+    offsets.npy / doc_ids.npy / term_freqs.npy / doc_lengths.npy
+                    転置リスト（語ごとのオフセット・文書ID・出現回数）と文書長（mmapで読み込み）
+
+再構築は各ファイルを .tmp に書いてから置き換える（実行中のアプリがmmapしている古いファイルは
+削除されるまで読める。同じファイルを上書きすると読み込み済みのmmapが壊れSIGBUSで落ちる）。
+"""
+
+import json
+import os
+import re
+import time
+import unicodedata
+from collections import Counter
+
+import numpy as np
+
+from chunk_store import ChunkStore, ChunkStoreWriter
+
+DEFAULT_INDEX_DIR = "cache/market_index"
+INDEX_FORMAT_VERSION = 2
+
+POSTING_ARRAYS = ("offsets", "doc_ids", "term_freqs", "doc_lengths")
+
+# パッセージの目安の長さ（文字）
+PASSAGE_CHARS = 500
+
+# 日本語（かな・漢字・長音）の連続と、英数字の連続
+TERM_PATTERN = re.compile(r"[a-z0-9]+|[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\u3005\u3006\u30fc]+")
+PAGE_MARKER_PATTERN = re.compile(r"^\[p\.(\d+)\]$")
+SENTENCE_END_PATTERN = re.compile(r"(?<=[。！？])")
+
+
+def tokenize(text):
+    """検索語に分割（日本語は文字2-gram、1文字だけの連続はその1文字、英数字は単語）"""
+    terms = []
+    for run in TERM_PATTERN.findall(unicodedata.normalize("NFKC", text).lower()):
+        if run.isascii() or len(run) == 1:
+            terms.append(run)
+        else:
+            terms.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return terms
+
+
+def chunk_passages(source_name, text, target_chars=PASSAGE_CHARS):
+    """
+    資料をパッセージに分割（段落の途中では切らず、長い段落は文末で切る）
+
+    Returns:
+        [{"source": 資料名, "page": 開始ページ or None, "text": 本文}, ...]
+    """
+    passages = []
+    buffer, buffer_page, current_page = [], None, None
+
+    def flush():
+        body = "\n".join(buffer).strip()
+        if body:
+            passages.append({"source": source_name, "page": buffer_page, "text": body})
+        buffer.clear()
+
+    def add(piece):
+        nonlocal buffer_page
+        if not buffer:
+            buffer_page = current_page
+        buffer.append(piece)
+        if sum(len(p) for p in buffer) >= target_chars:
+            flush()
+
+    for paragraph in re.split(r"\n\s*\n", text):
+        lines = []
+        for line in paragraph.split("\n"):
+            match = PAGE_MARKER_PATTERN.match(line.strip())
+            if match:
+                current_page = int(match.group(1))
+            else:
+                lines.append(line)
+        paragraph = "\n".join(lines).strip()
+        if not paragraph:
+            continue
+        if len(paragraph) <= target_chars:
+            add(paragraph)
+            continue
+        # 長い段落は文単位でまとめ直す
+        sentence_buffer = ""
+        for sentence in SENTENCE_END_PATTERN.split(paragraph):
+            if sentence_buffer and len(sentence_buffer) + len(sentence) > target_chars:
+                add(sentence_buffer)
+                sentence_buffer = ""
+            sentence_buffer += sentence
+        if sentence_buffer:
+            add(sentence_buffer)
+    flush()
+    return passages
+
+
+def _replace_file(path, write, binary=False):
+    """path.tmp に write(f) で書いてから path を置き換える（読み込み中・mmap中のファイルは上書きしない）"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") if binary else open(tmp_path, "w", encoding="utf-8") as f:
+        write(f)
+    os.replace(tmp_path, path)
+
+
+class MarketIndex:
+    """文字n-gram BM25の検索インデックス"""
+
+    def __init__(self, passages, vocabulary, offsets, doc_ids, term_freqs, doc_lengths, k1=1.2, b=0.75,
+                 store=None):
+        # 構築直後は passages に本文を持ち、読み込み時は本文の代わりにチャンクIDを持つ
+        self.passages = passages
+        self.store = store
+        self.vocabulary = vocabulary
+        self.term_ids = {term: i for i, term in enumerate(vocabulary)}
+        self.offsets = offsets
+        self.doc_ids = doc_ids
+        self.term_freqs = term_freqs
+        self.doc_lengths = doc_lengths
+        self.k1 = k1
+        self.b = b
+        self.built_at = None
+
+        count = len(passages)
+        avg_length = float(doc_lengths.mean()) if count else 0.0
+        doc_freqs = np.diff(offsets).astype(np.float64)
+        self._idf = np.log(1.0 + (count - doc_freqs + 0.5) / (doc_freqs + 0.5))
+        # 文書長による正規化項はクエリによらないので先に計算しておく
+        self._length_norm = k1 * (1.0 - b + b * doc_lengths / max(avg_length, 1e-9))
+
+    @classmethod
+    def build(cls, sources, target_chars=PASSAGE_CHARS, k1=1.2, b=0.75):
+        """
+        資料からインデックスを構築
+
+        Args:
+            sources: [{"name": 資料名, "text": 本文}, ...]
+        """
+        passages = []
+        for source in sources:
+            passages.extend(chunk_passages(source["name"], source["text"], target_chars))
+
+        postings = {}
+        doc_lengths = np.zeros(len(passages), dtype=np.float32)
+        for doc_id, passage in enumerate(passages):
+            terms = tokenize(passage["text"])
+            doc_lengths[doc_id] = len(terms)
+            for term, freq in Counter(terms).items():
+                postings.setdefault(term, []).append((doc_id, freq))
+
+        vocabulary = sorted(postings)
+        offsets = np.zeros(len(vocabulary) + 1, dtype=np.int64)
+        for i, term in enumerate(vocabulary):
+            offsets[i + 1] = offsets[i] + len(postings[term])
+        doc_ids = np.empty(offsets[-1], dtype=np.int32)
+        term_freqs = np.empty(offsets[-1], dtype=np.float32)
+        for i, term in enumerate(vocabulary):
+            entries = postings[term]
+            doc_ids[offsets[i]:offsets[i + 1]] = [doc_id for doc_id, _ in entries]
+            term_freqs[offsets[i]:offsets[i + 1]] = [freq for _, freq in entries]
+
+        return cls(passages, vocabulary, offsets, doc_ids, term_freqs, doc_lengths, k1, b)
+
+    def passage(self, doc_id):
+        """パッセージ（本文付き）。読み込み済みのインデックスではチャンクストアから本文を取り出す"""
+        passage = self.passages[doc_id]
+        if "text" in passage:
+            return passage
+        return {**passage, "text": self.store.text(passage["chunk"])}
+
+    def save(self, index_dir=DEFAULT_INDEX_DIR):
+        """本文はチャンクストア、転置リストは .npy に保存（いずれも読み込み時にmmapできる形式）"""
+        os.makedirs(index_dir, exist_ok=True)
+        with ChunkStoreWriter(os.path.join(index_dir, "chunks")) as writer:
+            passages = [
+                {"source": passage["source"], "page": passage["page"], "chunk": writer.add(passage["text"])}
+                for passage in map(self.passage, range(len(self.passages)))
+            ]
+        for name in POSTING_ARRAYS:
+            array = getattr(self, name)
+            _replace_file(os.path.join(index_dir, f"{name}.npy"), lambda f: np.save(f, array), binary=True)
+        _replace_file(os.path.join(index_dir, "passages.json"), lambda f: json.dump(passages, f, ensure_ascii=False))
+        # meta.json は最後に置き換える（存在すれば他のファイルも揃っている）
+        meta = {
+            "format_version": INDEX_FORMAT_VERSION,
+            "k1": self.k1,
+            "b": self.b,
+            "passages": len(self.passages),
+            "unique_chunks": writer.stats["chunks"],
+            "sources": sorted({p["source"] for p in self.passages}),
+            "built_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "vocabulary": self.vocabulary,
+        }
+        _replace_file(os.path.join(index_dir, "meta.json"), lambda f: json.dump(meta, f, ensure_ascii=False))
+
+    @classmethod
+    def load(cls, index_dir=DEFAULT_INDEX_DIR):
+        """保存済みのインデックスを読み込む（未構築・形式違いならNone）"""
+        meta_path = os.path.join(index_dir, "meta.json")
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path, encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta.get("format_version") != INDEX_FORMAT_VERSION:
+            return None
+        with open(os.path.join(index_dir, "passages.json"), encoding="utf-8") as f:
+            passages = json.load(f)
+        arrays = {name: np.load(os.path.join(index_dir, f"{name}.npy"), mmap_mode="r") for name in POSTING_ARRAYS}
+        index = cls(
+            passages, meta["vocabulary"], k1=meta["k1"], b=meta["b"],
+            store=ChunkStore(os.path.join(index_dir, "chunks")), **arrays
+        )
+        index.built_at = meta.get("built_at")
+        return index
+
+    def search(self, query_parts, k=8):
+        """
+        BM25で上位k件のパッセージを検索
+
+        Args:
+            query_parts: [(クエリ文字列, 重み), ...]
+            k: 取得件数
+
+        Returns:
+            [(スコア, パッセージdict), ...] スコアの高い順
+        """
+        weights = Counter()
+        for text, weight in query_parts:
+            for term in set(tokenize(text or "")):
+                weights[term] += weight
+
+        scores = np.zeros(len(self.passages), dtype=np.float64)
+        for term, weight in weights.items():
+            term_id = self.term_ids.get(term)
+            if term_id is None:
+                continue
+            start, end = self.offsets[term_id], self.offsets[term_id + 1]
+            docs = self.doc_ids[start:end]
+            freqs = self.term_freqs[start:end]
+            scores[docs] += weight * self._idf[term_id] * freqs * (self.k1 + 1) / (freqs + self._length_norm[docs])
+
+        if not scores.any():
+            return []
+        k = min(k, int((scores > 0).sum()))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(float(scores[i]), self.passage(int(i))) for i in top]
+
+
+def build_query(inputs):
+    """分析入力から検索クエリを作る（競合タイトル名を最も重視）"""
+    parts = [(inputs.get("competitor_name", ""), 2.0), (inputs.get("competitor_genre", ""), 1.0)]
+    parts += [(focus, 0.5) for focus in inputs.get("comparison_focus", [])]
+    return parts
+
+
+def format_passages(hits, title="市場資料からの関連抜粋"):
+    """検索結果をプロンプトに含める参照データの形式にする（出典・ページ付き）"""
+    if not hits:
+        return ""
+    blocks = [f"【{title}】（出典を記載する際は資料名とページを明記すること）"]
+    for _, passage in hits:
+        page = f" p.{passage['page']}" if passage.get("page") else ""
+        blocks.append(f"▼ {passage['source']}{page}\n{passage['text']}")
+    return "\n\n".join(blocks)
+
+
+def retrieve_reference(index, inputs, k=8, title="市場資料からの関連抜粋"):
+    """
+    分析入力に関連するパッセージを検索し、参照データの文字列にして返す
+
+    Returns:
+        (参照データ文字列, 検索結果, 検索時間[ms])
+    """
+    if index is None:
+        return "", [], 0.0
+    started = time.perf_counter()
+    hits = index.search(build_query(inputs), k)
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    return format_passages(hits, title), hits, elapsed_ms
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""
+PDFのテキスト抽出（ページ単位の並列処理・差分処理）
+
+ページをまとまり（チャンク）ごとにプロセスプールで抽出し、抽出結果は
+「ファイルのSHA-256 + ページ番号」をキーにディスクへ保存する。
+再実行時は内容が変わったファイル・未抽出のページだけを処理する。
+
+PDFの解析には pypdf を使う（requirements.txt に記載）。
+"""
+
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# 1タスクで処理するページ数（PDFを開くコストとプロセス間の負荷分散のバランス）
+PAGES_PER_TASK = 16
+
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    """ファイル内容のSHA-256（大きなファイルも分割して読む）"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(chunk_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _open_reader(path):
+    try:
+        from pypdf import PdfReader
+    except ImportError as e:
+        raise RuntimeError("PDFの抽出には pypdf が必要です（pip install pypdf）") from e
+    return PdfReader(path)
+
+
+def count_pages(path):
+    return len(_open_reader(path).pages)
+
+
+def _extract_page_range(path, page_numbers):
+    """ワーカープロセス: 指定ページのテキストを抽出（ページ番号は0始まり）"""
+    reader = _open_reader(path)
+    results = []
+    for page_no in page_numbers:
+        try:
+            text = reader.pages[page_no].extract_text() or ""
+        except Exception as e:
+            # 壊れたページは空として扱い、他のページの抽出は続ける
+            print(f"  Warning: page {page_no + 1} の抽出に失敗しました: {e}")
+            text = ""
+        results.append((page_no, text))
+    return results
+
+
+class PageTextCache:
+    """
+    ページ単位の抽出結果キャッシュ
+
+    cache_dir/<ファイルのSHA-256>/meta.json と 00001.txt, 00002.txt ... の構成。
+    """
+
+    def __init__(self, cache_dir="cache/pdf_pages"):
+        self.cache_dir = cache_dir
+
+    def _dir(self, file_hash):
+        return os.path.join(self.cache_dir, file_hash)
+
+    def _page_path(self, file_hash, page_no):
+        return os.path.join(self._dir(file_hash), f"{page_no + 1:05d}.txt")
+
+    def page_count(self, file_hash):
+        try:
+            with open(os.path.join(self._dir(file_hash), "meta.json"), encoding="utf-8") as f:
+                return json.load(f)["page_count"]
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def set_page_count(self, file_hash, page_count, source_name=""):
+        os.makedirs(self._dir(file_hash), exist_ok=True)
+        with open(os.path.join(self._dir(file_hash), "meta.json"), "w", encoding="utf-8") as f:
+            json.dump({"page_count": page_count, "source": source_name}, f, ensure_ascii=False)
+
+    def get(self, file_hash, page_no):
+        try:
+            with open(self._page_path(file_hash, page_no), encoding="utf-8") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def put(self, file_hash, page_no, text):
+        os.makedirs(self._dir(file_hash), exist_ok=True)
+        path = self._page_path(file_hash, page_no)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+
+
+def extract_pdf_pages(paths, cache=None, workers=None, on_progress=None):
+    """
+    複数PDFのページテキストを抽出（全ファイルで1つのプロセスプールを共有）
+
+    Args:
+        paths: PDFファイルパスのリスト
+        cache: PageTextCache（Noneならキャッシュしない）
+        workers: プロセス数（Noneなら CPU 数）
+        on_progress: on_progress(path, 完了ページ数, 総ページ数) 抽出済みページが増えるたびに呼ばれる
+
+    Returns:
+        ({path: [ページテキスト, ...]}, 統計dict)
+        統計: pages（総ページ数）, extracted（今回抽出）, cached（キャッシュ利用）, seconds,
+              pages_per_sec（今回抽出したページの処理速度、キャッシュ利用分は含めない）
+    """
+    started = time.perf_counter()
+    pages_by_path = {}
+    pending = []  # (path, file_hash, page_numbers)
+    stats = {"pages": 0, "extracted": 0, "cached": 0}
+
+    for path in paths:
+        file_hash = file_sha256(path)
+        page_count = cache.page_count(file_hash) if cache else None
+        if page_count is None:
+            page_count = count_pages(path)
+            if cache:
+                cache.set_page_count(file_hash, page_count, os.path.basename(path))
+
+        pages = [cache.get(file_hash, page_no) if cache else None for page_no in range(page_count)]
+        missing = [page_no for page_no, text in enumerate(pages) if text is None]
+        pages_by_path[path] = pages
+        stats["pages"] += page_count
+        stats["cached"] += page_count - len(missing)
+        for i in range(0, len(missing), PAGES_PER_TASK):
+            pending.append((path, file_hash, missing[i:i + PAGES_PER_TASK]))
+        if on_progress:
+            on_progress(path, page_count - len(missing), page_count)
+
+    if pending:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(_extract_page_range, path, page_numbers): (path, file_hash)
+                for path, file_hash, page_numbers in pending
+            }
+            for future in as_completed(futures):
+                path, file_hash = futures[future]
+                pages = pages_by_path[path]
+                for page_no, text in future.result():
+                    pages[page_no] = text
+                    if cache:
+                        cache.put(file_hash, page_no, text)
+                    stats["extracted"] += 1
+                if on_progress:
+                    done = sum(1 for text in pages if text is not None)
+                    on_progress(path, done, len(pages))
+
+    stats["seconds"] = time.perf_counter() - started
+    stats["pages_per_sec"] = stats["extracted"] / stats["seconds"] if stats["seconds"] > 0 else 0.0
+    return pages_by_path, stats
+
+
+def join_pages(pages):
+    """ページテキストを「[p.N]」の目印付きで結合（出典のページ番号を追えるように）"""
+    return "\n\n".join(
+        f"[p.{page_no + 1}]\n{text.strip()}"
+        for page_no, text in enumerate(pages)
+        if text and text.strip()
+    )
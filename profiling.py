@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""
+分析パイプラインの段階ごとの処理時間（スパン）の計測
+
+分析が遅いときに、プロンプト作成・APIの応答待ち・生成・レポート解析・グラフ作成・
+結果の描画のどこに時間がかかったかを調べるための軽量な計測。
+
+    trace = Trace("分析ジョブ", job_id=job.id)
+    with tracing(trace):
+        with span("プロンプト作成"):
+            ...
+    trace.records()   # 管理画面のウォーターフォール表示・JSON Lines出力用
+
+span() は tracing() の外（計測していないスレッド等）では何もしないため、計測対象の関数に
+残したままでよい。スパンの入れ子は深さとして記録する。
+
+詳しく調べる場合は profile_capture() で cProfile（または pyinstrument）の結果をファイルに出力する。
+"""
+
+import contextlib
+import contextvars
+import cProfile
+import io
+import json
+import os
+import pstats
+import threading
+import time
+import uuid
+from datetime import datetime
+
+from lazy_imports import import_module
+
+# 実行中のトレースとスパンの深さ（スレッド・タスクごと）
+_current_trace = contextvars.ContextVar("profiling_trace", default=None)
+_current_depth = contextvars.ContextVar("profiling_depth", default=0)
+
+# profile_capture の結果に含める関数の数（累積時間の上位）
+PROFILE_TOP_FUNCTIONS = 30
+
+
+class Trace:
+    """1回の処理（分析ジョブ・結果表示）のスパンの集まり"""
+
+    def __init__(self, name, **attrs):
+        self.id = uuid.uuid4().hex[:12]
+        self.name = name
+        self.attrs = attrs
+        self.started_at = time.time()
+        self._origin = time.perf_counter()
+        self._spans = []
+        self._lock = threading.Lock()
+
+    def add(self, name, start, end, depth=0, **attrs):
+        """perf_counter() の開始・終了時刻でスパンを追加（コンテキストマネージャで囲めない区間用）"""
+        with self._lock:
+            self._spans.append({
+                "span": name,
+                "start_ms": (start - self._origin) * 1000,
+                "duration_ms": (end - start) * 1000,
+                "depth": depth,
+                "thread": threading.current_thread().name,
+                **attrs,
+            })
+
+    @property
+    def duration_ms(self):
+        with self._lock:
+            return max((s["start_ms"] + s["duration_ms"] for s in self._spans), default=0.0)
+
+    def records(self):
+        """スパンの一覧（開始順）"""
+        with self._lock:
+            return sorted(self._spans, key=lambda s: (s["start_ms"], s["depth"]))
+
+
+@contextlib.contextmanager
+def tracing(trace):
+    """このブロック内の span() を trace に記録する（trace がNoneなら何もしない）"""
+    if trace is None:
+        yield None
+        return
+    trace_token = _current_trace.set(trace)
+    depth_token = _current_depth.set(0)
+    try:
+        yield trace
+    finally:
+        _current_depth.reset(depth_token)
+        _current_trace.reset(trace_token)
+
+
+@contextlib.contextmanager
+def span(name, **attrs):
+    """実行中のトレースに name の区間を記録する（トレースがなければ何もしない）"""
+    trace = _current_trace.get()
+    if trace is None:
+        yield
+        return
+    depth = _current_depth.get()
+    token = _current_depth.set(depth + 1)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        end = time.perf_counter()
+        _current_depth.reset(token)
+        trace.add(name, start, end, depth=depth, **attrs)
+
+
+def current_trace():
+    return _current_trace.get()
+
+
+def current_depth():
+    return _current_depth.get()
+
+
+class SpanExporter:
+    """
+    トレースを JSON Lines で追記する（1行1スパン、日をまたいだ集計用）
+
+    行: {"trace_id", "trace", "started_at", ...トレースの属性, "span", "start_ms", "duration_ms", "depth", "thread"}
+    """
+
+    def __init__(self, path="logs/spans.jsonl"):
+        self.path = path
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+    def export(self, trace, **attrs):
+        header = {
+            "trace_id": trace.id,
+            "trace": trace.name,
+            "started_at": datetime.fromtimestamp(trace.started_at).isoformat(timespec="milliseconds"),
+            **trace.attrs,
+            **attrs,
+        }
+        lines = [json.dumps({**header, **record}, ensure_ascii=False, default=str) for record in trace.records()]
+        if not lines:
+            return
+        try:
+            with self._lock, open(self.path, "a", encoding="utf-8") as f:
+                f.write("\n".join(lines) + "\n")
+        except OSError as e:
+            print(f"スパンの出力エラー: {e}")
+
+
+def profiler_engines():
+    """使用できるプロファイラ（pyinstrument はインストールされている場合のみ）"""
+    engines = ["cProfile"]
+    try:
+        import_module("pyinstrument")
+        engines.append("pyinstrument")
+    except ImportError:
+        pass
+    return engines
+
+
+@contextlib.contextmanager
+def profile_capture(path, engine="cProfile"):
+    """
+    ブロック内の処理をプロファイルして path に出力する（path がNoneなら何もしない）
+
+    cProfile は .prof（pstats形式、snakeviz等で閲覧）、pyinstrument は .html を出力する。
+    計測するのは呼び出し元のスレッドのみ（非同期のイベントループ・ヘッジのスレッドは含まない）。
+
+    Yields:
+        {"path": 出力先, "summary": 上位の関数のテキスト}（ブロック終了後に設定される）
+    """
+    capture = {"path": None, "summary": ""}
+    if path is None:
+        yield capture
+        return
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+    if engine == "pyinstrument":
+        profiler = import_module("pyinstrument").Profiler()
+        profiler.start()
+        try:
+            yield capture
+        finally:
+            profiler.stop()
+            capture["path"] = os.path.splitext(path)[0] + ".html"
+            with open(capture["path"], "w", encoding="utf-8") as f:
+                f.write(profiler.output_html())
+            capture["summary"] = profiler.output_text()
+        return
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield capture
+    finally:
+        profiler.disable()
+        capture["path"] = os.path.splitext(path)[0] + ".prof"
+        profiler.dump_stats(capture["path"])
+        out = io.StringIO()
+        pstats.Stats(profiler, stream=out).sort_stats("cumulative").print_stats(PROFILE_TOP_FUNCTIONS)
+        capture["summary"] = out.getvalue()
@@ -0,0 +1,345 @@
+# -*- coding: utf-8 -*-
+"""
+Provider・モデルごとのレート制限（RPM・TPM）のトークンバケット
+
+複数のユーザーが同時に分析を実行すると、APIの1分あたりのリクエスト数・トークン数の上限を超えて
+全員が429エラーになる。LLMClientPool は送信前にここで枠を予約し、枠が空くまで待ってから送信する。
+
+- リクエスト数（RPM）と推定トークン数（入力 + max_tokens、TPM）の2つのバケットで計量する
+- 呼び出しは到着順に枠を予約する（後から来た呼び出しが先に通ることはない）。予約時に
+  待ち時間が決まり、その時間だけ待ってから送信する
+- 応答のusageが分かれば、推定との差をトークンバケットに戻す（max_tokens を使い切らなかった分等）
+- 状態は既定でプロセス内に持つ。state_path を指定するとSQLiteで複数プロセス間で共有する
+
+    limiter = RateLimiter({"Claude (Anthropic)": RateLimit(rpm=50, tpm=400_000)})
+    reservation = limiter.reserve("Claude (Anthropic)", "claude-sonnet-4-20250514", tokens=20_000)
+    reservation.sleep()
+    ...
+    reservation.settle(actual_tokens)
+"""
+
+import contextlib
+import contextvars
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from analysis_prompt import CLAUDE_PROVIDER, OPENAI_PROVIDER
+from token_budget import TokenCounter
+
+
+class RateLimit:
+    """1分あたりのリクエスト数・トークン数の上限（Noneなら制限しない）"""
+
+    def __init__(self, rpm=None, tpm=None):
+        self.rpm = rpm
+        self.tpm = tpm
+
+
+# Secretsの rate_limits で上書きできる既定値（Providerの下位の有料プランの上限が目安）
+DEFAULT_LIMITS = {
+    CLAUDE_PROVIDER: RateLimit(rpm=50, tpm=400_000),
+    OPENAI_PROVIDER: RateLimit(rpm=500, tpm=450_000),
+}
+
+BUCKET_KINDS = ("requests", "tokens")
+
+
+def load_limits(config):
+    """
+    Secretsの rate_limits テーブルから上限を読み込む（既定値に上書き）
+
+    キーはProvider名またはモデル名（モデル名の設定が優先される）:
+        [rate_limits."Claude (Anthropic)"]
+        rpm = 50
+        tpm = 400000
+    """
+    limits = dict(DEFAULT_LIMITS)
+    for key, values in (config or {}).items():
+        limits[key] = RateLimit(values.get("rpm"), values.get("tpm"))
+    return limits
+
+
+# ============================================
+# 推定トークン数
+# ============================================
+
+_counter = TokenCounter()
+
+
+def _content_text(content):
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        return "".join(
+            block.get("text", "") if isinstance(block, dict) else str(block)
+            for block in content
+        )
+    return ""
+
+
+def estimate_request_tokens(request_kwargs):
+    """
+    リクエストの推定トークン数（入力の推定 + 出力の上限 max_tokens）
+
+    Claude（system・messages・tools）とOpenAI（messages・response_format）のどちらの引数にも対応する。
+    """
+    text = _content_text(request_kwargs.get("system", ""))
+    for message in request_kwargs.get("messages", []):
+        text += _content_text(message.get("content", ""))
+    input_tokens = _counter.count(text)
+    for key in ("tools", "response_format"):
+        if key in request_kwargs:
+            input_tokens += _counter.count(json.dumps(request_kwargs[key], ensure_ascii=False))
+    return input_tokens + int(request_kwargs.get("max_tokens") or 0)
+
+
+def usage_tokens(result):
+    """
+    API応答から実際のトークン数を取り出す（分からなければNone）
+
+    result はSDKの応答（.usage を持つ）・usage そのもの・usage の dict、またはそれらを最後に持つタプル。
+    キャッシュ読み取りはレート制限に数えないProviderが多いため含めない。
+    """
+    if isinstance(result, tuple):
+        result = result[-1] if result else None
+    usage = getattr(result, "usage", result)
+    if usage is None:
+        return None
+
+    def field(name):
+        value = usage.get(name) if isinstance(usage, dict) else getattr(usage, name, None)
+        return value or 0
+
+    if field("prompt_tokens") or field("completion_tokens"):
+        return field("prompt_tokens") + field("completion_tokens")
+    total = field("input_tokens") + field("cache_creation_input_tokens") + field("output_tokens")
+    return total or None
+
+
+# ============================================
+# バケットの状態（プロセス内 / SQLite）
+# ============================================
+
+class MemoryBucketStore:
+    """プロセス内のバケット状態"""
+
+    def __init__(self):
+        self._states = {}
+        self._lock = threading.Lock()
+
+    def update(self, keys, fn):
+        """keys の状態 {key: (残量, 更新時刻) or None} を fn に渡し、返された新しい状態を保存"""
+        with self._lock:
+            states, result = fn({key: self._states.get(key) for key in keys})
+            self._states.update(states)
+            return result
+
+
+class SQLiteBucketStore:
+    """SQLiteで複数プロセス間に共有するバケット状態（更新は BEGIN IMMEDIATE で直列化）"""
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with contextlib.closing(self._connect()) as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, level REAL, updated_at REAL)")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30.0, isolation_level=None)
+
+    def update(self, keys, fn):
+        with contextlib.closing(self._connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                states = dict.fromkeys(keys)
+                for key, level, updated_at in conn.execute(
+                    f"SELECT key, level, updated_at FROM buckets WHERE key IN ({','.join('?' * len(keys))})", keys
+                ):
+                    states[key] = (level, updated_at)
+                new_states, result = fn(states)
+                conn.executemany(
+                    "INSERT OR REPLACE INTO buckets (key, level, updated_at) VALUES (?, ?, ?)",
+                    [(key, level, updated_at) for key, (level, updated_at) in new_states.items()]
+                )
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        return result
+
+
+# ============================================
+# レート制限
+# ============================================
+
+# 待ちが発生したときの通知先と中止イベント（分析ジョブが設定する、呼び出し元スレッドごと）
+_wait_context = contextvars.ContextVar("rate_limit_wait_context", default=(None, None))
+
+
+class RateLimitWaitCancelled(Exception):
+    """レート制限の待ち中に中止された（予約した枠は戻してある）"""
+
+
+@contextlib.contextmanager
+def notify_waits(callback, cancel_event=None):
+    """
+    このブロック内の同期呼び出しでレート制限の待ちが発生したら callback(provider, model, 秒) を呼ぶ
+
+    cancel_event がセットされると待ちを打ち切り、RateLimitWaitCancelled を送出する。
+    """
+    token = _wait_context.set((callback, cancel_event))
+    try:
+        yield
+    finally:
+        _wait_context.reset(token)
+
+
+class Reservation:
+    """予約済みの枠（wait 秒後に送信してよい）"""
+
+    def __init__(self, limiter, provider, model, tokens, wait):
+        self.limiter = limiter
+        self.provider = provider
+        self.model = model
+        self.tokens = tokens
+        self.wait = wait
+
+    def sleep(self):
+        """送信してよい時刻まで待つ（notify_waits の通知先に知らせ、中止されたら枠を戻す）"""
+        if self.wait <= 0:
+            return
+        callback, cancel_event = _wait_context.get()
+        if callback is not None and self.wait >= 1.0:
+            callback(self.provider, self.model, self.wait)
+        if cancel_event is None:
+            time.sleep(self.wait)
+        elif cancel_event.wait(self.wait):
+            self.cancel()
+            raise RateLimitWaitCancelled("レート制限の待ち中に中止しました")
+
+    def cancel(self):
+        """送信しなかった予約を取り消す（枠を戻す）"""
+        self.limiter._adjust(self.provider, self.model, requests=1, tokens=self.tokens)
+
+    def settle(self, actual_tokens):
+        """実際のトークン数が分かったら推定との差を戻す（超えた分は追加で消費）"""
+        if actual_tokens is not None:
+            self.limiter._adjust(self.provider, self.model, tokens=self.tokens - actual_tokens)
+
+
+class RateLimiter:
+    """
+    Provider・モデルごとのトークンバケット（RPM・TPM）
+
+    バケットの容量は1分間の上限、補充速度は上限/60秒。残量がマイナス（前借り）になることを許し、
+    マイナス分が補充されるまでの時間を待ち時間とする（到着順に並ぶ）。
+    """
+
+    def __init__(self, limits=None, state_path=None):
+        self.limits = limits or dict(DEFAULT_LIMITS)
+        self.store = SQLiteBucketStore(state_path) if state_path else MemoryBucketStore()
+        self._last_tokens = {}
+        self._waits = {}
+
+    def limit_for(self, provider, model):
+        """モデル名の設定を優先し、なければProviderの設定（どちらもなければ制限なし）"""
+        return self.limits.get(model) or self.limits.get(provider) or RateLimit()
+
+    def _capacities(self, provider, model):
+        limit = self.limit_for(provider, model)
+        return {"requests": limit.rpm, "tokens": limit.tpm}
+
+    @staticmethod
+    def _key(provider, model, kind):
+        return f"{provider}|{model}|{kind}"
+
+    @staticmethod
+    def _refill(state, capacity, now):
+        """現在の残量（前回の残量に経過時間分を補充、容量まで）"""
+        if state is None:
+            return float(capacity)
+        level, updated_at = state
+        return min(float(capacity), level + max(0.0, now - updated_at) * capacity / 60.0)
+
+    def _update(self, provider, model, costs, commit):
+        """
+        各バケットの残量から costs を引いたときの待ち時間（秒）
+
+        commit=False なら状態を変えずに待ち時間だけを返す（見込みの表示用）
+        """
+        capacities = self._capacities(provider, model)
+        kinds = [kind for kind in BUCKET_KINDS if capacities[kind]]
+        if not kinds:
+            return 0.0
+        keys = [self._key(provider, model, kind) for kind in kinds]
+
+        def apply(states):
+            now = time.time()
+            new_states = {}
+            wait = 0.0
+            for kind, key in zip(kinds, keys):
+                capacity = capacities[kind]
+                # 1回で容量を超える分は容量まで（超えると永久に送信できない）
+                level = self._refill(states[key], capacity, now) - min(costs.get(kind, 0), capacity)
+                level = min(level, float(capacity))
+                if level < 0:
+                    wait = max(wait, -level * 60.0 / capacity)
+                new_states[key] = (level, now)
+            return (new_states if commit else {}), wait
+
+        return self.store.update(keys, apply)
+
+    def reserve(self, provider, model, tokens=0):
+        """1リクエスト・tokens トークン分の枠を予約（待ち時間は Reservation.wait）"""
+        tokens = int(tokens or 0)
+        wait = self._update(provider, model, {"requests": 1, "tokens": tokens}, commit=True)
+        if tokens:
+            self._last_tokens[(provider, model)] = tokens
+        if wait > 0:
+            self._waits[(provider, model)] = (time.time(), wait)
+        return Reservation(self, provider, model, tokens, wait)
+
+    def _adjust(self, provider, model, requests=0, tokens=0):
+        # コストを負にして残量に戻す
+        self._update(provider, model, {"requests": -requests, "tokens": -tokens}, commit=True)
+
+    def expected_wait(self, provider, model, tokens=None):
+        """
+        今送信した場合の待ち時間の見込み（秒、予約はしない）
+
+        tokens を省略すると、このProvider・モデルで最後に予約したトークン数を使う。
+        """
+        if tokens is None:
+            tokens = self._last_tokens.get((provider, model), 0)
+        return self._update(provider, model, {"requests": 1, "tokens": tokens}, commit=False)
+
+    def status(self):
+        """
+        管理画面向け: 使用したことのあるProvider・モデルごとの状態
+
+        Returns:
+            [{"provider", "model", "rpm", "tpm", "requests_available", "tokens_available", "last_wait"}, ...]
+        """
+        rows = []
+        for provider, model in sorted(set(self._last_tokens) | set(self._waits)):
+            capacities = self._capacities(provider, model)
+            kinds = [kind for kind in BUCKET_KINDS if capacities[kind]]
+            keys = [self._key(provider, model, kind) for kind in kinds]
+            now = time.time()
+            available = self.store.update(keys, lambda states: ({}, {
+                kind: self._refill(states[key], capacities[kind], now) for kind, key in zip(kinds, keys)
+            })) if keys else {}
+            last_wait = self._waits.get((provider, model))
+            rows.append({
+                "provider": provider,
+                "model": model,
+                "rpm": capacities["requests"],
+                "tpm": capacities["tokens"],
+                "requests_available": available.get("requests"),
+                "tokens_available": available.get("tokens"),
+                "last_wait": last_wait,
+            })
+        return rows
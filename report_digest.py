@@ -0,0 +1,381 @@
+# -*- coding: utf-8 -*-
+"""
+大きな資料の要約ダイジェスト（map-reduce）
+
+数百ページの市場レポートはそのままではコンテキストに入らないため、
+1) map: ページをトークン数でまとめたチャンクごとに、安価なモデルで事実を箇条書きに要約（並列・同時数に上限）
+2) reduce: 要約が1回の入力に収まるまでまとめ直し、最後に分析で参照するファクトダイジェストにする
+の2段階で圧縮する。完成したダイジェストはファイルのSHA-256ごとに、各チャンクの要約は
+チャンク内容のハッシュごとにディスクへ保存するため、中止した後の再実行は未完了のチャンクだけを処理する。
+
+LLMの呼び出しは summarize(system, prompt, max_tokens) -> (本文, usage) の非同期関数として
+注入する（make_llm_summarizer が LLMClientPool 経由の実装、検証時はスタブに差し替えられる）。
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import re
+import time
+
+from analysis_prompt import CLAUDE_PROVIDER, LIGHT_MODELS, extract_cache_usage
+from llm_client import post_event
+from rate_limiter import estimate_request_tokens
+from section_fanout import sum_usage
+from token_budget import TokenCounter
+
+# プロンプトを変えたら上げる（保存済みの要約を使わなくなる）
+DIGEST_PROMPT_VERSION = "1.0"
+
+# 要約に使う安価なモデル（分析本体とは別）
+DIGEST_MODELS = LIGHT_MODELS
+
+# 1チャンクの入力トークン数・1回のreduceに渡す要約の合計トークン数
+MAP_CHUNK_TOKENS = 6000
+REDUCE_INPUT_TOKENS = 12000
+# 出力トークンの上限（チャンクの要約・中間のまとめ・最終ダイジェスト）
+MAP_MAX_TOKENS = 800
+REDUCE_MAX_TOKENS = 1200
+DIGEST_MAX_TOKENS = 2000
+
+# 中止（cancel_event）を確認する間隔（秒）
+CANCEL_POLL_INTERVAL = 0.2
+
+MAP_SYSTEM_PROMPT = """あなたはゲーム業界の市場調査アナリストです。
+渡された市場レポートの一部から、競合分析に使える事実だけを日本語の箇条書きで抜き出してください。
+- 市場規模・売上・ユーザー数・シェア・成長率・ランキングなどの数値は単位と年度を付けてそのまま残す
+- 各項目の末尾に根拠のページを [p.N] の形式で付ける
+- 推測や一般論は書かない。該当する事実がなければ「（該当なし）」とだけ書く"""
+
+REDUCE_SYSTEM_PROMPT = """あなたはゲーム業界の市場調査アナリストです。
+市場レポートの各部分から抜き出した事実の箇条書きを、重複をまとめて1つの箇条書きに統合してください。
+- 数値・単位・年度・[p.N] のページ表記は変更しない
+- 矛盾する数値は両方残し、それぞれのページを付ける
+- 新しい事実や推測は加えない"""
+
+FINAL_SYSTEM_PROMPT = """あなたはゲーム業界の市場調査アナリストです。
+市場レポートから抜き出した事実をもとに、競合分析で参照するファクトダイジェストを作成してください。
+- 「市場規模」「ジャンル・プラットフォーム別の動向」「主要タイトル・企業」「ユーザー動向」「その他」の見出しで整理する
+- 数値・単位・年度・[p.N] のページ表記は変更しない
+- 分析に関係の薄い事実は省き、全体を簡潔にまとめる
+- 新しい事実や推測は加えない"""
+
+
+class DigestCancelledError(Exception):
+    """ダイジェストの作成が中止された"""
+
+
+def chunk_pages(pages, chunk_tokens=MAP_CHUNK_TOKENS, counter=None):
+    """
+    ページテキストを目印付きでトークン数ごとのチャンクにまとめる（ページの途中では切らない）
+
+    Returns:
+        [{"first_page": 開始ページ, "last_page": 終了ページ, "text": 本文}, ...]
+    """
+    counter = counter or TokenCounter()
+    chunks = []
+    current, current_tokens, first_page = [], 0, None
+
+    def flush(last_page):
+        if current:
+            chunks.append({"first_page": first_page, "last_page": last_page, "text": "\n\n".join(current)})
+
+    last_page = None
+    for page_no, text in enumerate(pages, start=1):
+        if not text or not text.strip():
+            continue
+        block = f"[p.{page_no}]\n{text.strip()}"
+        tokens = counter.count(block)
+        if current and current_tokens + tokens > chunk_tokens:
+            flush(last_page)
+            current, current_tokens = [], 0
+        if not current:
+            first_page = page_no
+        current.append(block)
+        current_tokens += tokens
+        last_page = page_no
+    flush(last_page)
+    return chunks
+
+
+def group_by_tokens(texts, limit=REDUCE_INPUT_TOKENS, counter=None):
+    """テキストを合計トークン数が limit 以下になるよう順にまとめる（1件で超えるものは単独）"""
+    counter = counter or TokenCounter()
+    groups, current, current_tokens = [], [], 0
+    for text in texts:
+        tokens = counter.count(text)
+        if current and current_tokens + tokens > limit:
+            groups.append(current)
+            current, current_tokens = [], 0
+        current.append(text)
+        current_tokens += tokens
+    if current:
+        groups.append(current)
+    return groups
+
+
+class DigestCache:
+    """
+    ダイジェストとチャンク要約のディスクキャッシュ
+
+    cache_dir/<ファイルのSHA-256>_<モデル>.json  完成したダイジェスト
+    cache_dir/map/<チャンクのキー>.txt            チャンクごとの要約（中止後の再開用）
+    """
+
+    def __init__(self, cache_dir="cache/report_digests"):
+        self.cache_dir = cache_dir
+
+    def _digest_path(self, file_hash, model):
+        safe_model = re.sub(r"[^A-Za-z0-9._-]", "_", model)
+        return os.path.join(self.cache_dir, f"{file_hash}_{safe_model}.json")
+
+    def get(self, file_hash, model):
+        try:
+            with open(self._digest_path(file_hash, model), encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if entry.get("prompt_version") != DIGEST_PROMPT_VERSION:
+            return None
+        return entry
+
+    def put(self, file_hash, model, entry):
+        self._write(self._digest_path(file_hash, model), json.dumps(entry, ensure_ascii=False))
+
+    def get_summary(self, key):
+        try:
+            with open(os.path.join(self.cache_dir, "map", f"{key}.txt"), encoding="utf-8") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def put_summary(self, key, text):
+        self._write(os.path.join(self.cache_dir, "map", f"{key}.txt"), text)
+
+    @staticmethod
+    def _write(path, content):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+            f.write(content)
+        os.replace(f"{path}.tmp", path)
+
+
+def make_llm_summarizer(pool, provider, api_key, model):
+    """
+    LLMClientPool 経由の summarize 関数（再試行・期限・ブレーカー付き、run_async のループ上で使う）
+
+    Returns:
+        async summarize(system, prompt, max_tokens) -> (本文, usage)
+    """
+    client = pool.async_client(provider, api_key)
+
+    async def summarize(system, prompt, max_tokens):
+        if provider == CLAUDE_PROVIDER:
+            async def attempt():
+                message = await client.messages.create(
+                    model=model,
+                    max_tokens=max_tokens,
+                    temperature=0,
+                    system=system,
+                    messages=[{"role": "user", "content": prompt}]
+                )
+                text = "".join(block.text for block in message.content if getattr(block, "type", "") == "text")
+                return text, extract_cache_usage(message.usage)
+        else:
+            async def attempt():
+                response = await client.chat.completions.create(
+                    model=model,
+                    max_tokens=max_tokens,
+                    temperature=0,
+                    messages=[{"role": "system", "content": system}, {"role": "user", "content": prompt}]
+                )
+                return response.choices[0].message.content or "", extract_cache_usage(response.usage)
+
+        tokens = estimate_request_tokens({
+            "system": system, "messages": [{"role": "user", "content": prompt}], "max_tokens": max_tokens
+        })
+        return await pool.call_async(provider, model, attempt, tokens=tokens)
+
+    return summarize
+
+
+class ReportDigester:
+    """
+    map-reduce によるダイジェスト作成
+
+    進捗は post_event("digest", 段階, 完了数, 総数) で通知する（段階は "map" / "reduce" / "final"）。
+    cancel_event（threading.Event）がセットされると、実行中の要約リクエストをキャンセルし、未発行の呼び出しも
+    止めて DigestCancelledError を送出する（完了したチャンクの要約は保存済みのため、再実行はその続きから処理する）。
+    """
+
+    def __init__(self, summarize, model, cache=None, max_concurrency=4, chunk_tokens=MAP_CHUNK_TOKENS,
+                 reduce_input_tokens=REDUCE_INPUT_TOKENS, counter=None):
+        self.summarize = summarize
+        self.model = model
+        self.cache = cache
+        self.max_concurrency = max_concurrency
+        self.chunk_tokens = chunk_tokens
+        self.reduce_input_tokens = reduce_input_tokens
+        self.counter = counter or TokenCounter()
+
+    def _summary_key(self, system, prompt):
+        source = f"{DIGEST_PROMPT_VERSION}\n{self.model}\n{system}\n{prompt}"
+        return hashlib.sha256(source.encode("utf-8")).hexdigest()
+
+    async def _run_level(self, phase, jobs, semaphore, cancel_event, stats):
+        """
+        同じ段階の要約をまとめて並列実行（入力順に結果を返す）
+
+        Args:
+            jobs: [(system, prompt, max_tokens), ...]
+        """
+        async def run(index, system, prompt, max_tokens):
+            key = self._summary_key(system, prompt)
+            cached = self.cache.get_summary(key) if self.cache else None
+            if cached is not None:
+                stats["cached_calls"] += 1
+                return index, cached
+            async with semaphore:
+                if cancel_event is not None and cancel_event.is_set():
+                    raise DigestCancelledError("ダイジェストの作成を中止しました")
+                text, usage = await self.summarize(system, prompt, max_tokens)
+            stats["calls"] += 1
+            stats["usages"].append(usage)
+            text = (text or "").strip()
+            if self.cache:
+                self.cache.put_summary(key, text)
+            return index, text
+
+        async def wait_cancelled():
+            # threading.Event はイベントループ上で待てないため一定間隔で確認する
+            while not cancel_event.is_set():
+                await asyncio.sleep(CANCEL_POLL_INTERVAL)
+
+        tasks = [asyncio.ensure_future(run(i, *job)) for i, job in enumerate(jobs)]
+        watcher = asyncio.ensure_future(wait_cancelled()) if cancel_event is not None else None
+        results = [None] * len(jobs)
+        pending = set(tasks)
+        done = 0
+        post_event("digest", phase, 0, len(jobs))
+        try:
+            while pending:
+                finished, _ = await asyncio.wait(
+                    pending | {watcher} if watcher is not None else pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                if watcher in finished:
+                    raise DigestCancelledError("ダイジェストの作成を中止しました")
+                for task in finished:
+                    pending.discard(task)
+                    index, text = task.result()
+                    results[index] = text
+                    done += 1
+                    post_event("digest", phase, done, len(jobs))
+        except BaseException:
+            # 中止・失敗時は実行中の要約リクエストもキャンセルする
+            for task in tasks:
+                task.cancel()
+            raise
+        finally:
+            if watcher is not None:
+                watcher.cancel()
+        return results
+
+    async def digest_async(self, pages, cancel_event=None):
+        """
+        ページテキストからダイジェストを作成
+
+        Returns:
+            (ダイジェスト本文, 統計dict)
+            統計: chunks, calls（API呼び出し数）, cached_calls（保存済みの要約を使った数）, reduce_levels, usage, seconds
+        """
+        started = time.perf_counter()
+        semaphore = asyncio.Semaphore(max(1, self.max_concurrency))
+        stats = {"calls": 0, "cached_calls": 0, "usages": []}
+
+        chunks = chunk_pages(pages, self.chunk_tokens, self.counter)
+        if not chunks:
+            return "", {"chunks": 0, "calls": 0, "cached_calls": 0, "reduce_levels": 0, "usage": {}, "seconds": 0.0}
+
+        # 1) map: チャンクごとの事実抽出（1チャンクだけなら最終段にそのまま渡す）
+        if len(chunks) == 1:
+            summaries = [chunks[0]["text"]]
+        else:
+            jobs = [
+                (MAP_SYSTEM_PROMPT, f"【p.{chunk['first_page']}〜p.{chunk['last_page']}】\n\n{chunk['text']}", MAP_MAX_TOKENS)
+                for chunk in chunks
+            ]
+            summaries = await self._run_level("map", jobs, semaphore, cancel_event, stats)
+            summaries = [text for text in summaries if text and text.strip() != "（該当なし）"]
+
+        # 2) reduce: 1回の入力に収まるまでまとめ直す
+        reduce_levels = 0
+        while len(summaries) > 1 and sum(map(self.counter.count, summaries)) > self.reduce_input_tokens:
+            groups = group_by_tokens(summaries, self.reduce_input_tokens, self.counter)
+            if len(groups) == len(summaries):
+                # 1件ずつしか入らない（これ以上まとめられない）
+                break
+            jobs = [(REDUCE_SYSTEM_PROMPT, "\n\n---\n\n".join(group), REDUCE_MAX_TOKENS) for group in groups]
+            summaries = await self._run_level("reduce", jobs, semaphore, cancel_event, stats)
+            reduce_levels += 1
+
+        # 3) 最終ダイジェスト（どのチャンクにも該当する事実がなければ空のプロンプトを送らず空にする）
+        if summaries:
+            final_prompt = "\n\n---\n\n".join(summaries)
+            digest, = await self._run_level(
+                "final", [(FINAL_SYSTEM_PROMPT, final_prompt, DIGEST_MAX_TOKENS)], semaphore, cancel_event, stats
+            )
+        else:
+            digest = ""
+
+        return digest, {
+            "chunks": len(chunks),
+            "calls": stats["calls"],
+            "cached_calls": stats["cached_calls"],
+            "reduce_levels": reduce_levels,
+            "usage": sum_usage(stats["usages"]),
+            "seconds": time.perf_counter() - started,
+        }
+
+    def digest(self, pool, pages, file_hash, file_name="", on_progress=None, cancel_event=None):
+        """
+        digest_async の同期版（保存済みならAPIを呼ばずに返す）
+
+        on_progress(段階, 完了数, 総数) は呼び出し元スレッドで呼ばれる。
+        呼び出し元が中断された場合（Streamlitの再実行など）も実行中のリクエストはキャンセルされる。
+
+        Returns:
+            (ダイジェスト本文, キャッシュエントリdict, キャッシュから取得したか)
+        """
+        if self.cache:
+            entry = self.cache.get(file_hash, self.model)
+            if entry is not None:
+                return entry["digest"], entry, True
+
+        def on_event(kind, *payload):
+            if kind == "digest" and on_progress:
+                on_progress(*payload)
+
+        digest, stats = pool.run_async(self.digest_async(pages, cancel_event), on_event=on_event)
+        entry = {
+            "digest": digest,
+            "file_name": file_name,
+            "model": self.model,
+            "prompt_version": DIGEST_PROMPT_VERSION,
+            "pages": len(pages),
+            "created_at": time.time(),
+            **stats,
+        }
+        if self.cache and digest:
+            self.cache.put(file_hash, self.model, entry)
+        return digest, entry, False
+
+
+def format_digest(digest, file_name):
+    """ダイジェストをプロンプトに含める参照データの形式にする"""
+    if not digest:
+        return ""
+    return (
+        f"【アップロード資料の要約ダイジェスト: {file_name}】"
+        f"（資料全体から抽出した事実。出典を記載する際は資料名とページを明記すること）\n\n{digest}"
+    )
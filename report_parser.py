@@ -0,0 +1,319 @@
+# -*- coding: utf-8 -*-
+"""
+分析結果（モデルの出力）の構造化パーサー
+
+出力を先頭から1行ずつ1回だけ読み、セクション・表・スコアJSON・評価根拠・データソースを
+AnalysisReport にまとめる。ストリーミング応答は受信した断片を feed() に渡せば、
+完成した行だけを処理しながら同じ結果を組み立てる（受信済みの全文を毎回走査しない）。
+
+    parser = ReportParser()
+    for chunk in stream:
+        parser.feed(chunk)
+    report = parser.close()
+"""
+
+import json
+import re
+
+from analysis_prompt import METRIC_KEYS
+
+# 出力形式で定義しているセクション（表示順）
+SECTION_NAMES = (
+    "EXECUTIVE_SUMMARY",
+    "COMPARISON_METRICS",
+    "MARKET_ANALYSIS",
+    "COMPETITOR_ANALYSIS",
+    "GAP_ANALYSIS",
+    "ACTION_PLAN",
+    "RISK_OPPORTUNITY",
+    "DATA_SOURCES",
+)
+
+# スコアJSONのキー（analysis_prompt.METRIC_KEYS）と表示名
+METRIC_LABELS = ("市場ポジション", "収益性", "ユーザー基盤", "ブランド力", "技術力")
+METRIC_SIDES = ("competitor", "our_product")
+
+RATIONALE_MARKER = "**各評価の根拠**"
+
+# 「## 見出し」と、セクション名だけの行（「EXECUTIVE_SUMMARY」「**GAP_ANALYSIS**」「# ACTION_PLAN」等）
+HEADING_PATTERN = re.compile(r"^##\s+(.+?)\s*$")
+BARE_SECTION_PATTERN = re.compile(r"^[#*\s]*(" + "|".join(SECTION_NAMES) + r")\b[*\s:：]*(.*)$")
+TABLE_SEPARATOR_PATTERN = re.compile(r"^\|?\s*:?-{2,}:?\s*(\|\s*:?-{2,}:?\s*)*\|?$")
+
+
+class ReportTable:
+    """Markdownの表（ヘッダー行とデータ行）"""
+
+    def __init__(self, header):
+        self.header = header
+        self.rows = []
+
+    def records(self):
+        """[{ヘッダー: 値, ...}, ...]"""
+        return [dict(zip(self.header, row)) for row in self.rows]
+
+
+class ReportSection:
+    """「## 見出し」1つ分のセクション"""
+
+    def __init__(self, name, title):
+        self.name = name      # SECTION_NAMES のいずれか（定義外の見出しは見出し文字列）
+        self.title = title    # 見出し行の文字列（「ACTION_PLAN (自社タイトル向け)」等）
+        self.lines = []
+        self.tables = []
+        self._body = None
+
+    @property
+    def body(self):
+        """見出し行を除いた本文"""
+        if self._body is None:
+            return "\n".join(self.lines).strip()
+        return self._body
+
+    def freeze(self):
+        self._body = "\n".join(self.lines).strip()
+
+
+class AnalysisReport:
+    """構造化された分析結果"""
+
+    def __init__(self, raw, sections, metrics, metrics_error, rationale, preamble):
+        self.raw = raw
+        self.sections = sections            # [ReportSection, ...] 出力順
+        self.metrics = metrics              # {"competitor": {...}, "our_product": {...}} or None
+        self.metrics_error = metrics_error  # スコアJSONの読み取りに失敗した理由（JSONがない・成功ならNone）
+        self.rationale = rationale          # 「**各評価の根拠**」以降の表（なければ空文字）
+        self.preamble = preamble            # 最初の見出しより前の文字列
+        self._by_name = {}
+        for section in sections:
+            self._by_name.setdefault(section.name, section)
+
+    def section(self, name):
+        return self._by_name.get(name)
+
+    @property
+    def summary(self):
+        section = self.section("EXECUTIVE_SUMMARY")
+        return section.body if section else ""
+
+    @property
+    def sources(self):
+        """DATA_SOURCES セクションの表の行（[{列名: 値}, ...]）"""
+        section = self.section("DATA_SOURCES")
+        if section is None:
+            return []
+        return [record for table in section.tables for record in table.records()]
+
+    def detail_sections(self):
+        """詳細分析タブに表示するセクション（サマリー・スコアは別に表示するため除く）"""
+        return [s for s in self.sections if s.name not in ("EXECUTIVE_SUMMARY", "COMPARISON_METRICS") and s.body]
+
+    def metric_rows(self):
+        """[(表示名, 競合スコア, 自社スコア), ...]（スコアがなければ空）"""
+        if not self.metrics:
+            return []
+        return [
+            (label, self.metrics["competitor"][key], self.metrics["our_product"][key])
+            for key, label in zip(METRIC_KEYS, METRIC_LABELS)
+        ]
+
+
+def split_table_row(line):
+    """「| a | b |」を ["a", "b"] に"""
+    cells = line.strip()
+    if cells.startswith("|"):
+        cells = cells[1:]
+    if cells.endswith("|"):
+        cells = cells[:-1]
+    return [cell.strip() for cell in cells.split("|")]
+
+
+def validate_metrics(data):
+    """スコアJSONを検証して数値に揃える（キーの欠落・数値以外・0-100の範囲外ならValueError）"""
+    metrics = {}
+    for side in METRIC_SIDES:
+        values = data.get(side) if isinstance(data, dict) else None
+        if not isinstance(values, dict):
+            raise ValueError(f"'{side}' がありません")
+        try:
+            scores = {key: float(values[key]) for key in METRIC_KEYS}
+        except KeyError as e:
+            raise ValueError(f"'{side}.{e.args[0]}' がありません") from None
+        except (TypeError, ValueError):
+            raise ValueError(f"'{side}' に数値でないスコアがあります") from None
+        out_of_range = [key for key, value in scores.items() if not 0 <= value <= 100]
+        if out_of_range:
+            raise ValueError(f"'{side}.{out_of_range[0]}' が0-100の範囲外です")
+        metrics[side] = {key: int(value) if value.is_integer() else value for key, value in scores.items()}
+    return metrics
+
+
+class ReportParser:
+    """分析結果のインクリメンタルパーサー（1行を1回だけ処理）"""
+
+    def __init__(self):
+        self.sections = []
+        self.current = None
+        self.metrics = None
+        self.metrics_error = None
+        self._raw = []
+        self._pending = ""
+        self._preamble = []
+        self._json_lines = None
+        self._rationale = None
+        self._rationale_open = False
+        self._table = None
+
+    # ---------- 入力 ----------
+
+    def feed(self, chunk):
+        """
+        受信した断片を追加（完成した行だけを処理し、行の途中は次の断片まで保留）
+
+        Returns:
+            今回完成したセクション数（新しい見出しが届くと直前のセクションが完成する）
+        """
+        if not chunk:
+            return 0
+        self._raw.append(chunk)
+        completed_before = self.completed_count
+        text = self._pending + chunk
+        newline = text.rfind("\n")
+        if newline == -1:
+            self._pending = text
+            return 0
+        self._pending = text[newline + 1:]
+        for line in text[:newline].split("\n"):
+            self._line(line)
+        return self.completed_count - completed_before
+
+    def close(self):
+        """残りの行を処理して AnalysisReport を返す"""
+        if self._pending:
+            self._line(self._pending)
+            self._pending = ""
+        self._end_section()
+        if self._json_lines is not None and self.metrics is None and self.metrics_error is None:
+            # 閉じられていないJSONブロックも読めれば使う
+            self._parse_metrics()
+        rationale = "\n".join(self._rationale).strip() if self._rationale else ""
+        return AnalysisReport(
+            "".join(self._raw), self.sections, self.metrics, self.metrics_error,
+            rationale, "\n".join(self._preamble).strip()
+        )
+
+    @property
+    def completed_count(self):
+        """完成したセクション数（生成中のセクションを除く）"""
+        return len(self.sections) - (1 if self.current is not None else 0)
+
+    def snapshot(self):
+        """途中経過: [(見出し, 本文), ...]（最後のセクションは受信途中の行を含む）"""
+        result = [(section.title, section.body) for section in self.sections]
+        if result and self._pending and self.current is not None:
+            title, body = result[-1]
+            result[-1] = (title, f"{body}\n{self._pending}".strip())
+        return result
+
+    # ---------- 1行の処理 ----------
+
+    def _line(self, line):
+        stripped = line.strip()
+
+        # ```json ～ ``` はスコアとして読み取り、本文には残さない
+        if self._json_lines is not None:
+            if stripped.startswith("```"):
+                self._parse_metrics()
+                self._json_lines = None
+            else:
+                self._json_lines.append(line)
+            return
+        if stripped.startswith("```json") and self.metrics is None:
+            self._end_table()
+            self._json_lines = []
+            return
+
+        heading = self._heading(stripped)
+        if heading is not None:
+            name, title = heading
+            if self.current is not None and name == self.current.name and not "".join(self.current.lines).strip():
+                # 「## ACTION_PLAN」の直後にセクション名だけの行が続く場合
+                return
+            self._start_section(name, title)
+            return
+
+        if self.current is None:
+            self._preamble.append(line)
+            return
+
+        self.current.lines.append(line)
+        self._table_line(stripped)
+
+        # 「**各評価の根拠**」から次の見出しまで
+        if self._rationale_open:
+            if stripped.startswith("#"):
+                self._rationale_open = False
+            else:
+                self._rationale.append(line)
+        elif stripped.startswith(RATIONALE_MARKER) and self._rationale is None:
+            self._rationale = [line]
+            self._rationale_open = True
+
+    def _heading(self, stripped):
+        """見出し行なら (セクション名, 見出し文字列)"""
+        match = BARE_SECTION_PATTERN.match(stripped)
+        if match and (stripped.startswith("##") or not match.group(2)):
+            name = match.group(1)
+            title = stripped.lstrip("#* ").rstrip("* ")
+            return name, title
+        match = HEADING_PATTERN.match(stripped)
+        if match:
+            title = match.group(1).strip("* ")
+            return title, title
+        return None
+
+    def _start_section(self, name, title):
+        self._end_section()
+        self.current = ReportSection(name, title)
+        self.sections.append(self.current)
+
+    def _end_section(self):
+        self._end_table()
+        if self.current is not None:
+            self.current.freeze()
+            self.current = None
+        self._rationale_open = False
+
+    # ---------- 表 ----------
+
+    def _table_line(self, stripped):
+        if not stripped.startswith("|"):
+            self._end_table()
+            return
+        if self._table is None:
+            self._table = ReportTable(split_table_row(stripped))
+            self.current.tables.append(self._table)
+        elif not self._table.rows and TABLE_SEPARATOR_PATTERN.match(stripped):
+            return
+        else:
+            self._table.rows.append(split_table_row(stripped))
+
+    def _end_table(self):
+        self._table = None
+
+    # ---------- スコア ----------
+
+    def _parse_metrics(self):
+        try:
+            self.metrics = validate_metrics(json.loads("\n".join(self._json_lines)))
+            self.metrics_error = None
+        except ValueError as e:
+            # json.JSONDecodeError も ValueError
+            self.metrics_error = str(e)
+
+
+def parse_report(text):
+    """分析結果の全文を構造化"""
+    parser = ReportParser()
+    parser.feed(text)
+    return parser.close()
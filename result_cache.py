@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+分析結果のディスクキャッシュ
+
+同一条件（競合・自社タイトル、ジャンル、プラットフォーム、分析タイプ、比較観点、
+既知の数値、プロバイダ・モデル）の分析は、API を呼ばずに保存済みの結果を返す。
+キーは正規化した入力値とプロンプトテンプレートのバージョンのハッシュ。
+有効期限（TTL）と、件数・合計サイズ上限による LRU 削除に対応。
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+import unicodedata
+
+from analysis_prompt import PROMPT_TEMPLATE_VERSION
+
+# 順序に意味のない複数選択項目（ソートして正規化）
+UNORDERED_FIELDS = ("competitor_platform", "our_platform", "comparison_focus")
+
+
+def normalize_value(value):
+    """文字列は NFKC 正規化・前後空白除去・連続空白の圧縮、リストは要素ごとに正規化"""
+    if isinstance(value, str):
+        return " ".join(unicodedata.normalize("NFKC", value).split())
+    if isinstance(value, (list, tuple)):
+        return [normalize_value(v) for v in value]
+    return value
+
+
+def normalize_inputs(inputs: dict) -> dict:
+    """
+    分析入力値を正規化
+
+    表記ゆれ（全角/半角、余分な空白）や複数選択の順序だけが異なる入力を同一視する
+    """
+    normalized = {}
+    for key, value in inputs.items():
+        value = normalize_value(value)
+        if key in UNORDERED_FIELDS and isinstance(value, list):
+            value = sorted(value)
+        normalized[key] = value
+    return normalized
+
+
+def make_cache_key(inputs: dict, provider: str, model: str, reference_data: str = "") -> str:
+    """
+    キャッシュキーを生成
+
+    Args:
+        inputs: 分析入力値（analysis_inputs）
+        provider: AI Provider名
+        model: モデル名
+        reference_data: 参照データ（内容が変われば別キー）
+
+    Returns:
+        SHA-256 ハッシュ（16進）
+    """
+    payload = {
+        "template_version": PROMPT_TEMPLATE_VERSION,
+        "provider": provider,
+        "model": model,
+        "inputs": normalize_inputs(inputs),
+        "reference_sha256": hashlib.sha256(reference_data.encode("utf-8")).hexdigest(),
+    }
+    canonical = json.dumps(payload, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    """
+    分析結果のディスクキャッシュ（1エントリ = 1 JSONファイル）
+
+    最終アクセス時刻はファイルの mtime で管理し、上限超過時は古いものから削除する。
+    プロセス内で共有する前提のためスレッドセーフ。
+    """
+
+    def __init__(self, cache_dir="cache/results", ttl_seconds=7 * 24 * 3600,
+                 max_entries=500, max_bytes=50 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def get(self, key):
+        """
+        キャッシュを取得
+
+        Returns:
+            {"result": str, "created_at": float, "metadata": dict}、なければNone
+        """
+        path = self._path(key)
+        with self._lock:
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    entry = json.load(f)
+            except (OSError, ValueError):
+                self.misses += 1
+                return None
+
+            if time.time() - entry.get("created_at", 0) > self.ttl_seconds:
+                self._remove(path)
+                self.misses += 1
+                return None
+
+            # LRU: 最終アクセス時刻を更新
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+            self.hits += 1
+            return entry
+
+    def put(self, key, result, metadata=None):
+        """分析結果を保存し、上限を超えていれば古いエントリを削除"""
+        entry = {
+            "result": result,
+            "created_at": time.time(),
+            "metadata": metadata or {},
+        }
+        path = self._path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+
+        with self._lock:
+            try:
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump(entry, f, ensure_ascii=False)
+                os.replace(tmp_path, path)
+            except OSError as e:
+                print(f"結果キャッシュ保存エラー: {e}")
+                self._remove(tmp_path)
+                return
+            self._evict()
+
+    def update_metadata(self, key, **fields):
+        """保存済みエントリのメタデータに項目を追加（保存日時・結果本文はそのまま）"""
+        path = self._path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with self._lock:
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    entry = json.load(f)
+                entry.setdefault("metadata", {}).update(fields)
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump(entry, f, ensure_ascii=False)
+                os.replace(tmp_path, path)
+            except (OSError, ValueError) as e:
+                print(f"結果キャッシュ更新エラー: {e}")
+                self._remove(tmp_path)
+
+    def stats(self):
+        """ヒット/ミス回数とヒット率"""
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def _evict(self):
+        """期限切れを削除し、件数・サイズ上限を超えた分を最終アクセスの古い順に削除"""
+        now = time.time()
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(".json"):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        entries.sort()
+        total_bytes = sum(size for _, size, _ in entries)
+
+        while entries and (len(entries) > self.max_entries or total_bytes > self.max_bytes
+                           or now - entries[0][0] > self.ttl_seconds):
+            _, size, path = entries.pop(0)
+            self._remove(path)
+            total_bytes -= size
@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+"""
+セクション並列生成（AsyncAnthropic / AsyncOpenAI）
+
+1回の8000トークン生成ではなく、セクションごとに1リクエストを同時に発行し、
+結果を通常の分析結果と同じ「## セクション名」形式の文字列に結合する。
+全リクエストは同じ静的プレフィックスを共有するため、Claudeでは
+最初の1リクエストが応答を始めてから残りを発行し、キャッシュ読み取りに乗せる。
+"""
+
+import asyncio
+
+from analysis_prompt import (
+    CLAUDE_PROVIDER,
+    OPENAI_PROVIDER,
+    build_claude_request,
+    build_openai_messages,
+    extract_cache_usage,
+)
+from llm_client import post_event
+from rate_limiter import estimate_request_tokens
+
+# 結合時の並び順（通常の分析結果と同じ）と各セクションの最大出力トークン
+SECTION_SPECS = [
+    ("EXECUTIVE_SUMMARY", 600),
+    ("COMPARISON_METRICS", 2000),
+    ("MARKET_ANALYSIS", 1500),
+    ("COMPETITOR_ANALYSIS", 1500),
+    ("GAP_ANALYSIS", 1500),
+    ("ACTION_PLAN", 1500),
+    ("RISK_OPPORTUNITY", 1500),
+    ("DATA_SOURCES", 1200),
+]
+
+# 先行リクエストの応答開始を待つ最大秒数（超えたらキャッシュを諦めて発行）
+PREFIX_WARMUP_TIMEOUT = 20.0
+
+
+def section_instruction(section_name: str) -> str:
+    """動的サフィックスの末尾に付ける「このセクションのみ出力」指示"""
+    return (
+        f"\n\n**【今回の出力範囲】** 上記の出力形式のうち「## {section_name}」セクションのみを出力してください。"
+        f"必ず「## {section_name}」の見出し行から始め、他のセクションは出力しないでください。"
+    )
+
+
+def normalize_section_text(section_name: str, text: str) -> str:
+    """見出しの前置き・指示外のセクションを除去し、見出しが欠けていれば補う"""
+    text = (text or "").strip()
+    heading_pos = text.find(f"## {section_name}")
+    if heading_pos > 0:
+        text = text[heading_pos:]
+    elif heading_pos == -1:
+        text = f"## {section_name}\n{text}"
+
+    # 指示に反して後続セクションまで出力された場合は切り捨てる
+    next_heading = text.find("\n## ", len(section_name) + 3)
+    if next_heading != -1:
+        text = text[:next_heading]
+    return text.rstrip()
+
+
+def merge_sections(section_texts: dict) -> str:
+    """セクションごとの結果をSECTION_SPECSの順に結合"""
+    parts = [
+        normalize_section_text(name, section_texts[name])
+        for name, _ in SECTION_SPECS
+        if section_texts.get(name)
+    ]
+    return "\n\n".join(parts) + "\n"
+
+
+def sum_usage(usages: list) -> dict:
+    """セクションごとのusageを合計"""
+    total = {}
+    for usage in usages:
+        for key, value in usage.items():
+            total[key] = total.get(key, 0) + value
+    return total
+
+
+async def _claude_section(pool, client, base_request, section_name, max_tokens, semaphore, prefix_ready, is_leader):
+    """Claudeで1セクションを生成（先頭以外はプレフィックスのキャッシュ作成を待つ）"""
+    if not is_leader:
+        try:
+            await asyncio.wait_for(prefix_ready.wait(), timeout=PREFIX_WARMUP_TIMEOUT)
+        except asyncio.TimeoutError:
+            pass
+
+    messages = [dict(message) for message in base_request["messages"]]
+    messages[-1]["content"] = messages[-1]["content"] + section_instruction(section_name)
+    request_kwargs = {**base_request, "messages": messages, "max_tokens": max_tokens}
+
+    async def attempt():
+        chunks = []
+        try:
+            async with client.messages.stream(**request_kwargs) as stream:
+                async for text in stream.text_stream:
+                    prefix_ready.set()
+                    chunks.append(text)
+                message = await stream.get_final_message()
+        finally:
+            # 失敗時も後続を待たせ続けない
+            prefix_ready.set()
+        return "".join(chunks), extract_cache_usage(message.usage)
+
+    async with semaphore:
+        return await pool.call_async(
+            CLAUDE_PROVIDER, base_request["model"], attempt, tokens=estimate_request_tokens(request_kwargs)
+        )
+
+
+async def _openai_section(pool, client, base_request, section_name, max_tokens, semaphore):
+    """OpenAIで1セクションを生成（プレフィックスは自動キャッシュ）"""
+    messages = [dict(message) for message in base_request["messages"]]
+    messages[-1]["content"] = messages[-1]["content"] + section_instruction(section_name)
+    request_kwargs = {**base_request, "messages": messages, "max_tokens": max_tokens}
+
+    async def attempt():
+        response = await client.chat.completions.create(**request_kwargs)
+        return response.choices[0].message.content, extract_cache_usage(response.usage)
+
+    async with semaphore:
+        return await pool.call_async(
+            OPENAI_PROVIDER, base_request["model"], attempt, tokens=estimate_request_tokens(request_kwargs)
+        )
+
+
+async def generate_sections_async(pool, provider, api_key, model, temperature, inputs, use_opus=False,
+                                  reference_data="", max_concurrency=4):
+    """
+    全セクションを並列生成して結合
+
+    セクション完了ごとに post_event("section", セクション名, 本文, 完了数, 総数) を通知する。
+
+    Args:
+        pool: LLMClientPool
+        provider: "Claude (Anthropic)" または "OpenAI (GPT)"
+        api_key: APIキー
+        model: モデル名
+        temperature: temperature
+        inputs: 分析入力値（analysis_inputs）
+        use_opus: Opus 4用のプロンプトを使うか
+        reference_data: 参照データ
+        max_concurrency: 同時リクエスト数の上限
+
+    Returns:
+        (結合した分析結果, 合計usage)
+    """
+    semaphore = asyncio.Semaphore(max(1, max_concurrency))
+    is_claude = provider == CLAUDE_PROVIDER
+    client = pool.async_client(provider, api_key)
+
+    if is_claude:
+        base_request = {
+            "model": model,
+            "temperature": temperature,
+            **build_claude_request(inputs, use_opus, reference_data)
+        }
+        prefix_ready = asyncio.Event()
+    else:
+        base_request = {
+            "model": model,
+            "temperature": temperature,
+            "messages": build_openai_messages(inputs, reference_data)
+        }
+
+    async def run(index, section_name, max_tokens):
+        if is_claude:
+            text, usage = await _claude_section(
+                pool, client, base_request, section_name, max_tokens, semaphore, prefix_ready, index == 0
+            )
+        else:
+            text, usage = await _openai_section(pool, client, base_request, section_name, max_tokens, semaphore)
+        return section_name, text, usage
+
+    tasks = [
+        asyncio.ensure_future(run(index, name, max_tokens))
+        for index, (name, max_tokens) in enumerate(SECTION_SPECS)
+    ]
+
+    section_texts = {}
+    usages = []
+    try:
+        for finished in asyncio.as_completed(tasks):
+            section_name, text, usage = await finished
+            section_texts[section_name] = text
+            usages.append(usage)
+            post_event("section", section_name, text, len(section_texts), len(SECTION_SPECS))
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+
+    return merge_sections(section_texts), sum_usage(usages)
+
+
+def generate_sections(pool, *args, on_section=None, **kwargs):
+    """
+    generate_sections_async の同期版（Streamlitのスクリプトスレッドから呼ぶ）
+
+    on_section(セクション名, 本文, 完了数, 総数) は呼び出し元スレッドで呼ばれる。
+    """
+    def on_event(kind, *payload):
+        if kind == "section" and on_section:
+            on_section(*payload)
+
+    return pool.run_async(generate_sections_async(pool, *args, **kwargs), on_event=on_event)
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+COMPARISON_METRICS のスコアを構造化出力で取得
+
+本文中の ```json ブロックが欠けている・壊れている場合でも、レーダーチャートのために
+8000トークンの分析全体を再実行せず、スコアだけを小さな呼び出しで取り直す。
+Claude は tool use、OpenAI は response_format の JSON schema でスキーマに沿った出力を強制し、
+受け取った値は report_parser.validate_metrics で検証する。
+"""
+
+import json
+
+from analysis_prompt import CLAUDE_PROVIDER, METRICS_TOOL_NAME, build_metrics_request, extract_cache_usage
+from rate_limiter import estimate_request_tokens
+from report_parser import validate_metrics
+
+# レポートから抜き出して渡す評価部分の上限（文字）
+REPORT_EXCERPT_CHARS = 4000
+
+
+def report_excerpt(report):
+    """スコアの根拠になる部分（根拠表・サマリー）を抜き出す"""
+    if report is None:
+        return ""
+    parts = []
+    if report.rationale:
+        parts.append(report.rationale)
+    elif report.section("COMPARISON_METRICS") is not None:
+        parts.append(report.section("COMPARISON_METRICS").body)
+    if report.summary:
+        parts.append(f"（エグゼクティブサマリー）\n{report.summary}")
+    return "\n\n".join(parts)[:REPORT_EXCERPT_CHARS]
+
+
+def fetch_metrics(pool, provider, api_key, model, inputs, report=None):
+    """
+    スコアだけを構造化出力で取得
+
+    Args:
+        pool: LLMClientPool
+        provider: AI Provider名
+        api_key: APIキー
+        model: モデル名（安価なモデルで十分）
+        inputs: 分析入力値
+        report: 生成済みの AnalysisReport（あればその評価内容に合わせたスコアにする）
+
+    Returns:
+        (スコアdict, usage)
+
+    Raises:
+        ValueError: 応答がスキーマに合わない
+    """
+    request_kwargs = {"model": model, **build_metrics_request(provider, inputs, report_excerpt(report))}
+
+    if provider == CLAUDE_PROVIDER:
+        message = pool.call(
+            provider, model, api_key, lambda client: client.messages.create(**request_kwargs),
+            tokens=estimate_request_tokens(request_kwargs)
+        )
+        tool_inputs = [
+            block.input for block in message.content
+            if getattr(block, "type", "") == "tool_use" and block.name == METRICS_TOOL_NAME
+        ]
+        if not tool_inputs:
+            raise ValueError("スコアのツール呼び出しが応答に含まれていません")
+        data = tool_inputs[0]
+        usage = message.usage
+    else:
+        response = pool.call(
+            provider, model, api_key, lambda client: client.chat.completions.create(**request_kwargs),
+            tokens=estimate_request_tokens(request_kwargs)
+        )
+        choice = response.choices[0].message
+        if getattr(choice, "refusal", None):
+            raise ValueError(f"スコアの出力が拒否されました: {choice.refusal}")
+        data = json.loads(choice.content or "")
+        usage = response.usage
+
+    return validate_metrics(data), extract_cache_usage(usage)
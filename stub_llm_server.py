@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+ローカル検証用のスタブLLMサーバー
+
+Anthropic Messages API（通常・ストリーミング・tool use・Message Batches・count_tokens）と
+OpenAI Chat Completions API（通常・ストリーミング・JSON schema）の最小限の互換エンドポイントを提供し、
+固定の分析レポート（スコアを要求された場合は固定のスコア）を返す。APIキーなし・課金なしでバッチ分析やUIの動作確認ができる。
+
+使い方:
+    python stub_llm_server.py --port 8765 --delay 0.5
+    python batch_analysis.py competitors.csv --base-url http://127.0.0.1:8765
+"""
+
+import argparse
+import json
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+STUB_REPORT = """## EXECUTIVE_SUMMARY
+（スタブ応答）競合タイトルは市場上位に位置する。自社タイトルは技術力で差別化を図る。
+
+## COMPARISON_METRICS
+
+```json
+{
+  "competitor": {"market_position": 85, "revenue_potential": 75, "user_base": 80, "brand_strength": 90, "technology": 70},
+  "our_product": {"market_position": 40, "revenue_potential": 60, "user_base": 30, "brand_strength": 45, "technology": 75}
+}
+```
+
+**各評価の根拠**（必ず具体的な要素を列挙）:
+
+| 評価軸 | 競合スコア | 根拠となる具体的要素 | 自社スコア | 根拠となる具体的要素 |
+|-------|----------|-------------------|----------|-------------------|
+| 市場ポジション | 85点 | 国内売上TOP3 | 40点 | 新規タイトル |
+
+## MARKET_ANALYSIS
+### 市場規模とトレンド
+
+| 項目 | 競合タイトル | 自社タイトル |
+|------|-------------|-------------|
+| 推定年間売上 | 500億円（市場データ参照） | 100億円（目標） |
+
+## COMPETITOR_ANALYSIS
+
+| 評価軸 | 競合タイトル | 自社タイトル |
+|--------|-------------|-------------|
+| **強み1** | IP力 | 技術力 |
+
+## GAP_ANALYSIS
+
+| 評価項目 | 現状のギャップ | 重要度 | 対応優先度 |
+|----------|---------------|--------|-----------|
+| 市場認知度 | 競合が45点優位 | 高 | 高 |
+
+## ACTION_PLAN (自社タイトル向け)
+
+| No | 施策 | 目的 | 実行内容 | 期待効果 | 優先度 |
+|----|------|------|---------|---------|--------|
+| 1 | 事前登録 | 認知拡大 | SNS広告 | 登録50万 | 高 |
+
+## RISK_OPPORTUNITY (自社タイトル向け)
+
+| リスク項目 | 内容 | 発生確率 | 影響度 | 対策 |
+|-----------|------|---------|--------|------|
+| 競争激化 | 同ジャンル新作 | 高 | 中 | 差別化 |
+
+## DATA_SOURCES
+
+| データ項目 | 出典 | 詳細（ページ/URL） | 信頼性 |
+|----------|------|------------------|--------|
+| 市場規模 | 2024年度国内ゲーム市場データ（提供データ） | - | 中 |
+"""
+
+# tool use / JSON schema で要求されたときに返すスコア
+STUB_METRICS = {
+    "competitor": {"market_position": 85, "revenue_potential": 75, "user_base": 80, "brand_strength": 90, "technology": 70},
+    "our_product": {"market_position": 40, "revenue_potential": 60, "user_base": 30, "brand_strength": 45, "technology": 75},
+}
+
+# 文字数から概算したスタブ用のusage
+STUB_USAGE = {"input_tokens": 1200, "output_tokens": 900}
+
+# Message Batches の状態（プロセス内のみ）
+_batches = {}
+_batches_lock = threading.Lock()
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """スタブAPIのリクエストハンドラ"""
+
+    delay = 0.0
+    chunk_delay = 0.0
+    chunk_chars = 40
+    report = STUB_REPORT
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_json(self):
+        length = int(self.headers.get("content-length") or 0)
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def _send_json(self, payload, status=200):
+        data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("content-type", "application/json")
+        self.send_header("content-length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _start_sse(self):
+        self.send_response(200)
+        self.send_header("content-type", "text/event-stream")
+        self.send_header("cache-control", "no-cache")
+        self.end_headers()
+
+    def do_POST(self):
+        body = self._read_json()
+        time.sleep(self.delay)
+
+        if self.path.rstrip("/").endswith("/messages/count_tokens"):
+            return self._anthropic_count_tokens(body)
+        if self.path.rstrip("/").endswith("/messages/batches"):
+            return self._anthropic_batch_create(body)
+        if self.path.rstrip("/").endswith("/messages"):
+            return self._anthropic_messages(body)
+        if self.path.rstrip("/").endswith("/chat/completions"):
+            return self._openai_chat(body)
+        self._send_json({"error": {"message": f"not found: {self.path}"}}, status=404)
+
+    def do_GET(self):
+        match = re.search(r"/messages/batches/([^/]+)(/results)?$", self.path.split("?")[0])
+        if not match:
+            return self._send_json({"error": {"message": f"not found: {self.path}"}}, status=404)
+        with _batches_lock:
+            batch = _batches.get(match.group(1))
+        if batch is None:
+            return self._send_json({"error": {"message": "batch not found"}}, status=404)
+        if match.group(2):
+            return self._anthropic_batch_results(batch)
+        return self._send_json(self._batch_object(batch))
+
+    # ---------- Anthropic Messages ----------
+
+    def _anthropic_message(self, model):
+        return {
+            "id": f"msg_{uuid.uuid4().hex[:12]}",
+            "type": "message",
+            "role": "assistant",
+            "model": model,
+            "content": [{"type": "text", "text": self.report}],
+            "stop_reason": "end_turn",
+            "stop_sequence": None,
+            "usage": {**STUB_USAGE, "cache_creation_input_tokens": 0, "cache_read_input_tokens": 0},
+        }
+
+    def _anthropic_messages(self, body):
+        message = self._anthropic_message(body.get("model"))
+        tool_choice = body.get("tool_choice") or {}
+        if tool_choice.get("type") == "tool":
+            # ツール指定の呼び出しにはスコアを入力としたtool_useを返す
+            message.update(
+                content=[{"type": "tool_use", "id": f"toolu_{uuid.uuid4().hex[:12]}",
+                          "name": tool_choice["name"], "input": STUB_METRICS}],
+                stop_reason="tool_use",
+            )
+            return self._send_json(message)
+        if not body.get("stream"):
+            return self._send_json(message)
+
+        self._start_sse()
+
+        def event(name, data):
+            self.wfile.write(f"event: {name}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+
+        event("message_start", {
+            "type": "message_start",
+            "message": {**message, "content": [], "stop_reason": None,
+                        "usage": {**message["usage"], "output_tokens": 1}},
+        })
+        event("content_block_start", {"type": "content_block_start", "index": 0,
+                                      "content_block": {"type": "text", "text": ""}})
+        for i in range(0, len(self.report), self.chunk_chars):
+            if i:
+                time.sleep(self.chunk_delay)
+            event("content_block_delta", {"type": "content_block_delta", "index": 0,
+                                          "delta": {"type": "text_delta", "text": self.report[i:i + self.chunk_chars]}})
+        event("content_block_stop", {"type": "content_block_stop", "index": 0})
+        event("message_delta", {"type": "message_delta",
+                                "delta": {"stop_reason": "end_turn", "stop_sequence": None},
+                                "usage": {"output_tokens": STUB_USAGE["output_tokens"]}})
+        event("message_stop", {"type": "message_stop"})
+
+    def _anthropic_count_tokens(self, body):
+        # 実際のトークナイザではなく、非ASCII文字は1文字1トークン・ASCIIは4文字1トークンの近似
+        text = json.dumps(body.get("messages", []), ensure_ascii=False) + json.dumps(body.get("system", ""),
+                                                                                     ensure_ascii=False)
+        non_ascii = sum(1 for ch in text if ord(ch) >= 128)
+        self._send_json({"input_tokens": non_ascii + (len(text) - non_ascii) // 4})
+
+    # ---------- Anthropic Message Batches ----------
+
+    def _batch_object(self, batch):
+        ended = time.time() >= batch["ends_at"]
+        count = len(batch["requests"])
+        return {
+            "id": batch["id"],
+            "type": "message_batch",
+            "processing_status": "ended" if ended else "in_progress",
+            "request_counts": {"processing": 0 if ended else count, "succeeded": count if ended else 0,
+                               "errored": 0, "canceled": 0, "expired": 0},
+            "created_at": "2025-01-01T00:00:00Z",
+            "expires_at": "2025-01-02T00:00:00Z",
+            "ended_at": "2025-01-01T00:01:00Z" if ended else None,
+            "archived_at": None,
+            "cancel_initiated_at": None,
+            "results_url": (f"http://{self.headers.get('host')}/v1/messages/batches/{batch['id']}/results"
+                            if ended else None),
+        }
+
+    def _anthropic_batch_create(self, body):
+        batch = {
+            "id": f"msgbatch_{uuid.uuid4().hex[:12]}",
+            "requests": body.get("requests", []),
+            "ends_at": time.time() + max(self.delay, 1.0),
+        }
+        with _batches_lock:
+            _batches[batch["id"]] = batch
+        self._send_json(self._batch_object(batch))
+
+    def _anthropic_batch_results(self, batch):
+        lines = [
+            json.dumps({
+                "custom_id": request["custom_id"],
+                "result": {"type": "succeeded",
+                           "message": self._anthropic_message(request["params"].get("model"))},
+            }, ensure_ascii=False)
+            for request in batch["requests"]
+        ]
+        data = ("\n".join(lines) + "\n").encode("utf-8")
+        self.send_response(200)
+        self.send_header("content-type", "application/binary")
+        self.send_header("content-length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    # ---------- OpenAI Chat Completions ----------
+
+    def _openai_chat(self, body):
+        usage = {"prompt_tokens": STUB_USAGE["input_tokens"], "completion_tokens": STUB_USAGE["output_tokens"],
+                 "total_tokens": sum(STUB_USAGE.values()), "prompt_tokens_details": {"cached_tokens": 0}}
+        base = {"id": f"chatcmpl-{uuid.uuid4().hex[:12]}", "created": int(time.time()), "model": body.get("model")}
+
+        if not body.get("stream"):
+            # JSON schema 指定の呼び出しにはスコアのJSONを返す
+            is_schema = (body.get("response_format") or {}).get("type") == "json_schema"
+            content = json.dumps(STUB_METRICS) if is_schema else self.report
+            return self._send_json({
+                **base,
+                "object": "chat.completion",
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content},
+                             "finish_reason": "stop"}],
+                "usage": usage,
+            })
+
+        self._start_sse()
+        for i in range(0, len(self.report), self.chunk_chars):
+            if i:
+                time.sleep(self.chunk_delay)
+            chunk = {**base, "object": "chat.completion.chunk",
+                     "choices": [{"index": 0, "delta": {"content": self.report[i:i + self.chunk_chars]},
+                                  "finish_reason": None}]}
+            self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+        if (body.get("stream_options") or {}).get("include_usage"):
+            chunk = {**base, "object": "chat.completion.chunk", "choices": [], "usage": usage}
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ローカル検証用のスタブLLMサーバー")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--delay", type=float, default=0.0, help="応答前の待ち時間（秒）")
+    parser.add_argument("--chunk-delay", type=float, default=0.0,
+                        help="ストリーミング応答の断片の間隔（秒、最初のトークン後も生成が続く応答の確認用）")
+    parser.add_argument("--without-metrics-json", action="store_true",
+                        help="分析結果からスコアのJSONブロックを除く（構造化出力での再取得の確認用）")
+    args = parser.parse_args()
+
+    StubHandler.delay = args.delay
+    StubHandler.chunk_delay = args.chunk_delay
+    if args.without_metrics_json:
+        StubHandler.report = re.sub(r"```json\n.*?```\n", "", STUB_REPORT, flags=re.S)
+    server = ThreadingHTTPServer((args.host, args.port), StubHandler)
+    print(f"Stub LLM server: http://{args.host}:{args.port}")
+    print(f"  Anthropic: --base-url http://{args.host}:{args.port}")
+    print(f"  OpenAI:    --base-url http://{args.host}:{args.port}/v1")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
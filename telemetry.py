@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+"""
+分析ごとの利用量・所要時間の記録（SQLite）と管理画面向けの集計
+
+アクセスログ（audit_log）は「分析を実行した」ことしか分からないため、分析1件ごとに
+Provider・モデル・temperature・トークン数（キャッシュ作成・読み取りを含む）・最初のトークンまでの時間・
+全体の所要時間・レポートの解析とレーダーチャートの成否を1行として記録する。
+スコアを構造化出力で取り直した場合は、その呼び出しも別の行（kind="metrics"）として記録する。
+
+記録は分析ジョブのワーカースレッドから1件ずつ書き込む（画面の操作は待たせない）。
+"""
+
+import os
+import sqlite3
+from datetime import datetime, timedelta
+
+from audit_log import connect
+
+# 1件の記録の列（id以外）
+METRIC_COLUMNS = (
+    "timestamp",
+    "job_id",
+    "kind",                          # "analysis"（分析本体）/ "metrics"（スコアの構造化出力）
+    "username",
+    "provider",
+    "model",
+    "temperature",
+    "mode",                          # "stream" / "call" / "parallel" / "hedge" / "cache"
+    "status",                        # "done" / "error" / "cancelled"
+    "result_cache_hit",
+    "input_tokens",
+    "output_tokens",
+    "cache_creation_input_tokens",
+    "cache_read_input_tokens",
+    "ttft_ms",                       # 最初のトークンまで（ストリーミング時のみ）
+    "latency_ms",
+    "parse_ok",                      # 全セクションを読み取れたか
+    "radar_ok",                      # レーダーチャートのスコアがそろったか
+    "metrics_source",                # "本文" / "構造化出力" / "保存済み" / None
+    "error",
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS analysis_metrics (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    timestamp TEXT NOT NULL,
+    job_id TEXT,
+    kind TEXT NOT NULL,
+    username TEXT,
+    provider TEXT,
+    model TEXT,
+    temperature REAL,
+    mode TEXT,
+    status TEXT NOT NULL,
+    result_cache_hit INTEGER,
+    input_tokens INTEGER,
+    output_tokens INTEGER,
+    cache_creation_input_tokens INTEGER,
+    cache_read_input_tokens INTEGER,
+    ttft_ms REAL,
+    latency_ms REAL,
+    parse_ok INTEGER,
+    radar_ok INTEGER,
+    metrics_source TEXT,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_analysis_metrics_timestamp ON analysis_metrics (timestamp);
+"""
+
+TOKEN_FIELDS = ("input_tokens", "output_tokens", "cache_creation_input_tokens", "cache_read_input_tokens")
+
+# 概算コスト用の単価（USD / 100万トークン: 入力・出力・キャッシュ作成・キャッシュ読み取り、各社の公開価格）
+MODEL_PRICES = {
+    "claude-sonnet-4-20250514": (3.00, 15.00, 3.75, 0.30),
+    "claude-opus-4-20250514": (15.00, 75.00, 18.75, 1.50),
+    "claude-3-5-haiku-20241022": (0.80, 4.00, 1.00, 0.08),
+    "gpt-4o": (2.50, 10.00, 2.50, 1.25),
+    "gpt-4o-mini": (0.15, 0.60, 0.15, 0.075),
+}
+
+
+def estimate_cost(model, usage):
+    """usage（extract_cache_usage の dict）の概算コスト（USD、単価が不明なモデルはNone）"""
+    prices = MODEL_PRICES.get(model)
+    if prices is None:
+        return None
+    return sum((usage.get(field) or 0) * price for field, price in zip(TOKEN_FIELDS, prices)) / 1_000_000
+
+
+def percentile(values, q):
+    """最近傍順位法のパーセンタイル（値がなければNone）"""
+    values = sorted(value for value in values if value is not None)
+    if not values:
+        return None
+    rank = max(1, -(-len(values) * q // 100))
+    return values[int(rank) - 1]
+
+
+class MetricsStore:
+    """分析ごとの利用量・所要時間のSQLiteストア"""
+
+    def __init__(self, db_path="logs/metrics.db"):
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        conn = connect(db_path)
+        try:
+            conn.executescript(SCHEMA)
+        finally:
+            conn.close()
+
+    def record(self, entry):
+        """
+        1件記録する（entry は METRIC_COLUMNS のキーを持つ dict、足りない列はNULL）
+
+        記録の失敗で分析をエラーにしないよう、例外は出力して握りつぶす。
+        """
+        row = {**entry, "timestamp": entry.get("timestamp") or datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
+        try:
+            conn = connect(self.db_path)
+            try:
+                with conn:
+                    conn.execute(
+                        f"INSERT INTO analysis_metrics ({', '.join(METRIC_COLUMNS)}) "
+                        f"VALUES ({', '.join('?' * len(METRIC_COLUMNS))})",
+                        [row.get(column) for column in METRIC_COLUMNS]
+                    )
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            print(f"利用状況の記録エラー: {e}")
+
+    def query(self, start_date=None, end_date=None):
+        """期間内の記録（start_date・end_date は date、両端を含む。古い順、dictのリスト）"""
+        where, params = [], []
+        if start_date is not None:
+            where.append("timestamp >= ?")
+            params.append(start_date.strftime("%Y-%m-%d"))
+        if end_date is not None:
+            where.append("timestamp < ?")
+            params.append((end_date + timedelta(days=1)).strftime("%Y-%m-%d"))
+        sql = (
+            f"SELECT id, {', '.join(METRIC_COLUMNS)} FROM analysis_metrics"
+            f"{' WHERE ' + ' AND '.join(where) if where else ''}"
+            " ORDER BY timestamp, id"
+        )
+        conn = connect(self.db_path, read_only=True)
+        try:
+            return [dict(row) for row in conn.execute(sql, params).fetchall()]
+        finally:
+            conn.close()
+
+
+def summarize(rows):
+    """
+    管理画面の集計
+
+    Returns:
+        {"analyses", "errors", "latency_p50", "latency_p95", "ttft_p50", "ttft_p95",
+         "result_cache_hit_rate", "prompt_cache_rate", "parse_rate", "radar_rate", "cost",
+         "by_model": [{"model", "calls", "input_tokens", ..., "cost", "latency_p50", "latency_p95"}, ...],
+         "daily": [{"day", "model", "tokens", "cost"}, ...]}
+        所要時間は正常に完了した分析（結果キャッシュのヒットを除く）のミリ秒。
+    """
+    analyses = [row for row in rows if row["kind"] == "analysis"]
+    done = [row for row in analyses if row["status"] == "done"]
+    generated = [row for row in done if not row["result_cache_hit"]]
+
+    def rate(items, field):
+        return sum(1 for row in items if row[field]) / len(items) if items else None
+
+    by_model = {}
+    daily = {}
+    for row in rows:
+        if not row["model"] or row["result_cache_hit"]:
+            continue
+        usage = {field: row[field] or 0 for field in TOKEN_FIELDS}
+        cost = estimate_cost(row["model"], usage)
+        entry = by_model.setdefault(row["model"], {
+            "model": row["model"], "calls": 0, **dict.fromkeys(TOKEN_FIELDS, 0), "cost": 0.0, "latencies": []
+        })
+        entry["calls"] += 1
+        for field in TOKEN_FIELDS:
+            entry[field] += usage[field]
+        if cost is None:
+            entry["cost"] = None
+        elif entry["cost"] is not None:
+            entry["cost"] += cost
+        if row["kind"] == "analysis" and row["status"] == "done":
+            entry["latencies"].append(row["latency_ms"])
+
+        day = daily.setdefault((row["timestamp"][:10], row["model"]), {
+            "day": row["timestamp"][:10], "model": row["model"], "tokens": 0, "cost": 0.0
+        })
+        day["tokens"] += sum(usage.values())
+        day["cost"] += cost or 0.0
+
+    for entry in by_model.values():
+        latencies = entry.pop("latencies")
+        entry["latency_p50"] = percentile(latencies, 50)
+        entry["latency_p95"] = percentile(latencies, 95)
+
+    prompt_tokens = sum(
+        (row["input_tokens"] or 0) + (row["cache_creation_input_tokens"] or 0) + (row["cache_read_input_tokens"] or 0)
+        for row in generated
+    )
+    cache_read = sum(row["cache_read_input_tokens"] or 0 for row in generated)
+    return {
+        "analyses": len(analyses),
+        "errors": sum(1 for row in analyses if row["status"] == "error"),
+        "latency_p50": percentile([row["latency_ms"] for row in generated], 50),
+        "latency_p95": percentile([row["latency_ms"] for row in generated], 95),
+        "ttft_p50": percentile([row["ttft_ms"] for row in generated], 50),
+        "ttft_p95": percentile([row["ttft_ms"] for row in generated], 95),
+        "result_cache_hit_rate": rate(done, "result_cache_hit"),
+        "prompt_cache_rate": cache_read / prompt_tokens if prompt_tokens else None,
+        "parse_rate": rate(done, "parse_ok"),
+        "radar_rate": rate(done, "radar_ok"),
+        "cost": sum(entry["cost"] or 0.0 for entry in by_model.values()),
+        "by_model": sorted(by_model.values(), key=lambda entry: -entry["calls"]),
+        "daily": sorted(daily.values(), key=lambda day: (day["day"], day["model"])),
+    }
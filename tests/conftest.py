@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""テスト共通: リポジトリ直下のモジュールの読み込みとスタブLLMサーバーの起動"""
+
+import os
+import sys
+import threading
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from stub_llm_server import StubHandler  # noqa: E402
+
+
+class RequestLog(list):
+    """受け付けたリクエストのパス（connections はリクエストを受けたソケット）"""
+
+    def __init__(self):
+        super().__init__()
+        self.connections = []
+
+
+class StubServer(ThreadingHTTPServer):
+    # 応答待ちのリクエストが残っていても終了を待たない（キャンセルの確認用）
+    daemon_threads = True
+    block_on_close = False
+
+    def handle_error(self, request, client_address):
+        # 打ち切ったリクエストへの応答の書き込みエラーは表示しない
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+@pytest.fixture
+def start_stub_server():
+    """
+    スタブLLMサーバーを空いているポートで起動する関数（ベースURLを返す、OpenAIは + "/v1"）
+
+    delay を指定すると応答前に待ち、chunk_delay を指定するとストリーミング応答の断片の間で待つ。
+    受け付けたリクエストのパスは返り値の received（RequestLog）に記録する。
+    """
+    servers = []
+
+    def start(delay=0.0, chunk_delay=0.0):
+        received = RequestLog()
+
+        class Handler(StubHandler):
+            def do_POST(self):
+                received.append(self.path)
+                received.connections.append(self.connection)
+                super().do_POST()
+
+        Handler.delay = delay
+        Handler.chunk_delay = chunk_delay
+        server = StubServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        base_url = f"http://127.0.0.1:{server.server_address[1]}"
+        return base_url, received
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture
+def stub_server(start_stub_server):
+    """遅延なしのスタブLLMサーバーのベースURL"""
+    base_url, _ = start_stub_server()
+    return base_url
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""analysis_jobs: 同じリクエストの実行中ジョブへの相乗り（single-flight）と中止"""
+
+import threading
+from concurrent.futures import wait
+
+import pytest
+
+from analysis_jobs import JOB_CANCELLED, JOB_DONE, AnalysisJobQueue, JobCancelledError
+
+
+@pytest.fixture
+def queue():
+    queue = AnalysisJobQueue(max_workers=2)
+    yield queue
+    # テストが途中で失敗しても実行中のジョブを終わらせる（ワーカーが残ると終了できない）
+    for job in list(queue._jobs.values()):
+        queue.cancel(job.id)
+    queue._executor.shutdown(wait=True, cancel_futures=True)
+
+
+def blocking(release, calls):
+    """release がセットされるまで終わらないジョブ（中止されたら JobCancelledError）"""
+    def run(job):
+        calls.append(job.id)
+        while not release.wait(0.01):
+            job.check_cancelled()
+        return "結果"
+    return run
+
+
+def wait_finished(queue, job_id):
+    # 実行前に中止したジョブの future は cancel 済みのため、result() ではなく wait() で待つ
+    job = queue.get(job_id)
+    assert wait([job._future], timeout=5).done
+    return job
+
+
+def test_same_key_attaches_to_the_running_job(queue):
+    release, calls = threading.Event(), []
+    first = queue.submit("alice", "A vs B", blocking(release, calls), key="k")
+    second = queue.submit("bob", "A vs B", blocking(release, calls), key="k")
+    other = queue.submit("carol", "A vs B", blocking(release, calls), key="other")
+
+    assert second == first != other
+    assert queue.get(first).owners == {"alice", "bob"}
+    assert [job.id for job in queue.jobs_for("bob")] == [first]
+    assert queue.stats()["attached"] == 1
+
+    release.set()
+    job = wait_finished(queue, first)
+    assert (job.state, job.result) == (JOB_DONE, "結果")
+    assert calls.count(first) == 1
+
+
+def test_finished_or_cancelled_jobs_are_not_reused(queue):
+    release, calls = threading.Event(), []
+    release.set()
+    first = queue.submit("alice", "A vs B", blocking(release, calls), key="k")
+    wait_finished(queue, first)
+    second = queue.submit("bob", "A vs B", blocking(release, calls), key="k")
+    assert second != first
+    wait_finished(queue, second)
+
+    release.clear()
+    third = queue.submit("alice", "A vs B", blocking(release, calls), key="k")
+    assert queue.cancel(third)
+    fourth = queue.submit("bob", "A vs B", blocking(release, calls), key="k")
+    assert fourth != third
+    assert wait_finished(queue, third).state == JOB_CANCELLED
+
+    release.set()
+    assert wait_finished(queue, fourth).state == JOB_DONE
+    assert queue.stats()["attached"] == 0
+
+
+def test_without_key_never_coalesces(queue):
+    release, calls = threading.Event(), []
+    first = queue.submit("alice", "A vs B", blocking(release, calls))
+    assert queue.submit("alice", "A vs B", blocking(release, calls)) != first
+    release.set()
+
+
+def test_detach_keeps_the_job_running_for_the_other_owners(queue):
+    release, calls = threading.Event(), []
+    job_id = queue.submit("alice", "A vs B", blocking(release, calls), key="k")
+    queue.submit("bob", "A vs B", blocking(release, calls), key="k")
+
+    assert queue.detach(job_id, "alice")
+    assert queue.get(job_id).owners == {"bob"}
+    # 最後の1人は外さない（呼び出し側が中止する）
+    assert not queue.detach(job_id, "bob")
+    assert not queue.get(job_id).cancel_event.is_set()
+
+    release.set()
+    assert wait_finished(queue, job_id).state == JOB_DONE
+
+
+def test_cancelled_job_raises_at_checkpoint(queue):
+    release, calls = threading.Event(), []
+    job_id = queue.submit("alice", "A vs B", blocking(release, calls), key="k")
+    queue.cancel(job_id)
+    job = wait_finished(queue, job_id)
+    assert job.state == JOB_CANCELLED
+    with pytest.raises(JobCancelledError):
+        job.check_cancelled()
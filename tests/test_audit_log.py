@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+"""audit_log: 記録・絞り込み・ページ送りとサマリーの集計"""
+
+from datetime import date
+
+import pytest
+
+from audit_log import AuditLog
+
+
+@pytest.fixture
+def audit_log(tmp_path):
+    log = AuditLog(str(tmp_path / "access_log.db"), legacy_csv_path=str(tmp_path / "missing.csv"))
+    yield log
+    log.close()
+
+
+def test_error_rate_counts_each_failed_analysis_once(audit_log):
+    for i in range(4):
+        audit_log.log("alice", "analysis_executed", timestamp=f"2026-10-0{i + 1} 10:00:00")
+        audit_log.log("alice", "analysis_error", timestamp=f"2026-10-0{i + 1} 10:01:00")
+    audit_log.log("alice", "login_failed", timestamp="2026-10-05 09:00:00")
+    audit_log.flush()
+
+    summary = audit_log.summary()
+    assert (summary["analyses"], summary["errors"], summary["login_failed"]) == (4, 4, 1)
+    assert summary["error_rate"] == 1.0
+
+
+def test_error_rate_without_analyses(audit_log):
+    audit_log.log("alice", "analysis_error", timestamp="2026-10-01 10:00:00")
+    audit_log.flush()
+    assert audit_log.summary()["error_rate"] == 0.0
+
+
+def test_query_filters_and_pages_newest_first(audit_log):
+    for day in range(1, 6):
+        audit_log.log("alice" if day % 2 else "bob", "login", timestamp=f"2026-10-0{day} 09:00:00")
+    audit_log.flush()
+
+    rows, cursor = audit_log.query(start_date=date(2026, 10, 2), end_date=date(2026, 10, 5), limit=2)
+    assert [row["timestamp"][:10] for row in rows] == ["2026-10-05", "2026-10-04"]
+    rows, cursor = audit_log.query(start_date=date(2026, 10, 2), end_date=date(2026, 10, 5), cursor=cursor, limit=2)
+    assert [row["timestamp"][:10] for row in rows] == ["2026-10-03", "2026-10-02"]
+    assert cursor is None
+
+    rows, _ = audit_log.query(username="bob")
+    assert {row["username"] for row in rows} == {"bob"}
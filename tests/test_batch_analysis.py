@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""batch_analysis: スタブLLMサーバーを相手にしたCSV → レポートのバッチ実行"""
+
+import csv
+import json
+import os
+import sys
+
+import batch_analysis
+from analysis_prompt import CLAUDE_PROVIDER, OPENAI_PROVIDER, select_model
+from llm_client import LLMClientPool
+
+
+def write_csv(path, rows):
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=["competitor_name", "our_product", "competitor_platform"])
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def run_main(monkeypatch, *args):
+    monkeypatch.setattr(sys, "argv", ["batch_analysis.py", *args])
+    batch_analysis.main()
+
+
+def test_batch_writes_reports_and_skips_finished_rows(tmp_path, monkeypatch, stub_server):
+    csv_path = tmp_path / "competitors.csv"
+    output_dir = tmp_path / "out"
+    write_csv(csv_path, [
+        {"competitor_name": "モンスターストライク", "our_product": "新作RPG", "competitor_platform": "iOS;Android"},
+        {"competitor_name": "パズドラ", "our_product": "新作RPG", "competitor_platform": ""},
+        {"competitor_name": "", "our_product": "新作RPG", "competitor_platform": ""},
+    ])
+    common = [str(csv_path), "--output-dir", str(output_dir), "--base-url", stub_server, "--no-index"]
+
+    run_main(monkeypatch, *common)
+
+    with open(output_dir / "summary.json", encoding="utf-8") as f:
+        summary = json.load(f)["rows"]
+    assert [row["status"] for row in summary] == ["succeeded", "succeeded"]
+    for row in summary:
+        with open(output_dir / row["report"], encoding="utf-8") as f:
+            assert "## EXECUTIVE_SUMMARY" in f.read()
+        assert row["input_tokens"] == 1200
+
+    # 2回目は分析済みの行を送信しない
+    finished_at = {name: os.path.getmtime(output_dir / "reports" / name)
+                   for name in os.listdir(output_dir / "reports")}
+
+    def resend(*args):
+        raise AssertionError("分析済みの行を再送信した")
+
+    monkeypatch.setattr(batch_analysis, "run_analysis", resend)
+    run_main(monkeypatch, *common)
+    assert finished_at == {name: os.path.getmtime(output_dir / "reports" / name)
+                           for name in os.listdir(output_dir / "reports")}
+
+
+def test_batch_calls_are_metered_by_shared_limiter(tmp_path, stub_server):
+    limiter = batch_analysis.build_limiter(OPENAI_PROVIDER, rpm=100, tpm=1_000_000)
+    pool = LLMClientPool(base_urls={OPENAI_PROVIDER: stub_server + "/v1"}, limiter=limiter)
+    inputs = {**batch_analysis.DEFAULT_INPUTS, "competitor_name": "パズドラ", "our_product": "新作RPG"}
+    os.makedirs(tmp_path / "reports")
+
+    batch_analysis.run_with_workers(
+        pool, OPENAI_PROVIDER, "stub", False, [(1, inputs)], {1: "row1"}, {1: ""}, str(tmp_path), workers=1
+    )
+
+    model, _ = select_model(OPENAI_PROVIDER)
+    (status,) = limiter.status()
+    assert (status["provider"], status["model"]) == (OPENAI_PROVIDER, model)
+    assert status["requests_available"] < 100
+    # 推定トークン数は応答の usage（1200 + 900）で補正される
+    assert 1_000_000 - status["tokens_available"] < 2_200
+
+
+def test_build_limiter_overrides_provider_defaults():
+    limiter = batch_analysis.build_limiter(CLAUDE_PROVIDER, rpm=0, tpm=1000)
+    limit = limiter.limit_for(CLAUDE_PROVIDER, "claude-sonnet-4-20250514")
+    assert (limit.rpm, limit.tpm) == (None, 1000)
+    default = batch_analysis.build_limiter(CLAUDE_PROVIDER).limit_for(CLAUDE_PROVIDER, "any")
+    assert default.rpm == 50
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""chunk_store: 内容アドレスのチャンクストアと、保存・mmap読み込みしたインデックスでの検索"""
+
+import numpy as np
+
+from chunk_store import ChunkStore, ChunkStoreWriter, chunk_digest
+from market_index import MarketIndex
+
+
+def test_writer_deduplicates_identical_chunks(tmp_path):
+    with ChunkStoreWriter(str(tmp_path)) as writer:
+        ids = [writer.add(text) for text in ["市場規模", "売上", "市場規模", ""]]
+    assert ids == [0, 1, 0, 2]
+    assert writer.stats == {"chunks": 3, "added": 4, "bytes": len("市場規模売上".encode("utf-8"))}
+
+    store = ChunkStore(str(tmp_path))
+    try:
+        assert len(store) == 3
+        assert [store.text(i) for i in range(3)] == ["市場規模", "売上", ""]
+        assert store.digest(1) == chunk_digest("売上").hex()
+        assert store.find(chunk_digest("売上")) == 1
+        assert store.find(chunk_digest("売上").hex()) == 1
+        assert store.find(chunk_digest("ない")) is None
+    finally:
+        store.close()
+
+
+def test_digest_with_trailing_nul_bytes_round_trips(tmp_path, monkeypatch):
+    # numpy の固定長バイト列は末尾のNULを落とすため、digest() と find() で補えているか確認する
+    monkeypatch.setattr("chunk_store.chunk_digest", lambda data: b"\x01" * 31 + b"\0")
+    with ChunkStoreWriter(str(tmp_path)) as writer:
+        writer.add("本文")
+    store = ChunkStore(str(tmp_path))
+    try:
+        assert store.digest(0) == ("01" * 31) + "00"
+        assert store.find(store.digest(0)) == 0
+    finally:
+        store.close()
+
+
+def test_failed_build_leaves_no_partial_store(tmp_path):
+    try:
+        with ChunkStoreWriter(str(tmp_path)) as writer:
+            writer.add("本文")
+            raise RuntimeError("構築の中断")
+    except RuntimeError:
+        pass
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_empty_store(tmp_path):
+    with ChunkStoreWriter(str(tmp_path)):
+        pass
+    store = ChunkStore(str(tmp_path))
+    assert (len(store), store.nbytes) == (0, 0)
+    store.close()
+
+
+def test_saved_index_searches_the_same_over_mmap(tmp_path):
+    sources = [
+        {"name": "白書A", "text": "[p.1]\nモンスターストライクは国内売上上位。\n\n[p.2]\nパズドラは長期運営。"},
+        {"name": "白書B", "text": "モンスターストライクのDAUは高い。\n\nパズドラは長期運営。"},
+    ]
+    built = MarketIndex.build(sources, target_chars=10)
+    built.save(str(tmp_path))
+
+    loaded = MarketIndex.load(str(tmp_path))
+    try:
+        # 本文は読み込み時に持たず、チャンクストアから取り出す（同じ本文は1チャンク）
+        assert all("text" not in passage for passage in loaded.passages)
+        assert len(loaded.store) == len(built.passages) - 1
+        assert isinstance(loaded.doc_ids, np.memmap)
+
+        query = [("モンスターストライク", 2.0), ("パズドラ", 1.0)]
+
+        def hits(index):
+            # 同点のパッセージは順序が決まらないため集合で比べる
+            return {(score, p["source"], p["page"], p["text"]) for score, p in index.search(query, k=4)}
+
+        assert hits(loaded) == hits(built)
+    finally:
+        loaded.store.close()
+
+
+def test_load_without_index_returns_none(tmp_path):
+    assert MarketIndex.load(str(tmp_path / "missing")) is None
+
+
+def test_rebuild_keeps_loaded_index_readable(tmp_path):
+    # 実行中のアプリがmmapしているファイルを上書きせず置き換える（上書きすると読み取りでSIGBUS）
+    large = [{"name": f"白書{i}", "text": "モンスターストライクの売上は国内上位。" * 50} for i in range(20)]
+    MarketIndex.build(large, target_chars=40).save(str(tmp_path))
+    loaded = MarketIndex.load(str(tmp_path))
+    try:
+        before = [(score, p["text"]) for score, p in loaded.search([("売上", 1.0)], k=3)]
+
+        MarketIndex.build([{"name": "白書", "text": "パズドラは長期運営。"}]).save(str(tmp_path))
+
+        assert [(score, p["text"]) for score, p in loaded.search([("売上", 1.0)], k=3)] == before
+        assert int(np.asarray(loaded.doc_lengths).sum()) > 0
+        assert not list(tmp_path.glob("*.tmp"))
+        rebuilt = MarketIndex.load(str(tmp_path))
+        assert len(rebuilt.passages) == 1
+        rebuilt.store.close()
+    finally:
+        loaded.store.close()
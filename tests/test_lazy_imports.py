@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+"""lazy_imports: 遅延インポートの代理と、先に読み込む依存モジュール"""
+
+import lazy_imports
+from lazy_imports import lazy_module
+
+
+def test_requires_are_imported_before_the_module(monkeypatch):
+    loaded = []
+    original = lazy_imports.import_module
+
+    def record(name, trigger="使用時"):
+        loaded.append(name)
+        return original(name, trigger)
+
+    monkeypatch.setattr(lazy_imports, "import_module", record)
+    proxy = lazy_module("json", requires=("decimal",))
+    assert loaded == []
+
+    assert proxy.dumps([1]) == "[1]"
+    assert proxy.loads("2") == 2
+    # 依存モジュールが先、2回目以降のアクセスでは読み込み直さない
+    assert loaded == ["decimal", "json"]
+    assert proxy.is_loaded
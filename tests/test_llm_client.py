@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"""llm_client: サーキットブレーカーの状態遷移と、再試行・キャンセル時のブレーカーの扱い"""
+
+import asyncio
+import threading
+import time
+
+import pytest
+
+from analysis_prompt import CLAUDE_PROVIDER
+from llm_client import CircuitBreaker, CircuitOpenError, DeadlineExceededError, LLMClientPool, RetryPolicy
+from rate_limiter import RateLimit, RateLimiter, RateLimitWaitCancelled, notify_waits
+
+MODEL = "claude-sonnet-4-20250514"
+KEY = (CLAUDE_PROVIDER, MODEL)
+
+
+class StatusError(Exception):
+    def __init__(self, status_code):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+
+
+def make_pool(**kwargs):
+    return LLMClientPool(policy=RetryPolicy(max_attempts=2, base_delay=0.0), **kwargs)
+
+
+def make_throttled_pool():
+    """停止時間の明けたブレーカーと、次の送信まで約60秒待つレート制限を持つプール"""
+    limiter = RateLimiter({CLAUDE_PROVIDER: RateLimit(rpm=1)})
+    limiter.reserve(CLAUDE_PROVIDER, MODEL)
+    pool = make_pool(failure_threshold=1, reset_timeout=0.05, limiter=limiter)
+    trip(pool.breaker(CLAUDE_PROVIDER, MODEL), 0.05)
+    return pool
+
+
+def lift_limit(pool):
+    pool.limiter.limits[CLAUDE_PROVIDER] = RateLimit()
+
+
+def trip(breaker, reset_timeout):
+    """ブレーカーを開き、停止時間が明けるまで待つ"""
+    for _ in range(breaker.failure_threshold):
+        breaker.record_failure()
+    assert breaker.state == "open"
+    time.sleep(reset_timeout * 1.5)
+
+
+def test_breaker_opens_after_consecutive_failures():
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=60.0)
+    breaker.record_failure()
+    breaker.record_failure()
+    breaker.before_call(KEY)
+    breaker.record_failure()
+    assert breaker.state == "open"
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call(KEY)
+
+
+def test_breaker_half_open_lets_one_probe_through():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.02)
+    trip(breaker, 0.02)
+    breaker.before_call(KEY)
+    assert breaker.state == "half_open"
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call(KEY)
+
+    breaker.record_success()
+    assert (breaker.state, breaker.failures) == ("closed", 0)
+
+
+def test_breaker_failed_probe_reopens():
+    breaker = CircuitBreaker(failure_threshold=5, reset_timeout=0.02)
+    trip(breaker, 0.02)
+    breaker.before_call(KEY)
+    breaker.record_failure()
+    assert breaker.state == "open"
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call(KEY)
+
+
+def test_release_probe():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.02)
+    trip(breaker, 0.02)
+
+    # 送信前に終えた試行: 停止明けのまま、次の呼び出しが試せる
+    breaker.before_call(KEY)
+    breaker.release_probe(request_sent=False)
+    assert breaker.state == "open"
+    breaker.before_call(KEY)
+
+    # 送信後に打ち切った試行: 停止時間を数え直す
+    breaker.release_probe(request_sent=True)
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call(KEY)
+
+    # closed では何もしない
+    closed = CircuitBreaker()
+    closed.release_probe()
+    assert closed.state == "closed"
+
+
+def test_call_counts_only_retryable_errors():
+    pool = make_pool(failure_threshold=2)
+    breaker = pool.breaker(CLAUDE_PROVIDER, MODEL)
+
+    def bad_request(client):
+        raise StatusError(400)
+
+    with pytest.raises(StatusError):
+        pool.call(CLAUDE_PROVIDER, MODEL, "test", bad_request)
+    assert breaker.failures == 0
+
+    def overloaded(client):
+        raise StatusError(529)
+
+    with pytest.raises(StatusError):
+        pool.call(CLAUDE_PROVIDER, MODEL, "test", overloaded)
+    assert breaker.state == "open"
+    with pytest.raises(CircuitOpenError):
+        pool.call(CLAUDE_PROVIDER, MODEL, "test", lambda client: "ok")
+
+
+def test_call_async_cancelled_probe_does_not_stick_half_open():
+    pool = make_pool(failure_threshold=1, reset_timeout=0.05)
+    breaker = pool.breaker(CLAUDE_PROVIDER, MODEL)
+    trip(breaker, 0.05)
+
+    async def hang():
+        await asyncio.sleep(10)
+
+    async def cancel_probe():
+        task = asyncio.ensure_future(pool.call_async(CLAUDE_PROVIDER, MODEL, hang))
+        await asyncio.sleep(0.01)
+        assert breaker.state == "half_open"
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(cancel_probe())
+    assert breaker.state == "open"
+
+    async def answer():
+        return "ok"
+
+    time.sleep(0.08)
+    assert asyncio.run(pool.call_async(CLAUDE_PROVIDER, MODEL, answer)) == "ok"
+    assert breaker.state == "closed"
+
+
+def test_cancelled_rate_limit_wait_releases_the_probe():
+    pool = make_throttled_pool()
+    breaker = pool.breaker(CLAUDE_PROVIDER, MODEL)
+    cancel_event = threading.Event()
+    cancel_event.set()
+    with notify_waits(None, cancel_event):
+        with pytest.raises(RateLimitWaitCancelled):
+            pool.call(CLAUDE_PROVIDER, MODEL, "test", lambda client: "ok")
+
+    # 送信していないため停止時間は数え直さず、次の呼び出しがすぐに試せる
+    assert breaker.state == "open"
+    lift_limit(pool)
+    assert pool.call(CLAUDE_PROVIDER, MODEL, "test", lambda client: "ok") == "ok"
+    assert breaker.state == "closed"
+
+
+def test_rate_limit_wait_past_deadline_releases_the_probe():
+    pool = make_throttled_pool()
+    with pytest.raises(DeadlineExceededError):
+        pool.call(CLAUDE_PROVIDER, MODEL, "test", lambda client: "ok", deadline=1.0)
+
+    lift_limit(pool)
+    assert pool.call(CLAUDE_PROVIDER, MODEL, "test", lambda client: "ok") == "ok"
+
+
+def test_call_async_cancelled_during_rate_limit_wait_releases_the_probe():
+    pool = make_throttled_pool()
+    breaker = pool.breaker(CLAUDE_PROVIDER, MODEL)
+
+    async def answer():
+        return "ok"
+
+    async def cancel_throttled_probe():
+        task = asyncio.ensure_future(pool.call_async(CLAUDE_PROVIDER, MODEL, answer))
+        await asyncio.sleep(0.01)
+        assert breaker.state == "half_open"
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(cancel_throttled_probe())
+    lift_limit(pool)
+    assert asyncio.run(pool.call_async(CLAUDE_PROVIDER, MODEL, answer)) == "ok"
+    assert breaker.state == "closed"
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""llm_hedge: スタブLLMサーバーを相手にしたヘッジの起動条件と、採用しなかったリクエストの打ち切り"""
+
+import select
+import socket
+import time
+
+import pytest
+
+from analysis_prompt import CLAUDE_PROVIDER, OPENAI_PROVIDER
+from llm_client import LLMClientPool
+from llm_hedge import HedgeCandidate, HedgedRequest
+from stub_llm_server import STUB_REPORT
+
+MESSAGES = [{"role": "user", "content": "競合分析"}]
+
+
+def make_hedge(primary_url, secondary_url, hedge_after):
+    pool = LLMClientPool(base_urls={CLAUDE_PROVIDER: primary_url, OPENAI_PROVIDER: secondary_url + "/v1"})
+    # SDKの読み込み（初回のみ数百ミリ秒）をヘッジの期限に含めない
+    pool.async_client(CLAUDE_PROVIDER, "stub")
+    pool.async_client(OPENAI_PROVIDER, "stub")
+    hedge = HedgedRequest(
+        pool,
+        HedgeCandidate(CLAUDE_PROVIDER, "claude-sonnet-4-20250514", "stub",
+                       {"model": "claude-sonnet-4-20250514", "max_tokens": 100, "messages": MESSAGES}),
+        HedgeCandidate(OPENAI_PROVIDER, "gpt-4o", "stub",
+                       {"model": "gpt-4o", "max_tokens": 100, "messages": MESSAGES}),
+        hedge_after=hedge_after,
+    )
+    return pool, hedge
+
+
+def wait_closed_by_client(connections, timeout=1.0):
+    """スタブサーバー側のソケットがすべてクライアントから切断されるまで待つ"""
+    def closed(sock):
+        if not select.select([sock], [], [], 0)[0]:
+            return False
+        try:
+            return sock.recv(1, socket.MSG_PEEK) == b""
+        except OSError:
+            return True
+
+    deadline = time.monotonic() + timeout
+    while not all(closed(sock) for sock in connections):
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.02)
+    return True
+
+
+@pytest.mark.parametrize("mode", ["complete", "stream"])
+def test_streaming_primary_is_not_hedged(start_stub_server, mode):
+    # 最初のトークンはすぐ届き、生成全体はヘッジ期限より長くかかるプライマリ
+    primary_url, primary_received = start_stub_server(chunk_delay=0.03)
+    secondary_url, secondary_received = start_stub_server()
+    _, hedge = make_hedge(primary_url, secondary_url, hedge_after=0.3)
+
+    started = time.monotonic()
+    text = hedge.complete() if mode == "complete" else "".join(hedge.stream())
+
+    assert time.monotonic() - started > 0.3
+    assert text == STUB_REPORT
+    assert hedge.winner is hedge.candidates[0]
+    assert not hedge.hedged
+    assert (len(primary_received), secondary_received) == (1, [])
+
+
+@pytest.mark.parametrize("mode", ["complete", "stream"])
+def test_slow_primary_is_hedged_and_aborted(start_stub_server, mode):
+    primary_url, primary_received = start_stub_server(delay=5.0)
+    secondary_url, secondary_received = start_stub_server()
+    pool, hedge = make_hedge(primary_url, secondary_url, hedge_after=0.2)
+
+    started = time.monotonic()
+    text = hedge.complete() if mode == "complete" else "".join(hedge.stream())
+
+    assert text == STUB_REPORT
+    assert hedge.hedged
+    assert hedge.winner is hedge.candidates[1]
+    assert (len(primary_received), len(secondary_received)) == (1, 1)
+    # 最初のトークン前のプライマリのリクエストも、5秒の応答を待たずに打ち切る
+    assert wait_closed_by_client(primary_received.connections)
+    assert time.monotonic() - started < 2.0
+    assert hedge.candidates[0].error is None
+    assert pool.breaker(CLAUDE_PROVIDER, "claude-sonnet-4-20250514").state == "closed"
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""market_index: 分かち書き・パッセージ分割・BM25検索"""
+
+import math
+from collections import Counter
+
+import pytest
+
+from market_index import MarketIndex, build_query, chunk_passages, format_passages, retrieve_reference, tokenize
+
+SOURCES = [
+    {"name": "白書A", "text": "[p.1]\nモンスターストライクは国内売上上位のモバイルRPGである。\n\n"
+                             "[p.2]\nパズドラはパズルRPGとして長期運営を続けている。"},
+    {"name": "白書B", "text": "[p.10]\n家庭用ゲーム市場は約0.4兆円。\n\n"
+                             "モンスターストライクのDAUは高い水準を維持している。モンスターストライクの課金率も高い。"},
+    {"name": "白書C", "text": "PCゲーム市場は約0.2兆円で、Steamの利用者が増えている。"},
+]
+
+
+def naive_bm25(passages, query_parts, k1=1.2, b=0.75):
+    """転置リストを使わない素朴なBM25（比較用）"""
+    docs = [Counter(tokenize(p["text"])) for p in passages]
+    avg_length = sum(sum(doc.values()) for doc in docs) / len(docs)
+    weights = Counter()
+    for text, weight in query_parts:
+        for term in set(tokenize(text)):
+            weights[term] += weight
+    scores = []
+    for doc in docs:
+        length = sum(doc.values())
+        score = 0.0
+        for term, weight in weights.items():
+            df = sum(1 for d in docs if term in d)
+            if not df or term not in doc:
+                continue
+            idf = math.log(1.0 + (len(docs) - df + 0.5) / (df + 0.5))
+            freq = doc[term]
+            score += weight * idf * freq * (k1 + 1) / (freq + k1 * (1 - b + b * length / avg_length))
+        scores.append(score)
+    return scores
+
+
+def test_tokenize_uses_bigrams_for_japanese_and_words_for_ascii():
+    assert tokenize("ＲＰＧ市場 Steam") == ["rpg", "市場", "steam"]
+    assert tokenize("の") == ["の"]
+
+
+def test_chunk_passages_tracks_pages_and_splits_long_paragraphs():
+    text = "[p.3]\n" + "売上が伸びた。" * 10 + "\n\n[p.4]\n" + "次の段落。" * 8
+    passages = chunk_passages("資料", text, target_chars=30)
+    # 長い段落は文末で切る（文の途中では切らない）
+    assert all(p["text"].endswith("。") and len(p["text"]) < 2 * 30 for p in passages)
+    assert "".join(p["text"].replace("\n", "") for p in passages) == "売上が伸びた。" * 10 + "次の段落。" * 8
+    # ページはパッセージの開始位置のページ
+    assert [p["page"] for p in passages] == [3, 3, 4]
+
+
+def test_search_matches_naive_bm25_ranking():
+    index = MarketIndex.build(SOURCES, target_chars=40)
+    query = [("モンスターストライク", 2.0), ("RPG", 1.0)]
+
+    hits = index.search(query, k=3)
+    expected = naive_bm25(index.passages, query)
+    ranked = sorted(range(len(expected)), key=lambda i: -expected[i])[:3]
+    assert [hit[1]["text"] for hit in hits] == [index.passages[i]["text"] for i in ranked]
+    assert [hit[0] for hit in hits] == pytest.approx([expected[i] for i in ranked], rel=1e-5)
+    assert hits[0][1]["source"] == "白書B"
+
+
+def test_search_without_matching_terms_returns_nothing():
+    index = MarketIndex.build(SOURCES)
+    assert index.search([("存在しない語彙", 1.0)]) == []
+    assert retrieve_reference(None, {"competitor_name": "x"}) == ("", [], 0.0)
+
+
+def test_retrieve_reference_formats_sources_and_pages():
+    index = MarketIndex.build(SOURCES, target_chars=10)
+    text, hits, elapsed_ms = retrieve_reference(index, {"competitor_name": "パズドラ"}, k=1)
+    assert hits[0][1]["page"] == 2
+    assert text == format_passages(hits)
+    assert "▼ 白書A p.2" in text
+    assert elapsed_ms >= 0
+    assert build_query({"competitor_name": "A", "comparison_focus": ["収益"]})[-1] == ("収益", 0.5)
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+"""pdf_extract: ページ単位の差分抽出と処理速度の統計"""
+
+from pypdf import PdfWriter
+
+from pdf_extract import PageTextCache, extract_pdf_pages, join_pages
+
+
+def make_pdf(path, pages):
+    writer = PdfWriter()
+    for _ in range(pages):
+        writer.add_blank_page(width=200, height=200)
+    with open(path, "wb") as f:
+        writer.write(f)
+
+
+def test_incremental_run_uses_cache_and_reports_extraction_rate(tmp_path):
+    pdf_path = str(tmp_path / "report.pdf")
+    make_pdf(pdf_path, 3)
+    cache = PageTextCache(str(tmp_path / "pages"))
+
+    pages_by_path, stats = extract_pdf_pages([pdf_path], cache=cache, workers=1)
+    assert pages_by_path[pdf_path] == ["", "", ""]
+    assert (stats["pages"], stats["extracted"], stats["cached"]) == (3, 3, 0)
+    assert stats["pages_per_sec"] > 0
+
+    progress = []
+    pages_by_path, stats = extract_pdf_pages(
+        [pdf_path], cache=cache, workers=1, on_progress=lambda path, done, total: progress.append((done, total))
+    )
+    assert (stats["pages"], stats["extracted"], stats["cached"]) == (3, 0, 3)
+    # キャッシュから読んだページは処理速度に数えない
+    assert stats["pages_per_sec"] == 0.0
+    assert progress == [(3, 3)]
+
+
+def test_join_pages_marks_page_numbers_and_skips_empty_pages():
+    assert join_pages(["一", "  ", "三"]) == "[p.1]\n一\n\n[p.3]\n三"
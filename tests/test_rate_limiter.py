@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""rate_limiter: 到着順の予約・使用量での補正・取り消し・待ちの中止"""
+
+import threading
+
+import pytest
+
+from analysis_prompt import CLAUDE_PROVIDER
+from rate_limiter import RateLimit, RateLimiter, RateLimitWaitCancelled, notify_waits
+
+MODEL = "claude-sonnet-4-20250514"
+
+
+def make_limiter(rpm=None, tpm=None, state_path=None):
+    return RateLimiter({CLAUDE_PROVIDER: RateLimit(rpm=rpm, tpm=tpm)}, state_path=state_path)
+
+
+def available(limiter, kind):
+    return limiter.status()[0][f"{kind}_available"]
+
+
+def test_reservations_wait_in_arrival_order():
+    limiter = make_limiter(rpm=2)
+    waits = [limiter.reserve(CLAUDE_PROVIDER, MODEL).wait for _ in range(4)]
+    # 容量2件までは待たず、以降は補充（1件/30秒）を到着順に待つ
+    assert waits[:2] == [0.0, 0.0]
+    assert waits[2] == pytest.approx(30.0, abs=0.1)
+    assert waits[3] == pytest.approx(60.0, abs=0.1)
+
+
+def test_settle_refunds_unused_tokens_and_charges_overrun():
+    limiter = make_limiter(tpm=1_000)
+    limiter.reserve(CLAUDE_PROVIDER, MODEL, tokens=600).settle(100)
+    assert available(limiter, "tokens") == pytest.approx(900, abs=1)
+
+    limiter.reserve(CLAUDE_PROVIDER, MODEL, tokens=100).settle(500)
+    assert available(limiter, "tokens") == pytest.approx(400, abs=1)
+
+    # 使用量が分からなければ推定のまま
+    limiter.reserve(CLAUDE_PROVIDER, MODEL, tokens=100).settle(None)
+    assert available(limiter, "tokens") == pytest.approx(300, abs=1)
+
+
+def test_cancel_returns_the_slot_and_expected_wait_does_not_reserve():
+    limiter = make_limiter(rpm=1)
+    limiter.reserve(CLAUDE_PROVIDER, MODEL)
+    queued = limiter.reserve(CLAUDE_PROVIDER, MODEL)
+    assert queued.wait == pytest.approx(60.0, abs=0.1)
+
+    queued.cancel()
+    assert limiter.expected_wait(CLAUDE_PROVIDER, MODEL) == pytest.approx(60.0, abs=0.1)
+    assert limiter.expected_wait(CLAUDE_PROVIDER, MODEL) == pytest.approx(60.0, abs=0.1)
+
+
+def test_request_larger_than_capacity_is_capped():
+    limiter = make_limiter(tpm=1_000)
+    assert limiter.reserve(CLAUDE_PROVIDER, MODEL, tokens=5_000).wait == 0.0
+    assert available(limiter, "tokens") == pytest.approx(0, abs=1)
+
+
+def test_unlimited_model_never_waits():
+    limiter = make_limiter()
+    assert all(limiter.reserve(CLAUDE_PROVIDER, MODEL, tokens=10**6).wait == 0.0 for _ in range(100))
+
+
+def test_sqlite_state_is_shared_between_limiters(tmp_path):
+    path = str(tmp_path / "rate_limits.db")
+    first = make_limiter(rpm=1, state_path=path)
+    second = make_limiter(rpm=1, state_path=path)
+    assert first.reserve(CLAUDE_PROVIDER, MODEL).wait == 0.0
+    assert second.reserve(CLAUDE_PROVIDER, MODEL).wait == pytest.approx(60.0, abs=0.1)
+
+
+def test_cancelled_wait_refunds_the_slot():
+    limiter = make_limiter(rpm=1)
+    limiter.reserve(CLAUDE_PROVIDER, MODEL)
+    notified = []
+    cancel_event = threading.Event()
+    threading.Timer(0.05, cancel_event.set).start()
+
+    with notify_waits(lambda *args: notified.append(args), cancel_event):
+        with pytest.raises(RateLimitWaitCancelled):
+            limiter.reserve(CLAUDE_PROVIDER, MODEL).sleep()
+
+    assert notified == [(CLAUDE_PROVIDER, MODEL, pytest.approx(60.0, abs=0.1))]
+    assert limiter.expected_wait(CLAUDE_PROVIDER, MODEL) == pytest.approx(60.0, abs=0.2)
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""report_digest: スタブLLMサーバーを相手にした map-reduce ダイジェストと中止"""
+
+import threading
+import time
+
+import pytest
+
+from analysis_prompt import CLAUDE_PROVIDER
+from llm_client import LLMClientPool
+from report_digest import (
+    DigestCache,
+    DigestCancelledError,
+    ReportDigester,
+    chunk_pages,
+    group_by_tokens,
+    make_llm_summarizer,
+)
+from stub_llm_server import STUB_REPORT
+from token_budget import TokenCounter
+
+MODEL = "claude-3-5-haiku-20241022"
+PAGES = [f"2024年度の国内モバイルゲーム市場（{page}ページ目）。" * 40 for page in range(1, 7)]
+
+
+def make_digester(base_url, cache=None, max_concurrency=4):
+    pool = LLMClientPool(base_urls={CLAUDE_PROVIDER: base_url})
+    counter = TokenCounter()
+    # 1ページ1チャンク、スタブの要約2件までを1回のreduceに渡す
+    digester = ReportDigester(
+        make_llm_summarizer(pool, CLAUDE_PROVIDER, "stub", MODEL), MODEL, cache=cache,
+        max_concurrency=max_concurrency,
+        chunk_tokens=counter.count(f"[p.1]\n{PAGES[0]}") + 1,
+        reduce_input_tokens=int(counter.count(STUB_REPORT.strip()) * 2.5),
+    )
+    return pool, digester
+
+
+def test_chunk_pages_keeps_pages_whole_and_skips_blank_pages():
+    counter = TokenCounter()
+    chunk_tokens = counter.count("[p.1]\n" + "一" * 10) * 2 + 1
+    chunks = chunk_pages(["一" * 10, "", "二" * 10, "三" * 10], chunk_tokens=chunk_tokens, counter=counter)
+    assert [(c["first_page"], c["last_page"]) for c in chunks] == [(1, 3), (4, 4)]
+    assert chunks[0]["text"] == "[p.1]\n" + "一" * 10 + "\n\n[p.3]\n" + "二" * 10
+
+
+def test_group_by_tokens_keeps_oversized_text_alone():
+    counter = TokenCounter()
+    texts = ["あ" * 10, "い" * 10, "う" * 50, "え" * 10]
+    limit = counter.count("あ" * 10) * 2
+    assert group_by_tokens(texts, limit, counter) == [texts[:2], [texts[2]], [texts[3]]]
+
+
+def test_map_reduce_digest_against_stub(tmp_path, start_stub_server):
+    base_url, received = start_stub_server()
+    pool, digester = make_digester(base_url, cache=DigestCache(str(tmp_path)))
+    phases = []
+
+    digest, entry, cached = digester.digest(
+        pool, PAGES, "filehash", "report.pdf", on_progress=lambda phase, done, total: phases.append(phase)
+    )
+
+    assert not cached
+    assert digest == STUB_REPORT.strip()
+    assert entry["chunks"] == 6
+    # map 6件 → reduce（2件ずつ 3件 → 2件）→ 最終ダイジェスト1件
+    # （スタブは同じ本文を返すため、同じ入力になった要約は保存済みの結果を使う）
+    assert entry["reduce_levels"] == 2
+    assert entry["calls"] + entry["cached_calls"] == 6 + 3 + 2 + 1
+    assert entry["calls"] == len(received)
+    assert entry["usage"]["input_tokens"] == 1200 * entry["calls"]
+    assert set(phases) == {"map", "reduce", "final"}
+
+    # 同じファイルは保存済みのダイジェストを返す
+    assert digester.digest(pool, PAGES, "filehash")[2]
+    assert len(received) == entry["calls"]
+
+
+def test_rerun_after_cancel_reuses_finished_chunk_summaries(tmp_path, start_stub_server):
+    cache = DigestCache(str(tmp_path))
+    slow_url, slow_received = start_stub_server(delay=1.0)
+    pool, digester = make_digester(slow_url, cache=cache, max_concurrency=2)
+    cancel_event = threading.Event()
+    # 最初の2チャンクの要約が保存された後、次の2チャンクの応答待ちの間に中止する
+    threading.Timer(1.5, cancel_event.set).start()
+    with pytest.raises(DigestCancelledError):
+        digester.digest(pool, PAGES, "filehash", cancel_event=cancel_event)
+    assert len(slow_received) == 4
+
+    base_url, received = start_stub_server()
+    pool, digester = make_digester(base_url, cache=cache)
+    _, entry, cached = digester.digest(pool, PAGES, "filehash")
+    assert not cached
+    assert entry["cached_calls"] >= 2
+    assert len(received) == entry["calls"] <= 12 - 2
+
+
+def test_cancel_aborts_in_flight_summaries(start_stub_server):
+    base_url, received = start_stub_server(delay=5.0)
+    pool, digester = make_digester(base_url, max_concurrency=2)
+    cancel_event = threading.Event()
+    threading.Timer(0.5, cancel_event.set).start()
+
+    started = time.monotonic()
+    with pytest.raises(DigestCancelledError):
+        digester.digest(pool, PAGES, "filehash", cancel_event=cancel_event)
+
+    # 5秒かかる応答を待たずに中止し、同時実行数を超えるチャンクは送信しない
+    assert time.monotonic() - started < 2.0
+    assert len(received) == 2
+    assert pool.breaker(CLAUDE_PROVIDER, MODEL).state == "closed"
+
+
+def test_no_relevant_facts_skips_the_final_call():
+    prompts = []
+
+    async def nothing_relevant(system, prompt, max_tokens):
+        prompts.append(prompt)
+        return "（該当なし）\n", {"input_tokens": 100, "output_tokens": 5}
+
+    digester = ReportDigester(nothing_relevant, MODEL, chunk_tokens=TokenCounter().count(f"[p.1]\n{PAGES[0]}") + 1)
+    digest, entry, cached = digester.digest(LLMClientPool(), PAGES, "filehash")
+
+    # 空のプロンプトで最終段を呼ばない（Providerは400で拒否する）
+    assert (digest, cached) == ("", False)
+    assert len(prompts) == entry["calls"] == 6
+    assert all(prompts)
+    assert (entry["chunks"], entry["reduce_levels"]) == (6, 0)
+    assert entry["usage"]["input_tokens"] == 600
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""report_parser: 分析結果の構造化と、ストリーミングの断片を渡したときの一致"""
+
+import json
+
+import pytest
+
+from report_parser import SECTION_NAMES, ReportParser, parse_report, validate_metrics
+from stub_llm_server import STUB_METRICS, STUB_REPORT
+
+
+def parse_in_chunks(text, size):
+    parser = ReportParser()
+    completed = 0
+    for i in range(0, len(text), size):
+        completed += parser.feed(text[i:i + size])
+    return parser, completed, parser.close()
+
+
+def outline(report):
+    return [(s.name, s.title, s.body, [t.records() for t in s.tables]) for s in report.sections]
+
+
+def test_parses_sections_metrics_tables_and_rationale():
+    report = parse_report(STUB_REPORT)
+    assert [s.name for s in report.sections] == list(SECTION_NAMES)
+    assert report.section("ACTION_PLAN").title == "ACTION_PLAN (自社タイトル向け)"
+    assert report.metrics == STUB_METRICS
+    assert report.metrics_error is None
+    assert report.rationale.startswith("**各評価の根拠**")
+    assert "```" not in report.section("COMPARISON_METRICS").body
+    assert report.sources == [{"データ項目": "市場規模", "出典": "2024年度国内ゲーム市場データ（提供データ）",
+                               "詳細（ページ/URL）": "-", "信頼性": "中"}]
+    assert report.metric_rows()[0] == ("市場ポジション", 85, 40)
+    assert report.summary.startswith("（スタブ応答）")
+    assert report.raw == STUB_REPORT
+
+
+@pytest.mark.parametrize("size", [1, 7, 40, 10_000])
+def test_incremental_feed_matches_full_parse(size):
+    full = parse_report(STUB_REPORT)
+    parser, completed, report = parse_in_chunks(STUB_REPORT, size)
+    assert outline(report) == outline(full)
+    assert (report.metrics, report.rationale, report.raw) == (full.metrics, full.rationale, full.raw)
+    # 最後のセクションは close() で完成する
+    assert completed == len(SECTION_NAMES) - 1
+
+
+def test_snapshot_includes_partial_last_line():
+    parser = ReportParser()
+    parser.feed("前置き\n## EXECUTIVE_SUMMARY\n競合は上位")
+    assert parser.snapshot() == [("EXECUTIVE_SUMMARY", "競合は上位")]
+    assert parser.completed_count == 0
+    assert parser.feed("。\n## MARKET_ANALYSIS\n") == 1
+    assert parser.close().preamble == "前置き"
+
+
+def test_bare_section_names_and_duplicate_heading():
+    report = parse_report("**EXECUTIVE_SUMMARY**\n要約\n## ACTION_PLAN\nACTION_PLAN\n| a | b |\n|---|---|\n| 1 | 2 |\n")
+    assert [s.name for s in report.sections] == ["EXECUTIVE_SUMMARY", "ACTION_PLAN"]
+    assert report.section("ACTION_PLAN").tables[0].records() == [{"a": "1", "b": "2"}]
+
+
+def test_invalid_or_unclosed_metrics_json():
+    report = parse_report('## COMPARISON_METRICS\n```json\n{"competitor": {}}\n```\n')
+    assert report.metrics is None
+    assert "market_position" in report.metrics_error
+
+    # 閉じられていないJSONブロックも読めれば使う
+    report = parse_report("## COMPARISON_METRICS\n```json\n" + json.dumps(STUB_METRICS))
+    assert report.metrics == STUB_METRICS
+
+
+def test_validate_metrics_range_and_types():
+    with pytest.raises(ValueError, match="範囲外"):
+        validate_metrics({**STUB_METRICS, "competitor": {**STUB_METRICS["competitor"], "technology": 101}})
+    with pytest.raises(ValueError, match="数値でない"):
+        validate_metrics({**STUB_METRICS, "our_product": {**STUB_METRICS["our_product"], "user_base": "高い"}})
+    assert validate_metrics({**STUB_METRICS, "our_product": {**STUB_METRICS["our_product"], "technology": "75.5"}})[
+        "our_product"]["technology"] == 75.5
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""token_budget: セクションの詰め込みと、入らなかったセクションの先頭部分での穴埋め"""
+
+from token_budget import TokenCounter, pack_sections, render_sections, source_header
+
+MARKET = "■ 市場規模\n" + "\n\n".join(["国内の市場規模は前年比で拡大した。" * 4] * 3)
+MISC = "■ 雑記\n" + "\n\n".join([f"その他の話題その{i}について述べる。" * 5 for i in range(6)])
+SOURCES = [{"name": "白書", "text": MARKET + "\n" + MISC}]
+
+
+def budget_for(counter, *texts):
+    """texts を丸ごと入れるのに必要な予算（出典見出し・区切りを含む）"""
+    separator = counter.count("\n\n")
+    return counter.count(source_header("白書")) + separator + sum(counter.count(t) + separator for t in texts)
+
+
+def test_everything_fits_without_partial_sections():
+    counter = TokenCounter()
+    sections, report = pack_sections(SOURCES, budget_for(counter, MARKET, MISC), counter)
+    assert [s.title for s in sections] == ["■ 市場規模", "■ 雑記"]
+    assert report["partial_sections"] == 0
+    assert render_sections(sections) == source_header("白書") + "\n\n" + MARKET + "\n\n" + MISC
+
+
+def test_leftover_budget_is_filled_with_leading_paragraphs():
+    counter = TokenCounter()
+    misc_paragraphs = MISC.split("\n\n")
+    # 市場規模（スコアが高い）は丸ごと入り、雑記は半分ほどしか入らない予算
+    token_budget = budget_for(counter, MARKET, "\n\n".join(misc_paragraphs[:3])) + 5
+
+    sections, report = pack_sections(SOURCES, token_budget, counter)
+
+    assert [s.title for s in sections] == ["■ 市場規模", "■ 雑記（一部）"]
+    assert sections[1].text == "\n\n".join(misc_paragraphs[:3])
+    assert report["partial_sections"] == 1
+    # 残りは次の1段落より少ない（以前は雑記を丸ごと捨て、半分近くが空いていた）
+    assert 0 <= report["unused_tokens"] < counter.count(misc_paragraphs[3])
+    assert report["per_source"]["白書"]["sections"] == 2
+
+
+def test_budget_too_small_for_any_paragraph():
+    counter = TokenCounter()
+    sections, report = pack_sections(SOURCES, budget_for(counter) + 3, counter)
+    assert sections == []
+    assert report["partial_sections"] == 0
@@ -0,0 +1,346 @@
+# -*- coding: utf-8 -*-
+"""
+日本語を考慮したトークン数の推定と、トークン予算に合わせた市場データの詰め込み
+
+「文字数 // 4」は英語向けの目安で、漢字・かなが1文字1トークン前後になる
+日本語では大幅に少なく見積もってしまう。ここでは文字種ごとの重みで推定し、
+重みは実測値（Anthropic の count_tokens API 等）で校正できる。
+
+詰め込み（pack_sections）は資料を見出し単位のセクションに分け、
+優先度の高いセクションから丸ごと選び、入らなかったセクションは段落の境界で切った先頭部分で
+残りの予算を埋める（段落の途中では切らない）。
+"""
+
+import json
+import os
+import re
+import unicodedata
+
+# 文字種ごとの1文字あたりトークン数（校正前の既定値）
+DEFAULT_WEIGHTS = {
+    "kanji": 1.0,
+    "hiragana": 0.75,
+    "katakana": 0.8,
+    "fullwidth": 1.0,     # 全角記号・全角英数
+    "ascii_alpha": 0.25,  # 英単語は概ね4文字で1トークン
+    "digit": 0.45,
+    "ascii_symbol": 0.8,
+    "space": 0.15,
+    "newline": 0.5,
+    "other": 1.0,
+}
+
+CHAR_CLASSES = tuple(DEFAULT_WEIGHTS)
+
+# 優先度を上げる語（市場規模・売上など分析で参照されやすい数値の章）
+PRIORITY_KEYWORDS = (
+    "市場規模", "売上", "ランキング", "ユーザー数", "課金", "シェア",
+    "前年比", "推移", "ジャンル", "プラットフォーム", "ダウンロード",
+)
+
+# 見出し行とみなすパターン（章・節・番号付き見出し・【】見出し）
+HEADING_PATTERN = re.compile(
+    r"^(第[0-9０-９一二三四五六七八九十百]+[章節部]|[0-9０-９]+(\.[0-9０-９]+)*[\.．、\s]|【[^】]{1,40}】$|■|●|◆)"
+)
+PAGE_MARKER_PATTERN = re.compile(r"^\[p\.(\d+)\]$")
+
+
+def char_class(ch):
+    """1文字の文字種"""
+    if ch == "\n":
+        return "newline"
+    if ch.isspace():
+        return "space"
+    code = ord(ch)
+    if code < 128:
+        if ch.isalpha():
+            return "ascii_alpha"
+        if ch.isdigit():
+            return "digit"
+        return "ascii_symbol"
+    if 0x3040 <= code <= 0x309F:
+        return "hiragana"
+    if 0x30A0 <= code <= 0x30FF or 0xFF66 <= code <= 0xFF9F:
+        return "katakana"
+    if 0x4E00 <= code <= 0x9FFF or 0x3400 <= code <= 0x4DBF or ch in "々〆〇":
+        return "kanji"
+    if 0xFF01 <= code <= 0xFF5E or 0x3000 <= code <= 0x303F:
+        return "fullwidth"
+    if unicodedata.category(ch).startswith("N"):
+        return "digit"
+    return "other"
+
+
+def count_char_classes(text):
+    """文字種ごとの文字数"""
+    counts = dict.fromkeys(CHAR_CLASSES, 0)
+    for ch in text:
+        counts[char_class(ch)] += 1
+    return counts
+
+
+class TokenCounter:
+    """文字種ごとの重みによるトークン数推定"""
+
+    def __init__(self, weights=None):
+        self.weights = {**DEFAULT_WEIGHTS, **(weights or {})}
+
+    def count(self, text):
+        if not text:
+            return 0
+        counts = count_char_classes(text)
+        return int(round(sum(self.weights[name] * n for name, n in counts.items())))
+
+    def calibrate(self, samples, ridge=1e-4):
+        """
+        実測値に合わせて重みを推定した新しいTokenCounterを返す
+
+        Args:
+            samples: [(テキスト, 実測トークン数), ...]（文字種が偏らないよう複数セクションを渡す）
+            ridge: 現在の重みから離れにくくする強さ
+        """
+        import numpy as np
+
+        rows = [count_char_classes(text) for text, _ in samples]
+        matrix = np.array([[row[name] for name in CHAR_CLASSES] for row in rows], dtype=float)
+        actual = np.array([max(tokens, 1) for _, tokens in samples], dtype=float)
+        prior = np.array([self.weights[name] for name in CHAR_CLASSES])
+
+        # 相対誤差の最小二乗 + 現在の重みへの正則化（文字種の構成が似たサンプルばかりでも発散しない）
+        matrix = matrix / actual[:, None]
+        target = np.ones(len(samples))
+        strength = np.sqrt(ridge)
+        solved, *_ = np.linalg.lstsq(
+            np.vstack([matrix, strength * np.eye(len(CHAR_CLASSES))]),
+            np.concatenate([target, strength * prior]),
+            rcond=None
+        )
+        return TokenCounter({name: max(0.0, float(value)) for name, value in zip(CHAR_CLASSES, solved)})
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.weights, f, ensure_ascii=False, indent=2)
+
+    @classmethod
+    def load(cls, path):
+        """校正済みの重みを読み込む（ファイルがなければ既定値）"""
+        try:
+            with open(path, encoding="utf-8") as f:
+                return cls(json.load(f))
+        except (OSError, ValueError):
+            return cls()
+
+
+def reference_token_count(text, api_key=None, model="claude-sonnet-4-20250514", base_url=None):
+    """
+    推定値の検証用のトークン数（取得できなければNone）
+
+    api_key があれば Anthropic の count_tokens API（Claudeの実際のトークン数）、
+    なければ tiktoken（o200k_base）がインストールされていればその値を代わりに使う。
+    """
+    if api_key:
+        try:
+            import anthropic
+
+            client = anthropic.Anthropic(api_key=api_key, base_url=base_url)
+            result = client.messages.count_tokens(model=model, messages=[{"role": "user", "content": text}])
+            return result.input_tokens
+        except Exception as e:
+            print(f"  count_tokens API エラー: {e}")
+            return None
+    try:
+        import tiktoken
+
+        return len(tiktoken.get_encoding("o200k_base").encode(text))
+    except Exception:
+        return None
+
+
+class Section:
+    """資料の1セクション（見出し単位）"""
+
+    def __init__(self, source, index, title, text, first_page=None):
+        self.source = source
+        self.index = index
+        self.title = title
+        self.text = text
+        self.first_page = first_page
+        self.tokens = 0
+        self.score = 0.0
+
+
+def split_sections(text, max_section_tokens=2000, counter=None):
+    """
+    見出し行でセクションに分割（長すぎるセクションは段落境界でさらに分割）
+
+    Returns:
+        [(見出し, 本文, 開始ページ), ...]
+    """
+    counter = counter or TokenCounter()
+    sections = []
+    title, lines, first_page, current_page = "（冒頭）", [], None, None
+
+    def flush():
+        body = "\n".join(lines).strip()
+        # ページの目印だけのブロックは捨てる（ページ番号は次のセクションに引き継がれる）
+        if any(line.strip() and not PAGE_MARKER_PATTERN.match(line.strip()) for line in lines):
+            sections.append((title, body, first_page))
+
+    for line in text.split("\n"):
+        stripped = line.strip()
+        page_match = PAGE_MARKER_PATTERN.match(stripped)
+        if page_match:
+            current_page = int(page_match.group(1))
+            if first_page is None:
+                first_page = current_page
+        elif stripped and len(stripped) <= 60 and HEADING_PATTERN.match(stripped):
+            flush()
+            title, lines, first_page = stripped, [], current_page
+        lines.append(line)
+    flush()
+
+    # 予算の単位として大きすぎるセクションは段落（空行）ごとにまとめ直す
+    result = []
+    for title, body, page in sections:
+        if counter.count(body) <= max_section_tokens:
+            result.append((title, body, page))
+            continue
+        part, part_tokens, part_no = [], 0, 1
+        for paragraph in body.split("\n\n"):
+            tokens = counter.count(paragraph)
+            if part and part_tokens + tokens > max_section_tokens:
+                result.append((f"{title}（{part_no}）", "\n\n".join(part), page))
+                part, part_tokens, part_no = [], 0, part_no + 1
+            part.append(paragraph)
+            part_tokens += tokens
+        if part:
+            result.append((f"{title}（{part_no}）" if part_no > 1 else title, "\n\n".join(part), page))
+    return result
+
+
+def score_section(section, source_priority):
+    """優先度スコア（資料の優先度 × 重要語の密度による加点）"""
+    hits = sum(section.text.count(keyword) for keyword in PRIORITY_KEYWORDS)
+    density = hits * 1000 / max(section.tokens, 1)
+    return source_priority * (1.0 + min(density, 5.0) / 5.0)
+
+
+def leading_paragraphs(section, token_limit, counter, separator_tokens=0):
+    """
+    セクションの先頭から段落（空行区切り）単位で token_limit に収まる部分
+
+    Returns:
+        先頭部分のSection（見出しに「（一部）」を付ける）。1段落も入らなければNone
+    """
+    kept, tokens = [], 0
+    for paragraph in section.text.split("\n\n"):
+        candidate_tokens = counter.count("\n\n".join(kept + [paragraph])) + separator_tokens
+        if candidate_tokens > token_limit:
+            break
+        kept.append(paragraph)
+        tokens = candidate_tokens
+    # ページの目印だけの先頭部分は使わない
+    if not any(line.strip() and not PAGE_MARKER_PATTERN.match(line.strip())
+               for paragraph in kept for line in paragraph.split("\n")):
+        return None
+    part = Section(section.source, section.index, f"{section.title}（一部）", "\n\n".join(kept),
+                   section.first_page)
+    part.tokens = tokens
+    part.score = section.score
+    return part
+
+
+def pack_sections(sources, token_budget, counter=None, max_section_tokens=2000):
+    """
+    複数資料のセクションを優先度順に選び、予算内で最大限埋める
+
+    Args:
+        sources: [{"name": 資料名, "text": 本文, "priority": 優先度（大きいほど優先）}, ...]
+        token_budget: 詰め込むトークン数の上限
+        counter: TokenCounter
+
+    Returns:
+        (選ばれたSectionのリスト（資料順・文書順）, レポートdict)
+    """
+    counter = counter or TokenCounter()
+    # 結合時の区切り・出典見出しの分も予算に含める
+    separator_tokens = counter.count("\n\n")
+    header_tokens = sum(counter.count(source_header(source["name"])) + separator_tokens for source in sources)
+    budget = token_budget - header_tokens
+
+    candidates = []
+    for source in sources:
+        parts = split_sections(source["text"], max_section_tokens, counter)
+        for index, (title, body, page) in enumerate(parts):
+            # 途中のページから始まるセクションにもページの目印を付ける
+            if page is not None and not body.startswith("[p."):
+                body = f"[p.{page}]\n{body}"
+            section = Section(source["name"], index, title, body, page)
+            section.tokens = counter.count(body) + separator_tokens
+            section.score = score_section(section, source.get("priority", 1.0))
+            candidates.append(section)
+
+    # 1) スコアの高い順に、入るものを丸ごと選ぶ
+    selected, used = [], 0
+    remaining = []
+    # 同じスコアなら各資料の前の方から交互に選ぶ（1資料に偏らない）
+    source_order = {source["name"]: i for i, source in enumerate(sources)}
+    for section in sorted(candidates, key=lambda s: (-s.score, s.index, source_order[s.source])):
+        if used + section.tokens <= budget:
+            selected.append(section)
+            used += section.tokens
+        else:
+            remaining.append(section)
+
+    # 2) 入らなかったセクションは、スコアの高い順に段落の境界で切った先頭部分で残りを埋める
+    #    （1) で入らなかったセクションは丸ごとでは残りにも入らない）
+    partial = 0
+    for section in remaining:
+        part = leading_paragraphs(section, budget - used, counter, separator_tokens)
+        if part is not None:
+            selected.append(part)
+            used += part.tokens
+            partial += 1
+
+    selected.sort(key=lambda s: (source_order[s.source], s.index))
+
+    per_source = {}
+    for source in sources:
+        name = source["name"]
+        total = [s for s in candidates if s.source == name]
+        chosen = [s for s in selected if s.source == name]
+        per_source[name] = {
+            "sections": len(chosen),
+            "total_sections": len(total),
+            "tokens": sum(s.tokens for s in chosen),
+            "total_tokens": sum(s.tokens for s in total),
+        }
+
+    estimated = counter.count(render_sections(selected))
+    report = {
+        "token_budget": token_budget,
+        "estimated_tokens": estimated,
+        "unused_tokens": token_budget - estimated,
+        "sections": len(selected),
+        "partial_sections": partial,
+        "total_sections": len(candidates),
+        "per_source": per_source,
+    }
+    return selected, report
+
+
+def source_header(name):
+    return f"【出典: {name}】"
+
+
+def render_sections(sections):
+    """選ばれたセクションを出典見出し付きのテキストに結合"""
+    blocks = []
+    current_source = None
+    for section in sections:
+        if section.source != current_source:
+            blocks.append(source_header(section.source))
+            current_source = section.source
+        blocks.append(section.text)
+    return "\n\n".join(blocks)
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""
+アップロードされた市場データPDFの取り込み
+
+アップロードされたファイルは1MBずつディスクへ書き出しながらSHA-256を計算し、
+同じ内容のファイルが取り込み済みならそのまま再利用する（再アップロードは即時）。
+テキスト抽出・パッセージ分割・検索インデックスの構築はバックグラウンドスレッド
+（ページ抽出はさらにプロセスプール）で行い、Streamlitのスクリプト実行を止めない。
+
+保存形式（base_dir/<SHA-256>/ 配下）:
+    source.pdf   アップロードされたファイル
+    status.json  状態（extracting / ready / error）・ページ数・ファイル名
+    index/       検索インデックス（market_index.MarketIndex）
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from market_index import MarketIndex
+from pdf_extract import PageTextCache, extract_pdf_pages, join_pages
+
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+STATUS_EXTRACTING = "extracting"
+STATUS_READY = "ready"
+STATUS_ERROR = "error"
+
+
+class UploadIngestor:
+    """
+    アップロードPDFの取り込み（プロセス内で共有し、同じファイルの処理は1回だけ）
+
+    submit() はファイルを保存してジョブを登録するだけで、抽出の完了は待たない。
+    進捗は status()、完成したインデックスは load_index() で取得する。
+    """
+
+    def __init__(self, base_dir="cache/uploads", page_cache_dir="cache/pdf_pages", extract_workers=None,
+                 max_jobs=2, max_loaded_indexes=4):
+        self.base_dir = base_dir
+        self.page_cache = PageTextCache(page_cache_dir)
+        self.extract_workers = extract_workers
+        self.max_loaded_indexes = max_loaded_indexes
+        self._executor = ThreadPoolExecutor(max_workers=max_jobs, thread_name_prefix="upload-ingest")
+        self._lock = threading.Lock()
+        self._progress = {}
+        self._in_flight = set()
+        self._indexes = {}
+        os.makedirs(base_dir, exist_ok=True)
+
+    def _dir(self, digest):
+        return os.path.join(self.base_dir, digest)
+
+    # ---------- 登録 ----------
+
+    def submit(self, uploaded_file, file_name=None):
+        """
+        アップロードされたファイルを保存して取り込みジョブを登録
+
+        Args:
+            uploaded_file: read(size) できるファイルオブジェクト（st.file_uploader の戻り値など）
+            file_name: 表示・出典用のファイル名
+
+        Returns:
+            ファイル内容のSHA-256（以降の status() / load_index() のキー）
+        """
+        file_name = file_name or getattr(uploaded_file, "name", "uploaded.pdf")
+        digest, tmp_path = self._stream_to_disk(uploaded_file)
+
+        status = self.status(digest)
+        with self._lock:
+            if status["state"] in (STATUS_READY, STATUS_EXTRACTING) or digest in self._in_flight:
+                # 取り込み済み・取り込み中なら保存したファイルは不要
+                os.remove(tmp_path)
+                return digest
+            self._in_flight.add(digest)
+
+        target_dir = self._dir(digest)
+        os.makedirs(target_dir, exist_ok=True)
+        os.replace(tmp_path, os.path.join(target_dir, "source.pdf"))
+        self._write_status(digest, {"state": STATUS_EXTRACTING, "file_name": file_name})
+        self._executor.submit(self._ingest, digest, file_name)
+        return digest
+
+    def _stream_to_disk(self, uploaded_file):
+        """1MBずつ一時ファイルへ書き出しながらハッシュを計算（全体を別のbytesにコピーしない）"""
+        if hasattr(uploaded_file, "seek"):
+            uploaded_file.seek(0)
+        hasher = hashlib.sha256()
+        fd, tmp_path = tempfile.mkstemp(suffix=".pdf.part", dir=self.base_dir)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for block in iter(lambda: uploaded_file.read(STREAM_CHUNK_SIZE), b""):
+                    hasher.update(block)
+                    f.write(block)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        return hasher.hexdigest(), tmp_path
+
+    # ---------- バックグラウンド処理 ----------
+
+    def _ingest(self, digest, file_name):
+        pdf_path = os.path.join(self._dir(digest), "source.pdf")
+        try:
+            def on_progress(path, done, total):
+                self._progress[digest] = (done, total)
+
+            pages_by_path, stats = extract_pdf_pages(
+                [pdf_path], cache=self.page_cache, workers=self.extract_workers, on_progress=on_progress
+            )
+            pages = pages_by_path[pdf_path]
+            source_name = os.path.splitext(file_name)[0]
+            index = MarketIndex.build([{"name": source_name, "text": join_pages(pages)}])
+            index.save(os.path.join(self._dir(digest), "index"))
+            self._write_status(digest, {
+                "state": STATUS_READY,
+                "file_name": file_name,
+                "pages": stats["pages"],
+                "passages": len(index.passages),
+                "seconds": round(stats["seconds"], 2),
+            })
+        except Exception as e:
+            self._write_status(digest, {"state": STATUS_ERROR, "file_name": file_name, "error": str(e)})
+        finally:
+            with self._lock:
+                self._in_flight.discard(digest)
+                self._progress.pop(digest, None)
+
+    def _write_status(self, digest, status):
+        path = os.path.join(self._dir(digest), "status.json")
+        os.makedirs(self._dir(digest), exist_ok=True)
+        with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+            json.dump(status, f, ensure_ascii=False)
+        os.replace(f"{path}.tmp", path)
+
+    # ---------- 参照 ----------
+
+    def status(self, digest):
+        """
+        取り込み状態
+
+        Returns:
+            {"state": "missing" / "extracting" / "ready" / "error", "pages_done", "pages_total", ...}
+        """
+        try:
+            with open(os.path.join(self._dir(digest), "status.json"), encoding="utf-8") as f:
+                status = json.load(f)
+        except (OSError, ValueError):
+            return {"state": "missing"}
+
+        if status["state"] == STATUS_EXTRACTING:
+            with self._lock:
+                in_flight = digest in self._in_flight
+            if not in_flight:
+                # 前回のプロセスが処理途中で終了した（次の submit で再処理）
+                return {"state": "missing"}
+            done, total = self._progress.get(digest, (0, 0))
+            status.update(pages_done=done, pages_total=total)
+        return status
+
+    def pages(self, digest):
+        """取り込み済みファイルのページテキスト（ページキャッシュから読む、未完了ならNone）"""
+        if self.status(digest)["state"] != STATUS_READY:
+            return None
+        pdf_path = os.path.join(self._dir(digest), "source.pdf")
+        pages_by_path, _ = extract_pdf_pages([pdf_path], cache=self.page_cache, workers=self.extract_workers)
+        return pages_by_path[pdf_path]
+
+    def load_index(self, digest):
+        """取り込み済みファイルの検索インデックス（未完了ならNone、少数だけメモリに保持）"""
+        with self._lock:
+            if digest in self._indexes:
+                return self._indexes[digest]
+        if self.status(digest)["state"] != STATUS_READY:
+            return None
+        index = MarketIndex.load(os.path.join(self._dir(digest), "index"))
+        with self._lock:
+            self._indexes[digest] = index
+            while len(self._indexes) > self.max_loaded_indexes:
+                self._indexes.pop(next(iter(self._indexes)))
+        return index